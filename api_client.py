@@ -0,0 +1,229 @@
+"""
+HTTP-клиент chat2desk: общий пул соединений, таймауты и адаптивный лимит запросов.
+
+Chat2DeskClient — синхронный клиент для пула потоков (requests.Session с
+keep-alive, пул по числу воркеров). AsyncChat2DeskClient — вариант на asyncio
+(нужен aiohttp), держит тысячи запросов в полете в одном потоке.
+Оба клиента делят AdaptiveRateLimiter (limiter=, Pipeline передает один на
+процесс): token bucket + ограничение параллельности, которые сжимаются при
+429 (вдвое), 5xx/сетевых ошибках/росте задержки (мягко) и плавно восстанавливаются.
+Повторяют одно и то же: 429 (после паузы Retry-After), 5xx и сетевые ошибки
+и таймауты (с растущей паузой), до MAX_RETRIES раз.
+"""
+import asyncio
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Metrics, endpoint_label
+
+try:
+    import aiohttp
+except ImportError:  # асинхронный режим опционален
+    aiohttp = None
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+TOTAL_TIMEOUT = 120  # весь запрос в асинхронном клиенте: зависшее соединение не держит загрузку
+MAX_RETRIES = 3      # повторы 429, 5xx и сетевых ошибок
+RETRY_BACKOFF = 0.5  # пауза перед повтором 5xx/сетевой ошибки, секунды; удваивается
+LATENCY_SLACK = 0.05 # рост задержки меньше этого (секунды) — шум, а не перегрузка сервера
+
+
+class AdaptiveRateLimiter:
+    """Token bucket с адаптивной скоростью и числом одновременных запросов (AIMD).
+
+    - 429 (или ответ с Retry-After): скорость и параллельность делятся пополам,
+      Retry-After приостанавливает выдачу токенов;
+    - 5xx / сетевая ошибка и задержка (EWMA), выросшая вдвое (и не меньше чем
+      на LATENCY_SLACK) относительно базовой: мягкое снижение — единичный сбой
+      не должен обрушивать поток;
+    - успешные ответы: скорость и параллельность растут до исходных значений.
+    """
+
+    def __init__(self, rate, max_concurrency, min_rate=1.0, min_concurrency=1):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.min_concurrency = min_concurrency
+        self.tokens = float(rate)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency_ewma = None
+        self.latency_base = None
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Берет слот, если можно. Возвращает 0 или сколько секунд подождать."""
+        now = time.monotonic()
+        with self._lock:
+            self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now < self.paused_until: return self.paused_until - now
+            if self.in_flight >= self.concurrency: return 0.01
+            if self.tokens < 1: return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self):
+        while True:
+            delay = self._reserve()
+            if not delay: return
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        while True:
+            delay = self._reserve()
+            if not delay: return
+            await asyncio.sleep(delay)
+
+    def _decrease(self):
+        """Мягкое снижение (под self._lock): скорость -10%, параллельность -1"""
+        self.rate = max(self.min_rate, self.rate * 0.9)
+        self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+        self._successes = 0
+
+    def release(self, status, latency, retry_after=None):
+        """status=None — сетевая ошибка/таймаут."""
+        with self._lock:
+            self.in_flight -= 1
+            if status == 429 or retry_after:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+                self._successes = 0
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                return
+            if status is None or status >= 500:
+                self._decrease()
+                return
+
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            # Базовая задержка медленно "подтягивается" вверх, чтобы не залипнуть на случайном минимуме
+            self.latency_base = self.latency_ewma if self.latency_base is None else min(self.latency_base * 1.001, self.latency_ewma)
+            # Вдвое и заметно в абсолютных числах: на быстрых ответах (единицы мс) удвоение —
+            # это шум, а базовая задержка по минимуму подтягивается вверх слишком медленно
+            if self.latency_ewma > max(2 * self.latency_base, self.latency_base + LATENCY_SLACK):
+                self._decrease()
+                return
+
+            self._successes += 1
+            if self._successes >= self.concurrency:
+                self._successes = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def record_response(metrics, endpoint, status, latency):
+    """Задержка попытки и ее статус ("error" — сетевая ошибка/таймаут)"""
+    metrics.observe('http_request_seconds', latency, endpoint=endpoint)
+    metrics.inc('http_responses_total', endpoint=endpoint, status=status)
+
+
+def retryable(status):
+    """Стоит ли повторить попытку: 429, 5xx или сетевая ошибка/таймаут (status=None)"""
+    return status is None or status == 429 or status >= 500
+
+def retry_delay(status, attempt):
+    """Пауза перед повтором: у 429 ее задает Retry-After через лимитер"""
+    return 0 if status == 429 else RETRY_BACKOFF * 2 ** attempt
+
+def _retry_after(headers):
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Chat2DeskClient:
+    """Синхронный клиент для пула потоков. Одна сессия на процесс, пул = число воркеров."""
+
+    def __init__(self, base_url, token, pool_size, rate=25, limiter=None, metrics=None):
+        self.base_url = base_url.rstrip('/')
+        self.limiter = limiter or AdaptiveRateLimiter(rate, pool_size)
+        self.metrics = metrics or Metrics()
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": token})
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, params=None):
+        """GET с таймаутом. 429, 5xx и сетевые ошибки повторяются (до MAX_RETRIES);
+        сетевая ошибка последней попытки пробрасывается."""
+        endpoint = endpoint_label(path)
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                r = self.session.get(f"{self.base_url}{path}", params=params, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+                status = r.status_code
+            except requests.RequestException:
+                status = None
+                if attempt == MAX_RETRIES:
+                    self.limiter.release(None, time.monotonic() - started)
+                    record_response(self.metrics, endpoint, "error", time.monotonic() - started)
+                    raise
+            self.limiter.release(status, time.monotonic() - started, _retry_after(r.headers) if status else None)
+            record_response(self.metrics, endpoint, status or "error", time.monotonic() - started)
+            if not retryable(status) or attempt == MAX_RETRIES: return r
+            self.metrics.inc('retries_total', kind='http')
+            time.sleep(retry_delay(status, attempt))
+        return r
+
+
+class AsyncChat2DeskClient:
+    """Асинхронный клиент (aiohttp). Использовать как `async with`."""
+
+    def __init__(self, base_url, token, max_connections=200, rate=25, limiter=None, metrics=None):
+        if aiohttp is None:
+            raise RuntimeError("Для асинхронного режима нужен пакет aiohttp")
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.max_connections = max_connections
+        self.limiter = limiter or AdaptiveRateLimiter(rate, max_connections)
+        self.metrics = metrics or Metrics()
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            headers={"Authorization": self.token},
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def get_json(self, path, params=None):
+        """Возвращает (status, json | None). Повторы — как у Chat2DeskClient.get,
+        плюс ответ 200 с телом не-JSON; ошибка последней попытки пробрасывается."""
+        endpoint = endpoint_label(path)
+        for attempt in range(MAX_RETRIES + 1):
+            await self.limiter.acquire_async()
+            started = time.monotonic()
+            status, data, headers = None, None, {}
+            try:
+                async with self._session.get(f"{self.base_url}{path}", params=params) as r:
+                    status, headers = r.status, r.headers
+                    data = await r.json(content_type=None) if status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                # Сеть, таймаут или тело 200, которое не JSON (страница прокси, обрыв) — неудачная попытка
+                status, data = None, None
+                if attempt == MAX_RETRIES: raise
+            finally:
+                # Слот лимитера возвращается при любом исходе, в том числе при отмене задачи
+                self.limiter.release(status, time.monotonic() - started, _retry_after(headers))
+                record_response(self.metrics, endpoint, status or "error", time.monotonic() - started)
+            if not retryable(status) or attempt == MAX_RETRIES: return status, data
+            self.metrics.inc('retries_total', kind='http')
+            await asyncio.sleep(retry_delay(status, attempt))
+        return status, data
@@ -1,12 +1,21 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import requests
-import matplotlib.pyplot as plt
+from matplotlib.patches import Circle
 import seaborn as sns
 import plotly.express as px  
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import re
+import json
+import time
+import functools
+from datetime import date, datetime, timedelta, timezone
+from sheet_loader import SheetLoader
+from sheet_cube import SheetCube, day_range, ranked_counts, topic_dynamics, total_rows
+from charts import ChartCache
+from prefetch import PrefetchScheduler
+from pipeline import Pipeline, TIME_OFFSET, department_metrics, now_local
+from metrics import diff_snapshots, hist_quantile, to_json, to_prometheus
 
 # ==========================================
 # 1. КОНФИГУРАЦИЯ И БЕЗОПАСНОСТЬ
@@ -25,71 +34,38 @@ except KeyError as e:
     st.stop()
 
 # КОНСТАНТЫ (теперь они чистые)
-BASE_URL = "https://api.chat2desk.com/v1"
-HEADERS  = {"Authorization": API_TOKEN}
 SHEET_URL = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/export?format=csv&gid={GID}"
+SHEET_DATE_FORMAT = st.secrets.get("SHEET_DATE_FORMAT", "%d.%m.%Y %H:%M:%S")
+SHEET_REFRESH_SECONDS = 600
 
-MAX_WORKERS = 20
-TIME_OFFSET = 3
-
-# СПРАВОЧНИКИ
-OPERATORS_MAP = {310507: "Бот AI", 0: "Система"}
-DEPARTMENT_MAPPING = {
-    "Никита Приходько": "Concierge", 
-    "Алина Федулова": "Тренер",
-    "Илья Аврамов": "Appointment",
-    "Виктория Суворова": "Appointment",
-    "Кирилл Минаев": "Appointment",
-    "Мария Попова": "Без отдела",
-    "Станислав Басов": "Claims",
-    "Милена Говорова": "Без отдела",
-    "Надежда Смирнова": "Сопровождение",
-    "Ирина Вережан": "Claims",
-    "Наталья Половникова": "Claims",
-    "Администратор": "Без отдела",
-    "Владимир Асатрян": "Без отдела",
-    "Екатерина Ермакова": "Без отдела",
-    "Константин Гетман": "SMM",
-    "Екатерина Анисимова": "Без отдела",
-    "Оля Трущелева": "Без отдела",
-    "Алина Новикова": "SALE",
-    "Иван Савицкий": "SALE",
-    "Анастасия Ванян": "SALE",
-    "Павел Новиков": "SALE",
-    "Александра Шаповал": "SMM",
-    "Георгий Астапов": "Deep_support",
-    "Елена Панова": "Deep_support",
-    "Татьяна Сошникова": "SMM",
-    "Виктория Вороняк": "SMM",
-    "Анна Чернышова": "SMM",
-    "Алина Ребрина": "Claims",
-    "Алена Воронина": "Claims",
-    "Ксения Бухонина": "Сопровождение",
-    "Елизавета Давыденко": "Сопровождение",
-    "Екатерина Кондратьева": "Сопровождение",
-    "Ксения Гаврилова": "Claims",
-    "Снежана Ефимова": "Сопровождение",
-    "Анастасия Карпеева": "Claims",
-    "Кристина Любина": "Сопровождение",
-    "Наталья Серебрякова": "Сопровождение",
-    "Константин Клишин": "Claims",
-    "Наталья Баландина": "Claims",
-    "Даниил Гусев": "Appointment",
-    "Анна Власенкова": "SMM",
-    "Регина Арендт": "Сопровождение",
-    "Екатерина Щукина": "Сопровождение",
-    "Ксения Кривко": "Claims",
-    "Вероника Софронова": "SMM",
-    "Юрий Кобелев": "Claims",
-    "Арина Прохорова": "SMM"
-}
-
-CUSTOM_GROUPING = {
-    "Cleaner_Payments": "Сопровождение",
-    "Penalty": "Сопровождение",
-    "Operations": "Сопровождение",
-    "Storage": "Сопровождение"
-}
+# HTTP: лимит запросов в секунду (адаптивно снижается при 429/5xx) и режим загрузки сообщений;
+# остальные параметры загрузки и обработки диалогов — в pipeline.py
+API_RATE_LIMIT = float(st.secrets.get("API_RATE_LIMIT", 25))
+HTTP_MODE = st.secrets.get("HTTP_MODE", "threads")  # "threads" | "async" (нужен aiohttp)
+CPU_WORKERS = int(st.secrets.get("CPU_WORKERS", 0))  # процессов расчета диалогов; 0 — в основном процессе
+
+# Локальное хранилище посуточных результатов API
+STORE_PATH = st.secrets.get("STORE_PATH", os.path.join(".cache", "api_days.sqlite"))
+
+# Фоновое обновление ходовых периодов (сегодня, вчера, 7 дней и прошлые к ним)
+PREFETCH_INTERVAL_MINUTES = int(st.secrets.get("PREFETCH_INTERVAL_MINUTES", 15))  # 0 — выключено
+PREFETCH_HOURS = tuple(st.secrets.get("PREFETCH_HOURS", (7, 23)))  # локальные часы [с, до)
+# Открытый день, обновленный в фоне не раньше этого, интерфейс берет из хранилища, а не из API
+# (без фона — раз в час, как раньше жил кэш загрузки); кнопка "Запустить анализ" обновляет сразу
+OPEN_DAY_MAX_AGE = (PREFETCH_INTERVAL_MINUTES or 60) * 60
+
+# Сколько наборов входных данных (период × версия таблицы × отдел) помнит кэш расчетов вкладок
+TAB_CACHE_ENTRIES = 32
+
+# Кэш картинок графиков (PNG): сколько хранить и предельный суммарный размер
+CHART_CACHE_ITEMS = 128
+CHART_CACHE_MB = 64
+
+# Динамика: сколько типов обращений (самых частых) показывать на тепловых картах тренда
+DYNAMICS_TOP_TOPICS = 20
+
+# Панель метрик прогона в сайдбаре (время стадий, HTTP, размеры таблиц, выгрузка JSON/Prometheus)
+ADMIN_PANEL = bool(st.secrets.get("ADMIN_PANEL", False))
 
 # ==========================================
 # 2. АВТОРИЗАЦИЯ
@@ -119,20 +95,6 @@ if not check_password():
 # ==========================================
 # 3. ФУНКЦИИ API И ОБРАБОТКИ
 # ==========================================
-def normalize_text(text):
-    if not text: return ""
-    return str(text).lower().strip().replace("ё", "е")
-
-def find_department_smart(api_name_full):
-    clean_api = normalize_text(api_name_full)
-    for name, dept in DEPARTMENT_MAPPING.items():
-        if normalize_text(name) == clean_api: return dept
-    for name_key, dept in DEPARTMENT_MAPPING.items():
-        parts = normalize_text(name_key).split()
-        if not parts: continue
-        if all(part in clean_api for part in parts): return dept
-    return "Не определен"
-
 def format_seconds(x):
     if pd.isna(x) or x is None: return "-"
     try:
@@ -143,226 +105,340 @@ def format_seconds(x):
         return f"{m}м {s}с"
     except: return "-"
 
-def process_single_dialog(item, target_start, target_end):
-    req_id = item['req_id']
-    try:
-        r = requests.get(f"{BASE_URL}/requests/{req_id}/messages", headers=HEADERS, params={"limit": 300})
-        if r.status_code != 200: return None
-        json_data = r.json()
-        msgs = json_data if isinstance(json_data, list) else json_data.get('data', [])
-        msgs.sort(key=lambda x: x.get('created', 0))
-        
-        client_waiting_since = None
-        stats = {
-            'req_id': req_id,
-            'participations': set(),
-            'operator_speeds': {},
-            'op_hours': {}, 
-            'rating': item.get('rating')
-        }
-        
-        for m in msgs:
-            ts = m.get('created')
-            if not ts: continue
-            dt_utc = pd.to_datetime(ts, unit='s')
-            dt_local = dt_utc + timedelta(hours=TIME_OFFSET)
-            
-            msg_type = m.get('type')
-            op_id = m.get('operatorID') or m.get('operator_id')
-            
-            if msg_type == 'from_client' or msg_type == 'in':
-                if client_waiting_since is None: client_waiting_since = dt_local
-            
-            # ИСПРАВЛЕНИЕ: Убрали ограничение на бота (310507), чтобы он тоже собирал статистику
-            elif msg_type == 'out' and op_id and op_id != 0:
-                 if target_start <= dt_local <= target_end:
-                      stats['participations'].add(op_id)
-                      
-                      if op_id not in stats['op_hours']: stats['op_hours'][op_id] = set()
-                      stats['op_hours'][op_id].add((dt_local.date(), dt_local.hour)) 
-                      
-                      if client_waiting_since:
-                          diff = (dt_local - client_waiting_since).total_seconds()
-                          if diff > 0:
-                              if op_id not in stats['operator_speeds']: 
-                                  stats['operator_speeds'][op_id] = []
-                              stats['operator_speeds'][op_id].append(diff)
-                          client_waiting_since = None
-                      
-        return stats
-    except:
-        return None
-
-@st.cache_data(ttl=3600)
-def load_api_data_range(start_date, end_date):
-    # ИСПРАВЛЕНИЕ: Локальный справочник операторов, чтобы не ломать кэш Streamlit
-    local_op_map = {310507: "Бот AI", 0: "Система"}
-    try:
-        r = requests.get(f"{BASE_URL}/operators", headers=HEADERS, params={"limit": 1000})
-        for op in r.json().get('data', []):
-            name = f"{op.get('first_name', '')} {op.get('last_name', '')}".strip()
-            if not name: name = op.get('email', str(op['id']))
-            local_op_map[op['id']] = name
-    except: pass
-    
-    all_active_requests = []
-    date_list = pd.date_range(start_date, end_date).strftime("%Y-%m-%d").tolist()
-    
-    progress_bar = st.progress(0)
+@st.cache_resource
+def get_pipeline():
+    # Клиент API, хранилище дней и справочник операторов — один набор на процесс, общий для всех сессий
+    return Pipeline(API_TOKEN, STORE_PATH, rate=API_RATE_LIMIT, http_mode=HTTP_MODE, cpu_workers=CPU_WORKERS)
+
+@st.cache_resource
+def get_chart_cache():
+    return ChartCache(CHART_CACHE_ITEMS, CHART_CACHE_MB * 2**20)
+
+@st.cache_resource
+def get_prefetcher():
+    """Фоновый прогрев хранилища (один поток на процесс); None, если выключен"""
+    if PREFETCH_INTERVAL_MINUTES <= 0: return None
+    return PrefetchScheduler(get_pipeline().refresh_days, now_local, PREFETCH_INTERVAL_MINUTES * 60, hours=PREFETCH_HOURS).start()
+
+def load_api_data_range(start_date, end_date, force=False, full_reload=False, retry_failed=False, preview=False):
+    """(факты, скорости, первые скорости, версия данных) за диапазон.
+
+    Незакрытые дни догружаются (force — без оглядки на свежесть, по кнопке
+    обновления; full_reload — только вместе с force; retry_failed — сначала
+    перезапросить то, что не загрузилось в прошлый раз), затем таблица
+    собирается из хранилища. Сборка кэшируется по версии данных этих дней и
+    справочника операторов: обновление дня сбрасывает только диапазоны с ним,
+    новое имя оператора — все, а одинаковые отчеты разных сессий считаются
+    один раз. preview — пока идет загрузка,
+    показывать предварительные KPI и нагрузку (partial_preview)."""
+    date_list = [d.date() for d in pd.date_range(start_date, end_date)]
+    progress_bar = st.empty()
     status_text = st.empty()
-    
-    for i, d_str in enumerate(date_list):
-        status_text.text(f"Сбор списка чатов за {d_str}...")
-        limit = 200; offset = 0
-        while offset < 5000:
-            try:
-                params = {"report": "request_stats", "date": d_str, "limit": limit, "offset": offset}
-                r = requests.get(f"{BASE_URL}/statistics", headers=HEADERS, params=params)
-                data = r.json().get('data', [])
-                if not data: break
-                for row in data:
-                    rating = row.get('rating_scale_score')
-                    if rating == 0 or rating == '0': rating = None
-                    all_active_requests.append({'req_id': row['request_id'], 'rating': rating})
-                if len(data) < limit: break
-                offset += limit
-            except: break
-        progress_bar.progress((i + 1) / (len(date_list) * 2))
-
-    unique_requests = {v['req_id']: v for v in all_active_requests}.values()
-    
-    final_rows = []
-    all_speeds = {}        
-    all_first_speeds = {} 
-    
-    total = len(unique_requests)
-    completed = 0
-    
-    target_start_global = pd.to_datetime(f"{start_date.strftime('%Y-%m-%d')} 00:00:00")
-    target_end_global = pd.to_datetime(f"{end_date.strftime('%Y-%m-%d')} 23:59:59")
-    
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_single_dialog, item, target_start_global, target_end_global): item for item in unique_requests}
-        for future in as_completed(futures):
-            res = future.result()
-            if res and res['participations']:
-                for op_id, speeds in res['operator_speeds'].items():
-                    if op_id not in all_speeds: all_speeds[op_id] = []
-                    all_speeds[op_id].extend(speeds)
-                    
-                    if speeds:
-                        if op_id not in all_first_speeds: all_first_speeds[op_id] = []
-                        all_first_speeds[op_id].append(speeds[0])
-
-                for op_id in res['participations']:
-                    # ИСПРАВЛЕНИЕ: Выделяем бота в отдельный отдел
-                    if op_id == 310507:
-                        op_name = "🤖 Бот AI"
-                        dept = "Бот AI"
-                    else:
-                        # ИСПОЛЬЗУЕМ ЛОКАЛЬНЫЙ СПРАВОЧНИК
-                        op_name = local_op_map.get(op_id, f"ID {op_id}")
-                        dept = find_department_smart(op_name)
-                        if dept in CUSTOM_GROUPING: dept = CUSTOM_GROUPING[dept]
-                        
-                    if dept == "Тренер": continue
-                    
-                    hours = res.get('op_hours', {}).get(op_id, set())
-                    if not hours:
-                        final_rows.append({
-                            'req_id': res['req_id'],
-                            'operator_id': op_id,
-                            'Оператор': op_name,
-                            'Отдел': dept,
-                            'rating': res['rating'],
-                            'Дата': None,
-                            'Час': -1
-                        })
-                    else:
-                        for d, h in hours: 
-                            final_rows.append({
-                                'req_id': res['req_id'],
-                                'operator_id': op_id,
-                                'Оператор': op_name,
-                                'Отдел': dept,
-                                'rating': res['rating'],
-                                'Дата': d, 
-                                'Час': h
-                            })
-            
-            completed += 1
-            if total > 0: 
-                current_prog = 0.5 + (completed / total * 0.5)
-                progress_bar.progress(min(current_prog, 1.0))
-                status_text.text(f"Анализ диалогов: {completed}/{total}")
-            
+    def on_progress(frac, text):
+        progress_bar.progress(frac); status_text.text(text)
+    def on_wait(n_days):
+        status_text.text(f"Ждем загрузку {n_days} дн., начатую другой сессией...")
+    preview_box = st.empty() if preview else None
+    def on_partial(facts, speeds, first_speeds, done, total):
+        with preview_box.container(): partial_preview(facts, speeds, first_speeds, done, total)
+    pipeline = get_pipeline()
+    if retry_failed: pipeline.retry_failed(date_list, on_progress, on_wait)
+    pipeline.refresh_days(date_list, force and full_reload, 0 if force else OPEN_DAY_MAX_AGE, on_progress, on_wait,
+                          on_partial if preview else None)
     progress_bar.empty(); status_text.empty()
-    
-    df = pd.DataFrame(final_rows)
-    return df, all_speeds, all_first_speeds
-
-def get_dynamics_stats(df, start_date, end_date):
-    """Возвращает агрегированные данные: объем и % закрытия ботом"""
-    mask = (df['Дата'].dt.date >= start_date) & (df['Дата'].dt.date <= end_date)
-    period_df = df[mask].copy()
-    
-    if period_df.empty:
-        return pd.DataFrame(columns=['Всего', 'Бот_%'])
-    
-    stats = period_df.groupby('Тип обращения').agg(
-        Всего=('Дата', 'count'),
-        Закрыто_ботом=('Статус', lambda x: (x == 'Закрыл').sum())
+    if preview: preview_box.empty()
+
+    # Ключ — после догрузки и чтения: сборка таблицы ищет новых операторов в API и
+    # может поднять версию справочника. Тогда собранное под прежним ключом
+    # перечитываем под новым, иначе следующий прогон соберет таблицу еще раз.
+    version = (pipeline.store.data_version(date_list), pipeline.operators.version)
+    data = read_api_range(start_date, end_date, version)
+    if pipeline.operators.version != version[1]:
+        version = (pipeline.store.data_version(date_list), pipeline.operators.version)
+        data = read_api_range(start_date, end_date, version)
+    return (*data, version)
+
+@st.cache_data(ttl=3600, max_entries=TAB_CACHE_ENTRIES, show_spinner=False)
+def read_api_range(start_date, end_date, version):
+    """Факты и гистограммы скоростей за диапазон из хранилища (version — ключ кэша)"""
+    return get_pipeline().read_range(start_date, end_date)
+
+def partial_preview(facts, speeds, first_speeds, done, total):
+    """Предварительные цифры во время загрузки: KPI по API и нагрузка по отделам.
+    Дни, которые еще грузятся, учтены только посчитанными диалогами."""
+    st.info(f"⏳ Предварительные данные: посчитано {done} из {total} диалогов, цифры еще изменятся")
+    if facts.empty: return
+    summary = department_metrics(facts, speeds, first_speeds)
+    cols = st.columns(4)
+    cols[0].metric("Люди (Всего)", summary['chats'], help="Предварительно")
+    cols[1].metric("1-я скорость (медиана)", format_seconds(summary['first_speed']), help="Предварительно")
+    cols[2].metric("Скорость (медиана)", format_seconds(summary['speed']), help="Предварительно")
+    cols[3].metric("CSAT", f"{summary['csat']:.2f}" if summary['ratings'] else "-", help="Предварительно")
+
+    rows = []
+    for dept, dept_data in facts.groupby('Отдел', observed=True):
+        m = department_metrics(dept_data, speeds, first_speeds, dept == "Бот AI")
+        if m: rows.append({"Отдел": dept, "Кол-во чатов": m['chats'], "1-я скор.": format_seconds(m['first_speed']),
+                           "Ср. скор.": format_seconds(m['speed'])})
+    if rows:
+        st.dataframe(pd.DataFrame(rows).sort_values("Кол-во чатов", ascending=False), hide_index=True, use_container_width=True)
+
+# --- МЕТРИКИ ---
+def timed_tab(name):
+    """Время отрисовки вкладки -> tab_render_seconds{tab=name}, в том числе при перезапуске фрагмента"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper():
+            with get_pipeline().metrics.timer('tab_render_seconds', tab=name):
+                fn()
+        return wrapper
+    return decorator
+
+def record_frame_sizes(metrics, **frames):
+    """Строки и байты (с содержимым колонок) таблиц прогона"""
+    for name, df in frames.items():
+        metrics.set('frame_rows', len(df), frame=name)
+        metrics.set('frame_bytes', int(df.memory_usage(deep=True).sum()), frame=name)
+
+def metrics_panel(run):
+    """Панель метрик прогона (разность снимков реестра до и после прогона)"""
+    buckets = run['buckets']
+    def ms(value): return f"{value * 1000:.0f}" if value is not None else "-"
+
+    with st.sidebar.expander("⏱️ Метрики прогона", expanded=False):
+        st.caption("За время прогона по всему процессу: включая другие сессии и фоновое обновление")
+        timings = [
+            {"Стадия": f"{name.removesuffix('_seconds')}: {dict(labels).popitem()[1]}", "N": hist[2], "Всего, с": round(hist[1], 2),
+             "p50, мс": ms(hist_quantile(buckets, hist, 0.5)), "p99, мс": ms(hist_quantile(buckets, hist, 0.99))}
+            for (name, labels), hist in sorted(run['histograms'].items())
+            if name in ('stage_seconds', 'tab_render_seconds', 'json_parse_seconds', 'run_seconds') and labels
+        ]
+        if timings: st.dataframe(pd.DataFrame(timings), hide_index=True, use_container_width=True)
+
+        statuses = {}
+        for (name, labels), count in run['counters'].items():
+            if name == 'http_responses_total':
+                lab = dict(labels)
+                statuses.setdefault(lab['endpoint'], []).append(f"{lab['status']}: {count}")
+        http = [
+            {"Запрос": dict(labels)['endpoint'], "N": hist[2], "Статусы": ", ".join(sorted(statuses.get(dict(labels)['endpoint'], []))),
+             "p50, мс": ms(hist_quantile(buckets, hist, 0.5)), "p99, мс": ms(hist_quantile(buckets, hist, 0.99))}
+            for (name, labels), hist in sorted(run['histograms'].items()) if name == 'http_request_seconds'
+        ]
+        if http: st.dataframe(pd.DataFrame(http), hide_index=True, use_container_width=True)
+
+        dialogs = run['counters'].get(('dialogs_processed_total', ()), 0)
+        dialogs_time = run['histograms'].get(('stage_seconds', (('stage', 'dialogs'),)), (None, 0, 0))[1]
+        if dialogs and dialogs_time: st.caption(f"Диалогов в секунду: {dialogs / dialogs_time:.0f} ({dialogs} за {dialogs_time:.1f} с)")
+        retries = {dict(labels)['kind']: n for (name, labels), n in run['counters'].items() if name == 'retries_total'}
+        failed = run['counters'].get(('dialogs_failed_total', ()), 0)
+        if retries or failed:
+            st.caption(f"Повторов: HTTP-запросов {retries.get('http', 0)}, страниц {retries.get('stats_page', 0)}, "
+                       f"диалогов {retries.get('dialog', 0)}; не загрузилось диалогов: {failed}")
+        lookups = {dict(labels)['result']: n for (name, labels), n in run['counters'].items() if name == 'operator_lookups_total'}
+        if lookups:
+            st.caption(f"Новые операторы по id: найдено {lookups.get('found', 0)}, нет в API {lookups.get('missing', 0)}")
+
+        frames = {}
+        for (name, labels), value in run['gauges'].items():
+            if name in ('frame_rows', 'frame_bytes'): frames.setdefault(dict(labels)['frame'], {})[name] = value
+        if frames:
+            st.dataframe(pd.DataFrame([
+                {"Таблица": frame, "Строк": v.get('frame_rows'), "МБ": round(v.get('frame_bytes', 0) / 2**20, 2)}
+                for frame, v in frames.items()
+            ]), hide_index=True, use_container_width=True)
+        peak = run['gauges'].get(('process_peak_rss_bytes', ()))
+        if peak: st.caption(f"Пиковая память процесса: {peak / 2**20:.0f} МБ")
+
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        st.download_button("JSON", json.dumps(to_json(run), ensure_ascii=False, indent=1), f"metrics_{stamp}.json",
+                           "application/json", on_click="ignore")
+        st.download_button("Prometheus", to_prometheus(run), f"metrics_{stamp}.prom", "text/plain", on_click="ignore")
+
+def transfer_crosstab(df, keys):
+    """Статусы и причины перевода по ключам (тема / продукт × юзер × тема) за один проход.
+
+    df — ячейки куба (n, first). Одна группировка keys × Статус × Причина перевода, из нее:
+    stats — строки по ключам, колонки-статусы + 'Всего' (как groupby(...).unstack);
+    details — текст "• причина: %" по переведенным, в порядке убывания частоты."""
+    grouped = df.groupby(keys + ['Статус', 'Причина перевода'], dropna=False, observed=True).agg(n=('n', 'sum'), first=('first', 'min'))
+    # При равенстве — порядок первого появления, как у value_counts
+    grouped = grouped.sort_values('first')
+    counts = grouped['n']
+
+    stats = counts.groupby(level=keys + ['Статус'], observed=True).sum().unstack(fill_value=0)
+    stats['Всего'] = stats.sum(axis=1)
+    for c in ['Закрыл', 'Перевод']:
+        if c not in stats.columns: stats[c] = 0
+
+    lines = {}
+    statuses = counts.index.get_level_values('Статус')
+    moved = counts[(statuses == 'Перевод') & counts.index.get_level_values('Причина перевода').notna()]
+    for idx, count in moved.sort_values(ascending=False, kind='stable').items():
+        key = idx[0] if len(keys) == 1 else idx[:len(keys)]
+        lines.setdefault(key, []).append((idx[-1], count))
+    details = pd.Series([
+        "\n".join(f"• {r}: {(count / row_moved * 100):.0f}%" for r, count in lines.get(key, [])) if row_moved else "—"
+        for key, row_moved in stats['Перевод'].items()
+    ], index=stats.index, dtype=object)
+    return stats, details
+
+def explode_hours(df, cols):
+    """Строки (cols..., 'Час') по битам hour_mask — для часовых разрезов"""
+    bits = (df['hour_mask'].to_numpy()[:, None] >> np.arange(24)) & 1
+    rows, hours = np.nonzero(bits)
+    out = df[cols].iloc[rows].reset_index(drop=True)
+    out['Час'] = hours
+    return out
+
+def trend_periods(end_date, count, unit):
+    """Последние count недель (с понедельника) или календарных месяцев по end_date
+    включительно: [(начало, конец)]; последний период может быть неполным"""
+    if unit == "Недели":
+        first = end_date - timedelta(days=end_date.weekday(), weeks=count - 1)
+        starts = [first + timedelta(weeks=i) for i in range(count)]
+    else:
+        first = end_date.year * 12 + end_date.month - count  # номер месяца от нулевого года
+        starts = [date(m // 12, m % 12 + 1, 1) for m in range(first, first + count)]
+    ends = [start - timedelta(days=1) for start in starts[1:]] + [end_date]
+    return list(zip(starts, ends))
+
+def group_result_detailed(df):
+    status = df['Статус'].astype(object)
+    reason = df['Причина перевода'] if 'Причина перевода' in df.columns else pd.Series('Другое', index=df.index)
+    known = reason.isin(['Требует сценарий', 'Не знает ответ', 'Лимит сообщений'])
+    return np.select(
+        [status == 'Закрыл', (status == 'Перевод') & known, status == 'Перевод'],
+        ['Бот справился', "Перевод: " + reason.astype(str), "Перевод: Прочее"],
+        default="Без статуса"
     )
-    stats['Бот_%'] = (stats['Закрыто_ботом'] / stats['Всего'] * 100)
-    return stats[['Всего', 'Бот_%']]
+
+# Функция для вытаскивания типа юзера из скобок
+def extract_user_type(topic):
+    match = re.search(r'\(([^)]+)\)[^(]*$', str(topic))
+    return match.group(1).strip() if match else 'Не определен'
+
+# --- РАСЧЕТЫ ВКЛАДОК (кэш по ключу входных данных) ---
+# Таблицы-аргументы с "_" не хэшируются: кэш ведется по key — период, версия
+# выгрузки таблицы и (для отдела) выбранный отдел. Вкладка считает заново только
+# при смене своих входных данных, а не на каждый rerun.
+@st.cache_data(max_entries=TAB_CACHE_ENTRIES, show_spinner=False)
+def load_tab_tables(_df_api, _cells, key):
+    """Вкладка "Нагрузка": (чаты по отделам, отдел × час по API, тема × час по таблице)"""
+    dept_load, hm_data, hm_topic = None, pd.DataFrame(), pd.DataFrame()
+    if not _df_api.empty:
+        dept_load = _df_api.groupby('Отдел', observed=True)['req_id'].nunique().sort_values(ascending=False).reset_index()
+        dept_load.columns = ['Отдел', 'Кол-во чатов']
+
+        hm_df = explode_hours(_df_api, ['req_id', 'Отдел'])
+        if not hm_df.empty:
+            hm_data = hm_df.groupby(['Отдел', 'Час'], observed=True)['req_id'].nunique().unstack(fill_value=0)
+            hm_data = hm_data.reindex(columns=range(24), fill_value=0)
+            hm_data['Total'] = hm_data.sum(axis=1)
+            hm_data = hm_data.sort_values('Total', ascending=False).drop(columns='Total')
+
+    # Убираем только Авторизацию, "-" уже переименован
+    topics_cells = _cells[~_cells['Тип обращения'].str.contains('Авторизация', na=False)]
+    if not topics_cells.empty:
+        top_topics = ranked_counts(topics_cells, 'Тип обращения').nlargest(15).index
+        topics_cells_top = topics_cells[topics_cells['Тип обращения'].isin(top_topics)]
+        hm_topic = topics_cells_top.groupby(['Тип обращения', 'Час'], observed=True)['n'].sum().unstack(fill_value=0)
+        hm_topic = hm_topic.reindex(columns=range(24), fill_value=0)
+        hm_topic['Total'] = hm_topic.sum(axis=1)
+        hm_topic = hm_topic.sort_values('Total', ascending=False).drop(columns='Total')
+    return dept_load, hm_data, hm_topic
+
+@st.cache_data(max_entries=TAB_CACHE_ENTRIES, show_spinner=False)
+def operator_table(_dept_data, _speeds_map, _first_speeds_map, key):
+    """Вкладка "Анализ отдела": статистика специалистов отдела"""
+    op_list = _dept_data.groupby(['operator_id', 'Оператор', 'is_tl'], observed=True).agg(chats=('req_id', 'nunique')).reset_index().sort_values('chats', ascending=False)
+
+    spec_rows = []
+    for _, row in op_list.iterrows():
+        op_id = row['operator_id']
+        s_first_med = _first_speeds_map[op_id].median() if op_id in _first_speeds_map else None
+        s_avg = _speeds_map[op_id].median() if op_id in _speeds_map else None
+        s_p90 = _speeds_map[op_id].quantile(0.9) if op_id in _speeds_map else None
+        op_ratings = pd.to_numeric(_dept_data[_dept_data['operator_id'] == op_id].drop_duplicates('req_id')['rating'], errors='coerce').dropna()
+
+        spec_rows.append({
+            "Роль": "🤖 Автоматика" if op_id == 310507 else ("⭐ Team Lead" if row['is_tl'] else "Специалист"),
+            "Специалист": f"⭐ {row['Оператор'].upper()}" if row['is_tl'] else row['Оператор'],
+            "Чаты": row['chats'],
+            "1-я скор.": format_seconds(s_first_med),
+            "Ср. скор.": format_seconds(s_avg),
+            "p90 скор.": format_seconds(s_p90),
+            "Рейтинг": f"{op_ratings.mean():.2f}" if not op_ratings.empty else "-",
+            "Оценок": len(op_ratings)
+        })
+    return pd.DataFrame(spec_rows)
+
+@st.cache_data(max_entries=TAB_CACHE_ENTRIES, show_spinner=False)
+def category_tables(_cells, key):
+    """Вкладка "Категории": (ячейки с Результатом и Типом юзера, таблица по темам,
+    таблица по продуктам или None, если продукты не размечены)"""
+    # Считаем по ячейкам куба: каждая строка — группа обращений со счетчиком n
+    df_analysis = _cells.copy()
+    df_analysis['Результат'] = group_result_detailed(df_analysis)
+    df_analysis['Тип юзера'] = df_analysis['Тип обращения'].apply(extract_user_type)
+
+    stats, details = transfer_crosstab(df_analysis, ['Тип обращения'])
+    stats['Бот(✓)'] = (stats['Закрыл'] / stats['Всего'] * 100).map('{:.1f}%'.format)
+    stats['Бот(→)'] = (stats['Перевод'] / stats['Всего'] * 100).map('{:.1f}%'.format)
+    stats['Детализация перевода'] = details
+    final_table = stats[['Всего', 'Бот(✓)', 'Бот(→)', 'Детализация перевода']].sort_values('Всего', ascending=False).reset_index()
+
+    # Только размеченные продукты; добавили Тип обращения, чтобы таблица была максимально подробной
+    df_valid_prods = df_analysis[df_analysis['Продукт'] != '-']
+    if df_valid_prods.empty: return df_analysis, final_table, None
+    prod_stats, prod_details = transfer_crosstab(df_valid_prods, ['Продукт', 'Тип юзера', 'Тип обращения'])
+    prod_stats['Бот(✓)'] = (prod_stats['Закрыл'] / prod_stats['Всего'] * 100).map('{:.1f}%'.format)
+    prod_stats['Бот(→)'] = (prod_stats['Перевод'] / prod_stats['Всего'] * 100).map('{:.1f}%'.format)
+    prod_stats['Причины перевода'] = prod_details
+    final_prod_table = prod_stats[['Всего', 'Бот(✓)', 'Бот(→)', 'Причины перевода']].sort_values(['Продукт', 'Всего'], ascending=[True, False]).reset_index()
+    return df_analysis, final_table, final_prod_table
 
 # ==========================================
 # 4. GOOGLE SHEET
 # ==========================================
-@st.cache_data(ttl=600)
-def load_gsheet_data():
+@st.cache_resource
+def get_sheet_loader():
+    return SheetLoader(SHEET_URL, SHEET_DATE_FORMAT, max_age=SHEET_REFRESH_SECONDS)
+
+def load_gsheet_data(force=False):
+    """(таблица, куб агрегатов). Раз в SHEET_REFRESH_SECONDS — условный запрос;
+    дописанные строки разбираются и добавляются в куб отдельно."""
+    loader = get_sheet_loader()
     try:
-        df = pd.read_csv(SHEET_URL)
-        df['Дата'] = pd.to_datetime(df['Дата'], dayfirst=True, errors='coerce')
-        df = df.dropna(subset=['Дата'])
-        
-        # ДОБАВЛЕНО: Убеждаемся, что колонка Продукт существует (защита от ошибок)
-        if 'Продукт' not in df.columns:
-            df['Продукт'] = '-'
-
-        # ДОБАВЛЕНО: Чистим колонку Продукт вместе с остальными
-        for col in ['Отдел', 'Статус', 'Тип обращения', 'Продукт']:
-            if col in df.columns: 
-                df[col] = df[col].astype(str).str.strip().replace(['nan', ''], '-')
-        
-        def fix_topic(row):
-            topic = row['Тип обращения']
-            dept = row['Отдел']
-            if topic == '-' or topic == '' or topic == 'nan':
-                return f"Прямая маршрутизация {dept}"
-            return topic
-
-        df['Тип обращения'] = df.apply(fix_topic, axis=1)
-        
-        df['Час'] = df['Дата'].dt.hour
-        return df
+        return loader.load(force)
     except Exception as e:
-        st.error(f"Ошибка загрузки Google Sheet: {e}"); return pd.DataFrame()
+        if loader.df is not None:
+            st.warning(f"⚠️ Google Sheet не обновился, показана прошлая версия: {e}"); return loader.df, loader.cube
+        st.error(f"Ошибка загрузки Google Sheet: {e}"); return pd.DataFrame(), SheetCube.from_frame(pd.DataFrame())
 
 # ==========================================
 # 5. ИНТЕРФЕЙС
 # ==========================================
 st.sidebar.title("Фильтры")
 
+# Снимок метрик в начале прогона: панель показывает разность с концом прогона
+run_started = time.perf_counter()
+run_snapshot = get_pipeline().metrics.snapshot()
+
+# Фоновое обновление ходовых периодов стартует с первой сессией процесса
+prefetcher = get_prefetcher()
+
 # 1. Загружаем все данные из GSheet
-df_gsheet_all = load_gsheet_data()
+with get_pipeline().metrics.timer('stage_seconds', stage='sheet_load'):
+    df_gsheet_all, sheet_cube = load_gsheet_data()
 
 # --- БЛОК БЕЗОПАСНЫХ ДАТ (Чтобы не было StreamlitAPIException) ---
 today = datetime.now().date()
 
 if not df_gsheet_all.empty:
-    sheet_min = df_gsheet_all['Дата'].min().date()
-    sheet_max = df_gsheet_all['Дата'].max().date()
+    # Таблица отсортирована по дате
+    sheet_min = df_gsheet_all['Дата'].iloc[0].date()
+    sheet_max = df_gsheet_all['Дата'].iloc[-1].date()
 else:
     sheet_min = today
     sheet_max = today
@@ -393,10 +469,20 @@ else:
 
 st.sidebar.caption(f"Выбрано: {sel_start} — {sel_end}")
 
-# Кнопка запуска
+# Открытые дни (сегодня) по умолчанию обновляются инкрементально
+full_reload = st.sidebar.checkbox("Полная перезагрузка открытых дней", value=False,
+                                  help="По кнопке анализа заново скачать все диалоги за незакрытые дни, а не только изменившиеся")
+
+# Кнопка запуска. Повторное нажатие обновляет открытые дни выбранного и прошлого
+# периода (только их — кэши других диапазонов и сессий не трогаем)
 if st.sidebar.button("Запустить анализ (API)"):
+    refresh_api = 'run_analysis' in st.session_state
     st.session_state['run_analysis'] = True
-    st.cache_data.clear()
+else:
+    refresh_api = False
+
+if prefetcher and prefetcher.last_run:
+    st.sidebar.caption(f"Фоновое обновление: {prefetcher.last_run.strftime('%H:%M')}")
 
 # Если анализ еще не запускали — стопаем выполнение дальше
 if 'run_analysis' not in st.session_state:
@@ -406,18 +492,48 @@ if 'run_analysis' not in st.session_state:
 # --- ТУТ НАЧИНАЕТСЯ ТВОЯ ЛОГИКА ГРАФИКОВ И KPI ---
 
 # ЗАГРУЗКА ДАННЫХ ЧЕРЕЗ API
-df_api, speeds_map, first_speeds_map = load_api_data_range(sel_start, sel_end)
+# Кнопка "Повторить только сбойные" (ниже, после покрытия) ставит флаг на следующий прогон
+retry_failed = st.session_state.pop('retry_failed', False)
+df_api, speeds_map, first_speeds_map, api_version = load_api_data_range(sel_start, sel_end, refresh_api, full_reload, retry_failed, preview=True)
+
+today_local = (datetime.now(timezone.utc) + timedelta(hours=TIME_OFFSET)).date()
+if sel_start <= today_local <= sel_end:
+    watermark = get_pipeline().store.watermark(today_local)
+    if watermark:
+        wm_local = pd.to_datetime(watermark, unit='s') + timedelta(hours=TIME_OFFSET)
+        st.sidebar.caption(f"Сегодня: учтены сообщения до {wm_local.strftime('%H:%M')}")
 
 # --- ДОБАВЛЕНО: Грузим прошлый период для динамики в отчетах ---
 period_days = (sel_end - sel_start).days + 1
 prev_end = sel_start - timedelta(days=1)
 prev_start = prev_end - timedelta(days=period_days - 1)
-df_api_prev, speeds_map_prev, first_speeds_map_prev = load_api_data_range(prev_start, prev_end)
+df_api_prev, speeds_map_prev, first_speeds_map_prev, api_version_prev = load_api_data_range(prev_start, prev_end, refresh_api, full_reload, retry_failed)
 # -----------------------------------------------------------------
 
-# Фильтруем данные из таблицы под выбранные даты
-mask_gsheet = (df_gsheet_all['Дата'].dt.date >= sel_start) & (df_gsheet_all['Дата'].dt.date <= sel_end)
-df_gsheet = df_gsheet_all[mask_gsheet].copy()
+# Покрытие выбранного периода: сколько диалогов удалось загрузить (прошлый период — только в списке дней с ошибками)
+coverage = get_pipeline().coverage([d.date() for d in pd.date_range(prev_start, sel_end)])
+sel_coverage = get_pipeline().coverage([d.date() for d in pd.date_range(sel_start, sel_end)])
+if sel_coverage['listed']:
+    loaded = sel_coverage['listed'] - sel_coverage['failed']
+    st.sidebar.caption(f"Покрытие API: {loaded / sel_coverage['listed']:.1%} ({loaded} из {sel_coverage['listed']} диалогов)")
+if coverage['incomplete_days']:
+    st.warning(
+        f"⚠️ Данные API неполные (ошибки запросов): не загружено диалогов — {coverage['failed']}, "
+        "дни с неполным списком чатов или ошибками: " + ", ".join(d.strftime('%d.%m') for d in coverage['incomplete_days'])
+    )
+    st.sidebar.button("🔁 Повторить только сбойные", on_click=lambda: st.session_state.update(retry_failed=True),
+                      help="Перезапросить только диалоги и страницы, которые не загрузились; остальное берется из хранилища")
+
+# Фильтруем данные из таблицы под выбранные даты: сырые строки — только для вкладки "База данных",
+# все остальные разрезы считаются по ячейкам куба
+df_gsheet = day_range(df_gsheet_all, sel_start, sel_end, 'Дата') if not df_gsheet_all.empty else df_gsheet_all
+sheet_cells = sheet_cube.slice(sel_start, sel_end)
+
+# Ключ входных данных для кэша расчетов вкладок
+data_key = (sel_start, sel_end, api_version, api_version_prev, get_sheet_loader().version)
+
+if ADMIN_PANEL:
+    record_frame_sizes(get_pipeline().metrics, df_api=df_api, df_api_prev=df_api_prev, sheet=df_gsheet_all, sheet_cells=sheet_cells)
 
 # Расчет метрик KPI
 if not df_api.empty: 
@@ -425,48 +541,33 @@ if not df_api.empty:
 else: 
     count_human_chats = 0
 
-bot_closed_mask = (df_gsheet['Статус'].str.lower() == 'закрыл')
-count_bot_closed = len(df_gsheet[bot_closed_mask])
-
-auth_mask = (df_gsheet['Тип обращения'].str.contains('Авторизация пройдена', case=False, na=False))
-count_auth = len(df_gsheet[auth_mask])
-
-total_chats_day = count_human_chats + count_bot_closed + count_auth
-
 # --- ВЫВОД ТАБОВ ---
-tabs = st.tabs(["KPI", "Нагрузка", "Анализ отдела", "Категории", "📈 Динамика", "База данных"])
-
-# Дальше идут твои блоки with tabs[0], with tabs[1] и т.д.
-# (Они остаются без изменений, как в твоем исходном коде)
+# Ленивые вкладки: выполняется только открытая (смена вкладки — rerun).
+# Каждая вкладка — фрагмент: ее виджеты (отдел, даты динамики) перезапускают
+# только ее, а не весь дашборд.
+tabs = st.tabs(["KPI", "Нагрузка", "Анализ отдела", "Категории", "📈 Динамика", "База данных"],
+               key="main_tabs", on_change="rerun")
 
 # TAB 1: KPI
-with tabs[0]:
+@st.fragment
+@timed_tab("KPI")
+def kpi_tab():
     st.subheader("Сводная статистика")
     
     # --- 1. РАСЧЕТ МЕТРИК ---
     # Автоматика (общая)
-    mask_bot_closed = (df_gsheet['Статус'] == 'Закрыл')
-    mask_auth_success = df_gsheet['Тип обращения'].str.contains('Авторизация пройдена', case=False, na=False)
-    mask_stub = (df_gsheet['Тип обращения'] == 'Заглушка на старый чат')
+    mask_bot_closed = (sheet_cells['Статус'] == 'Закрыл')
+    mask_auth_success = sheet_cells['Тип обращения'].str.contains('Авторизация пройдена', case=False, na=False)
+    mask_stub = (sheet_cells['Тип обращения'] == 'Заглушка на старый чат')
     
-    count_bot_closed = len(df_gsheet[mask_bot_closed])
-    count_auth_success = len(df_gsheet[mask_auth_success])
-    count_stub = len(df_gsheet[mask_stub])
+    count_bot_closed = total_rows(sheet_cells, mask_bot_closed)
+    count_auth_success = total_rows(sheet_cells, mask_auth_success)
+    count_stub = total_rows(sheet_cells, mask_stub)
     
     total_automation = count_bot_closed + count_auth_success + count_stub
 
-    # Участие человека (для фильтрации, если нужно в других табах)
-    mask_confirm = df_gsheet['Статус'].isin(['Ручник: Позовите человека', 'Ручник: Обзвон и отмены'])
-    mask_courier = (df_gsheet['Статус'] == 'Меню курьеров')
-    mask_auth_fail = df_gsheet['Тип обращения'].str.startswith('Авторизация не пройдена', na=False)
-    
-    count_confirm = len(df_gsheet[mask_confirm])
-    count_courier = len(df_gsheet[mask_courier])
-    count_auth_fail = len(df_gsheet[mask_auth_fail])
-
     # Бот (участие и эффективность)
-    bot_participated_df = df_gsheet[df_gsheet['Статус'].isin(['Закрыл', 'Перевод'])]
-    participated_count = len(bot_participated_df)
+    participated_count = total_rows(sheet_cells, sheet_cells['Статус'].isin(['Закрыл', 'Перевод']))
     transferred_count = participated_count - count_bot_closed
     
     # Расчет общего итога
@@ -494,23 +595,23 @@ with tabs[0]:
             sizes = [count_bot_closed, transferred_count, pure_human_chats, count_stub, count_auth_success]
             colors = ['#ff9999', '#ffcc99', '#66b3ff', '#d3d3d3', '#99ff99'] 
             
-            fig1, ax1 = plt.subplots(figsize=(5, 5))
-            ax1.pie(
-                sizes, 
-                labels=labels, 
-                autopct='%1.1f%%', 
-                colors=colors, 
-                startangle=90,
-                pctdistance=0.85,
-                explode=[0.05 if i == 0 else 0 for i in range(len(labels))]
-            )
-            
-            # Donut-эффект
-            centre_circle = plt.Circle((0,0), 0.70, fc='white')
-            fig1.gca().add_artist(centre_circle)
-            
-            plt.tight_layout()
-            st.pyplot(fig1, use_container_width=False)
+            def draw_load_pie(fig1):
+                ax1 = fig1.subplots()
+                ax1.pie(
+                    sizes, 
+                    labels=labels, 
+                    autopct='%1.1f%%', 
+                    colors=colors, 
+                    startangle=90,
+                    pctdistance=0.85,
+                    explode=[0.05 if i == 0 else 0 for i in range(len(labels))]
+                )
+                
+                # Donut-эффект
+                ax1.add_artist(Circle((0,0), 0.70, fc='white'))
+                fig1.tight_layout()
+
+            st.image(get_chart_cache().render(('load_pie', sizes, labels, colors), draw_load_pie, figsize=(5, 5)), width='stretch')
             # ТЕКСТОВЫЕ ИНФО-ПАНЕЛИ УДАЛЕНЫ
 
     with col_pies[1]:
@@ -521,66 +622,63 @@ with tabs[0]:
         
         if participated_count > 0:
             st.caption(f"Из {participated_count} диалогов, где был бот:")
-            fig2, ax2 = plt.subplots(figsize=(4, 4))
-            ax2.pie([count_bot_closed, transferred_count], 
-                    labels=['Справился', 'Перевел'], 
-                    autopct='%1.1f%%', colors=['#ff9999', '#ffcc99'], startangle=90)
-            
-            centre_circle2 = plt.Circle((0,0), 0.70, fc='white')
-            fig2.gca().add_artist(centre_circle2)
-            
-            st.pyplot(fig2, use_container_width=False)
+            def draw_bot_pie(fig2):
+                ax2 = fig2.subplots()
+                ax2.pie([count_bot_closed, transferred_count], 
+                        labels=['Справился', 'Перевел'], 
+                        autopct='%1.1f%%', colors=['#ff9999', '#ffcc99'], startangle=90)
+                ax2.add_artist(Circle((0,0), 0.70, fc='white'))
+
+            st.image(get_chart_cache().render(('bot_pie', count_bot_closed, transferred_count), draw_bot_pie, figsize=(4, 4)), width='stretch')
             # ТЕКСТОВЫЙ БЛОК "РУЧНОЕ УЧАСТИЕ" УДАЛЕН
         else:
             st.write("Бот не участвовал в диалогах за выбранный период.")
 
+with tabs[0]:
+    if tabs[0].open: kpi_tab()
+
 # TAB 2: LOAD
-with tabs[1]:
+@st.fragment
+@timed_tab("Нагрузка")
+def load_tab():
     st.subheader("Нагрузка по отделам (Данные скрипта)")
-    if not df_api.empty:
-        dept_load = df_api.groupby('Отдел')['req_id'].nunique().sort_values(ascending=False).reset_index()
-        dept_load.columns = ['Отдел', 'Кол-во чатов']
+    dept_load, hm_data, hm_topic = load_tab_tables(df_api, sheet_cells, data_key)
+    if dept_load is not None:
         c_table, c_heat = st.columns([1, 2])
         with c_table: st.dataframe(dept_load, hide_index=True, use_container_width=True)
         with c_heat:
             st.write("**Тепловая карта: Отдел vs Час (Данные API)**")
-            
-            hm_df = df_api[df_api['Час'].between(0, 23)]
-            
-            if not hm_df.empty:
-                hm_data = hm_df.groupby(['Отдел', 'Час'])['req_id'].nunique().unstack(fill_value=0)
-                hm_data = hm_data.reindex(columns=range(24), fill_value=0)
-                hm_data['Total'] = hm_data.sum(axis=1)
-                hm_data = hm_data.sort_values('Total', ascending=False).drop(columns='Total')
-
-                fig_hm, ax_hm = plt.subplots(figsize=(10, len(hm_data)*0.5+2))
-                sns.heatmap(hm_data, annot=True, fmt="d", cmap="YlOrRd", cbar=False, ax=ax_hm)
-                ax_hm.set_xlabel("Час дня")
-                st.pyplot(fig_hm)
+
+            if not hm_data.empty:
+                def draw_dept_heatmap(fig_hm):
+                    ax_hm = fig_hm.subplots()
+                    sns.heatmap(hm_data, annot=True, fmt="d", cmap="YlOrRd", cbar=False, ax=ax_hm)
+                    ax_hm.set_xlabel("Час дня")
+
+                png = get_chart_cache().render(('dept_heatmap', hm_data), draw_dept_heatmap, figsize=(10, len(hm_data)*0.5+2))
+                st.image(png, width='stretch')
             else:
                 st.warning("Нет данных по часам в API.")
 
     st.divider()
     st.subheader("Тематика обращений по времени")
-    # Убираем только Авторизацию, "-" уже переименован
-    topics_df = df_gsheet[~df_gsheet['Тип обращения'].str.contains('Авторизация', na=False)].copy()
-    
-    if not topics_df.empty:
-        top_topics = topics_df['Тип обращения'].value_counts().nlargest(15).index
-        topics_df_top = topics_df[topics_df['Тип обращения'].isin(top_topics)]
-        hm_topic = topics_df_top.groupby(['Тип обращения', 'Час']).size().unstack(fill_value=0)
-        hm_topic = hm_topic.reindex(columns=range(24), fill_value=0)
-        hm_topic['Total'] = hm_topic.sum(axis=1)
-        hm_topic = hm_topic.sort_values('Total', ascending=False).drop(columns='Total')
-        
-        fig2, ax2 = plt.subplots(figsize=(12, len(hm_topic)*0.6+2))
-        sns.heatmap(hm_topic, annot=True, fmt="d", cmap="Blues", cbar=False, ax=ax2)
-        st.pyplot(fig2)
+
+    if not hm_topic.empty:
+        def draw_topic_heatmap(fig2):
+            sns.heatmap(hm_topic, annot=True, fmt="d", cmap="Blues", cbar=False, ax=fig2.subplots())
+
+        png = get_chart_cache().render(('topic_heatmap', hm_topic), draw_topic_heatmap, figsize=(12, len(hm_topic)*0.6+2))
+        st.image(png, width='stretch')
+
+with tabs[1]:
+    if tabs[1].open: load_tab()
 
 # ==========================================
 # TAB 3: DEPT ANALYSIS (С ИСПРАВЛЕННЫМ CSAT БОТА)
 # ==========================================
-with tabs[2]:
+@st.fragment
+@timed_tab("Анализ отдела")
+def dept_tab():
     st.subheader("Детальный анализ по отделу")
     if not df_api.empty:
         all_depts = sorted(df_api['Отдел'].unique())
@@ -597,74 +695,32 @@ with tabs[2]:
             else:
                 dept_data_prev, sm_prev, fsm_prev = pd.DataFrame(), {}, {}
             
-            # Логика Тимлидов
-            TL_ROOTS = ["черныш", "гетман", "власенков"]
-            dept_data['is_tl'] = dept_data['Оператор'].apply(
-                lambda x: any(normalize_text(tl) in normalize_text(x) for tl in TL_ROOTS)
-            )
-            if not dept_data_prev.empty:
-                dept_data_prev['is_tl'] = dept_data_prev['Оператор'].apply(
-                    lambda x: any(normalize_text(tl) in normalize_text(x) for tl in TL_ROOTS)
-                )
-
             # --- ГЕНЕРАЦИЯ БАЗОВОГО ОТЧЕТА ПО API ---
-            def calc_metrics_for_report(df, sm, fsm, dept_name):
-                if df.empty and dept_name != "Бот AI": return None
-                chats = df['req_id'].nunique() if not df.empty else 0
-                ratings = pd.to_numeric(df.drop_duplicates('req_id')['rating'], errors='coerce').dropna() if not df.empty else pd.Series(dtype=float)
-                
-                d_speeds, d_first = [], []
-                if not df.empty:
-                    for o_id in df['operator_id'].unique():
-                        if o_id in sm: d_speeds.extend(sm[o_id])
-                        if o_id in fsm: d_first.extend(fsm[o_id])
-                    
-                avg_s = np.median(d_speeds) if d_speeds else 0
-                avg_fs = np.median(d_first) if d_first else 0
-                
-                daily_c = df.groupby('Дата')['req_id'].nunique() if not df.empty else pd.Series(dtype=float)
-                if dept_name == "Бот AI":
-                    daily_o = pd.Series(1, index=daily_c.index) if not daily_c.empty else pd.Series(dtype=float)
-                else:
-                    daily_o = df[~df['is_tl']].groupby('Дата')['operator_id'].nunique() if not df.empty else pd.Series(dtype=float)
-                    
-                daily_stats = pd.DataFrame({'c': daily_c, 'o': daily_o}).fillna(0)
-                avg_specs = daily_stats['o'].mean() if not daily_stats.empty else 0
-                daily_stats['load'] = daily_stats.apply(lambda r: r['c']/r['o'] if r['o']>0 else r['c'], axis=1)
-                avg_load = daily_stats['load'].mean() if not daily_stats.empty else 0
-                
-                return {
-                    'chats': chats, 'ratings': len(ratings), 'csat': ratings.mean() if len(ratings)>0 else 0,
-                    'specs': round(avg_specs) if dept_name != "Бот AI" else 1, 
-                    'load': round(avg_load),
-                    'speed': avg_s, 'first_speed': avg_fs
-                }
-
-            curr_m = calc_metrics_for_report(dept_data, speeds_map, first_speeds_map, selected_dept)
-            prev_m = calc_metrics_for_report(dept_data_prev, sm_prev, fsm_prev, selected_dept)
+            is_bot = selected_dept == "Бот AI"
+            curr_m = department_metrics(dept_data, speeds_map, first_speeds_map, is_bot)
+            prev_m = department_metrics(dept_data_prev, sm_prev, fsm_prev, is_bot)
 
             # --- ИЗОЛИРОВАННАЯ ЛОГИКА ДЛЯ БОТА (ЧЕСТНЫЙ CSAT) ---
             if selected_dept == "Бот AI":
                 # Отфильтровываем участия бота из таблицы (Закрыл + Перевел)
-                dept_gsheet = df_gsheet[df_gsheet['Статус'].isin(['Закрыл', 'Перевод'])].copy()
-                d_chats_api = len(dept_gsheet) 
+                dept_cells = sheet_cells[sheet_cells['Статус'].isin(['Закрыл', 'Перевод'])]
+                d_chats_api = total_rows(dept_cells)
                 
                 # То же самое для прошлого периода (для динамики)
-                mask_gsheet_prev = (df_gsheet_all['Дата'].dt.date >= prev_start) & (df_gsheet_all['Дата'].dt.date <= prev_end)
-                df_gsheet_prev = df_gsheet_all[mask_gsheet_prev]
-                dept_gsheet_prev = df_gsheet_prev[df_gsheet_prev['Статус'].isin(['Закрыл', 'Перевод'])].copy()
+                cells_prev = sheet_cube.slice(prev_start, prev_end)
+                dept_cells_prev = cells_prev[cells_prev['Статус'].isin(['Закрыл', 'Перевод'])]
                 
                 # ---> ФИЛЬТРУЕМ CSAT: БЕРЕМ ОЦЕНКИ ТОЛЬКО ТАМ, ГДЕ БОТ "ЗАКРЫЛ" <---
-                if 'ID обращения' in df_gsheet.columns:
-                    # Чистим ID от возможных нулей на конце (если pandas прочитал их как float)
-                    closed_ids_curr = dept_gsheet[dept_gsheet['Статус'] == 'Закрыл']['ID обращения'].astype(str).str.replace(r'\.0$', '', regex=True).tolist()
+                # ID закрытых ботом обращений хранятся в кубе уже очищенными от хвоста '.0'
+                closed_ids_curr = sheet_cube.closed_ids(sel_start, sel_end)
+                closed_ids_prev = sheet_cube.closed_ids(prev_start, prev_end)
+                if closed_ids_curr is not None:
                     bot_ratings_curr = dept_data[dept_data['req_id'].astype(str).str.replace(r'\.0$', '', regex=True).isin(closed_ids_curr)].drop_duplicates('req_id')['rating']
                     bot_ratings_curr = pd.to_numeric(bot_ratings_curr, errors='coerce').dropna()
                 else:
                     bot_ratings_curr = pd.Series(dtype=float)
                     
-                if 'ID обращения' in df_gsheet_prev.columns:
-                    closed_ids_prev = dept_gsheet_prev[dept_gsheet_prev['Статус'] == 'Закрыл']['ID обращения'].astype(str).str.replace(r'\.0$', '', regex=True).tolist()
+                if closed_ids_prev is not None:
                     bot_ratings_prev = dept_data_prev[dept_data_prev['req_id'].astype(str).str.replace(r'\.0$', '', regex=True).isin(closed_ids_prev)].drop_duplicates('req_id')['rating']
                     bot_ratings_prev = pd.to_numeric(bot_ratings_prev, errors='coerce').dropna()
                 else:
@@ -672,23 +728,23 @@ with tabs[2]:
 
                 # Подменяем объемы и честный CSAT в текущем отчете
                 if curr_m:
-                    curr_m['chats'] = len(dept_gsheet)
-                    daily_c = dept_gsheet.groupby(dept_gsheet['Дата'].dt.date).size()
+                    curr_m['chats'] = total_rows(dept_cells)
+                    daily_c = dept_cells.groupby('День')['n'].sum()
                     curr_m['load'] = round(daily_c.mean()) if not daily_c.empty else 0
                     curr_m['ratings'] = len(bot_ratings_curr)
                     curr_m['csat'] = bot_ratings_curr.mean() if len(bot_ratings_curr) > 0 else 0
                     
                 # Подменяем объемы и честный CSAT в прошлом отчете
                 if prev_m:
-                    prev_m['chats'] = len(dept_gsheet_prev)
-                    daily_c_p = dept_gsheet_prev.groupby(dept_gsheet_prev['Дата'].dt.date).size()
+                    prev_m['chats'] = total_rows(dept_cells_prev)
+                    daily_c_p = dept_cells_prev.groupby('День')['n'].sum()
                     prev_m['load'] = round(daily_c_p.mean()) if not daily_c_p.empty else 0
                     prev_m['ratings'] = len(bot_ratings_prev)
                     prev_m['csat'] = bot_ratings_prev.mean() if len(bot_ratings_prev) > 0 else 0
             else:
                 # Если это живые люди (SMM и т.д.), работаем по классике
                 d_chats_api = dept_data['req_id'].nunique()
-                dept_gsheet = df_gsheet[df_gsheet['Отдел'] == selected_dept].copy()
+                dept_cells = sheet_cells[sheet_cells['Отдел'] == selected_dept]
 
             # --- ВЫВОД МИКРО-ОТЧЕТА ---
             if curr_m:
@@ -708,7 +764,8 @@ with tabs[2]:
 Среднее кол-во чатов на специалиста: {curr_m['load']}{fmt_trend(curr_m['load'], prev_m['load'] if prev_m else 0)}  
 Средний CSAT: {curr_m['csat']:.2f}{fmt_trend(curr_m['csat'], prev_m['csat'] if prev_m else 0, is_float=True)}  
 Средняя 1-я скорость: {format_seconds(curr_m['first_speed'])}{fmt_trend(curr_m['first_speed'], prev_m['first_speed'] if prev_m else 0, is_time=True)}  
-Средняя скорость: {format_seconds(curr_m['speed'])}{fmt_trend(curr_m['speed'], prev_m['speed'] if prev_m else 0, is_time=True)}"""
+Средняя скорость: {format_seconds(curr_m['speed'])}{fmt_trend(curr_m['speed'], prev_m['speed'] if prev_m else 0, is_time=True)}  
+90% ответов быстрее: {format_seconds(curr_m['speed_p90'])}{fmt_trend(curr_m['speed_p90'], prev_m['speed_p90'] if prev_m else 0, is_time=True)}"""
 
                 st.info(report_text)
 
@@ -716,8 +773,8 @@ with tabs[2]:
             if selected_dept == "Бот AI":
                 st.divider()
                 st.write("#### 🤖 Конверсия бота")
-                b_participated = len(dept_gsheet)
-                b_closed = len(dept_gsheet[dept_gsheet['Статус'] == 'Закрыл'])
+                b_participated = total_rows(dept_cells)
+                b_closed = total_rows(dept_cells, dept_cells['Статус'] == 'Закрыл')
                 b_transferred = b_participated - b_closed
                 
                 cb1, cb2, cb3 = st.columns(3)
@@ -728,11 +785,11 @@ with tabs[2]:
 
             # --- ПОСУТОЧНАЯ НАГРУЗКА ---
             if selected_dept == "Бот AI":
-                daily_chats = dept_gsheet.groupby(dept_gsheet['Дата'].dt.date).size()
+                daily_chats = dept_cells.groupby(dept_cells['День'].dt.date)['n'].sum().rename_axis('Дата')
                 daily_ops = pd.Series(1, index=daily_chats.index)
             elif 'Дата' in dept_data.columns:
-                daily_chats = dept_data.groupby('Дата')['req_id'].nunique()
-                daily_ops = dept_data[~dept_data['is_tl']].groupby('Дата')['operator_id'].nunique()
+                daily_chats = dept_data.groupby('Дата', observed=True)['req_id'].nunique()
+                daily_ops = dept_data[~dept_data['is_tl']].groupby('Дата', observed=True)['operator_id'].nunique()
             else:
                 daily_chats, daily_ops = pd.Series(dtype=float), pd.Series(dtype=float)
                 
@@ -750,27 +807,9 @@ with tabs[2]:
             # --- СТАТИСТИКА СПЕЦИАЛИСТОВ (СКРЫВАЕМ ДЛЯ БОТА) ---
             if selected_dept != "Бот AI":
                 st.write("#### Статистика специалистов")
-                op_list = dept_data.groupby(['operator_id', 'Оператор', 'is_tl']).agg(chats=('req_id', 'nunique')).reset_index().sort_values('chats', ascending=False)
-                
-                spec_rows = []
-                for _, row in op_list.iterrows():
-                    op_id = row['operator_id']
-                    s_first_med = np.median(first_speeds_map.get(op_id, [])) if first_speeds_map.get(op_id) else None
-                    s_avg = np.median(speeds_map.get(op_id, [])) if speeds_map.get(op_id) else None
-                    op_ratings = pd.to_numeric(dept_data[dept_data['operator_id'] == op_id]['rating'], errors='coerce').dropna()
-                    
-                    spec_rows.append({
-                        "Роль": "🤖 Автоматика" if op_id == 310507 else ("⭐ Team Lead" if row['is_tl'] else "Специалист"),
-                        "Специалист": f"⭐ {row['Оператор'].upper()}" if row['is_tl'] else row['Оператор'],
-                        "Чаты": row['chats'],
-                        "1-я скор.": format_seconds(s_first_med),
-                        "Ср. скор.": format_seconds(s_avg),
-                        "Рейтинг": f"{op_ratings.mean():.2f}" if not op_ratings.empty else "-",
-                        "Оценок": len(op_ratings)
-                    })
-                
+                spec_table = operator_table(dept_data, speeds_map, first_speeds_map, (data_key, selected_dept))
                 st.dataframe(
-                    pd.DataFrame(spec_rows).style.apply(lambda r: ['background-color: #e3f2fd; font-weight: bold']*len(r) if "Team Lead" in r['Роль'] else ['']*len(r), axis=1),
+                    spec_table.style.apply(lambda r: ['background-color: #e3f2fd; font-weight: bold']*len(r) if "Team Lead" in r['Роль'] else ['']*len(r), axis=1),
                     use_container_width=True, hide_index=True
                 )
                 st.divider()
@@ -786,12 +825,13 @@ with tabs[2]:
                     return f"{st_val} ({tp_val})"
                 return tp_val
 
-            if not dept_gsheet.empty:
-                dept_gsheet['Категория_Финальная'] = dept_gsheet.apply(get_universal_label, axis=1)
-                cat_counts = dept_gsheet['Категория_Финальная'].value_counts().reset_index()
+            if not dept_cells.empty:
+                # Подпись считается по ячейкам (статус × тема), а не по каждой строке таблицы
+                labeled = dept_cells.assign(**{'Категория_Финальная': dept_cells.apply(get_universal_label, axis=1)})
+                cat_counts = ranked_counts(labeled, 'Категория_Финальная').reset_index()
                 cat_counts.columns = ['Категория', 'Кол-во']
                 
-                total_sheet_found = len(dept_gsheet)
+                total_sheet_found = total_rows(dept_cells)
                 
                 # Для бота разница не считается (все данные и так из таблицы)
                 if selected_dept == "Бот AI":
@@ -809,167 +849,191 @@ with tabs[2]:
                 st.dataframe(cat_counts, use_container_width=True, hide_index=True)
             else:
                 st.warning(f"В таблице GSheet нет данных для {selected_dept}. Разница: {d_chats_api}")
+
+with tabs[2]:
+    if tabs[2].open: dept_tab()
+
 # ==========================================
 # TAB 4: КАТЕГОРИИ (ДЕТАЛЬНАЯ АНАЛИТИКА)
 # ==========================================
-with tabs[3]:
+@st.fragment
+@timed_tab("Категории")
+def categories_tab():
     st.subheader("📊 Анализ типов обращений")
-    
-    # 3 вкладки, включая новую под продукты
-    sub_tab1, sub_tab2, sub_tab3 = st.tabs(["📋 Полная детализация", "📈 Интерактивный ТОП-15", "📦 Отчет по продуктам"])
 
-    if not df_gsheet.empty:
-        import re 
-        
+    # 3 вкладки, включая новую под продукты (тоже ленивые: считается только открытая)
+    sub_tab1, sub_tab2, sub_tab3 = st.tabs(["📋 Полная детализация", "📈 Интерактивный ТОП-15", "📦 Отчет по продуктам"],
+                                           key="categories_tabs", on_change="rerun")
+
+    if not sheet_cells.empty:
         # --- 1. ПОДГОТОВКА ДАННЫХ ---
-        def group_result_detailed(row):
-            if row['Статус'] == 'Закрыл': return 'Бот справился'
-            elif row['Статус'] == 'Перевод':
-                reason = str(row.get('Причина перевода', 'Другое'))
-                if reason in ['Требует сценарий', 'Не знает ответ', 'Лимит сообщений']: return f"Перевод: {reason}"
-                return "Перевод: Прочее"
-            return "Без статуса"
-
-        # Функция для вытаскивания типа юзера из скобок
-        def extract_user_type(topic):
-            match = re.search(r'\(([^)]+)\)[^(]*$', str(topic))
-            return match.group(1).strip() if match else 'Не определен'
-
-        df_analysis = df_gsheet.copy()
-        df_analysis['Результат'] = df_analysis.apply(group_result_detailed, axis=1)
-        df_analysis['Тип юзера'] = df_analysis['Тип обращения'].apply(extract_user_type)
+        df_analysis, final_table, final_prod_table = category_tables(sheet_cells, data_key)
 
         # --- SUB-TAB 1: ПОЛНАЯ ТАБЛИЦА ---
         with sub_tab1:
-            st.write("#### Полная статистика по всем категориям")
-            stats = df_analysis.groupby(['Тип обращения', 'Статус']).size().unstack(fill_value=0)
-            stats['Всего'] = stats.sum(axis=1)
-            for c in ['Закрыл', 'Перевод']: 
-                if c not in stats.columns: stats[c] = 0
-                
-            stats['Бот(✓)'] = (stats['Закрыл'] / stats['Всего'] * 100).map('{:.1f}%'.format)
-            stats['Бот(→)'] = (stats['Перевод'] / stats['Всего'] * 100).map('{:.1f}%'.format)
-
-            def get_cat_details(row):
-                transferred = row.get('Перевод', 0)
-                if transferred == 0: return "—"
-                cat_reasons = df_analysis[(df_analysis['Тип обращения'] == row.name) & (df_analysis['Статус'] == 'Перевод')]
-                r_counts = cat_reasons['Причина перевода'].value_counts()
-                return "\n".join([f"• {r}: {(count/transferred*100):.0f}%" for r, count in r_counts.items() if count > 0])
-
-            stats['Детализация перевода'] = stats.apply(get_cat_details, axis=1)
-            final_table = stats[['Всего', 'Бот(✓)', 'Бот(→)', 'Детализация перевода']].sort_values('Всего', ascending=False).reset_index()
-            st.dataframe(final_table, use_container_width=True, hide_index=True)
+            if sub_tab1.open:
+                st.write("#### Полная статистика по всем категориям")
+                st.dataframe(final_table, use_container_width=True, hide_index=True)
 
         # --- SUB-TAB 2: ГРАФИК ТОП-15 ---
         with sub_tab2:
-            st.write("#### Топ-15 обращений в разрезе эффективности")
-            top_names = df_gsheet['Тип обращения'].value_counts().nlargest(15).index
-            df_plot = df_analysis[df_analysis['Тип обращения'].isin(top_names)]
-            plot_data = df_plot.groupby(['Тип обращения', 'Результат']).size().reset_index(name='Количество')
-            
-            color_map = {
-                'Бот справился': '#26A69A', 'Перевод: Не знает ответ': '#FF5252',
-                'Перевод: Требует сценарий': '#FFAB40', 'Перевод: Лимит сообщений': '#7C4DFF',
-                'Перевод: Прочее': '#90A4AE', 'Без статуса': '#CFD8DC'
-            }
-            fig = px.bar(plot_data, x="Количество", y="Тип обращения", color="Результат", orientation='h',
-                         color_discrete_map=color_map, text_auto=True, category_orders={"Тип обращения": top_names.tolist()})
-            fig.update_layout(barmode='stack', height=700, legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1), hovermode="y unified")
-            fig.update_yaxes(title="")
-            fig.update_xaxes(title="Количество диалогов")
-            st.plotly_chart(fig, use_container_width=True)
+            if sub_tab2.open:
+                st.write("#### Топ-15 обращений в разрезе эффективности")
+                top_names = ranked_counts(df_analysis, 'Тип обращения').nlargest(15).index
+                df_plot = df_analysis[df_analysis['Тип обращения'].isin(top_names)]
+                plot_data = df_plot.groupby(['Тип обращения', 'Результат'], observed=True)['n'].sum().reset_index(name='Количество')
             
+                color_map = {
+                    'Бот справился': '#26A69A', 'Перевод: Не знает ответ': '#FF5252',
+                    'Перевод: Требует сценарий': '#FFAB40', 'Перевод: Лимит сообщений': '#7C4DFF',
+                    'Перевод: Прочее': '#90A4AE', 'Без статуса': '#CFD8DC'
+                }
+                fig = px.bar(plot_data, x="Количество", y="Тип обращения", color="Результат", orientation='h',
+                             color_discrete_map=color_map, text_auto=True, category_orders={"Тип обращения": top_names.tolist()})
+                fig.update_layout(barmode='stack', height=700, legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1), hovermode="y unified")
+                fig.update_yaxes(title="")
+                fig.update_xaxes(title="Количество диалогов")
+                st.plotly_chart(fig, use_container_width=True)
+
         # --- SUB-TAB 3: ПРОДУКТЫ (НОВАЯ ЛОГИКА) ---
         with sub_tab3:
-            # 1. Отсекаем все прочерки. Считаем только размеченные продукты.
-            df_valid_prods = df_analysis[df_analysis['Продукт'] != '-'].copy()
-
-            if not df_valid_prods.empty:
-                total_valid_chats = len(df_valid_prods)
-                
-                c_head1, c_head2 = st.columns([2, 1])
-                c_head1.write(f"### 🏢 Иерархия обращений")
-                c_head2.metric("Учтено чатов с продуктом", total_valid_chats)
-
-                # --- ЭТАЖИ (Текстовый отчет) ---
-                for prod, prod_df in df_valid_prods.groupby('Продукт'):
-                    prod_cnt = len(prod_df)
-                    # Процент продукта от общей массы размеченных
-                    prod_pct = (prod_cnt / total_valid_chats) * 100 
-                    
-                    with st.expander(f"📦 ПРОДУКТ: {prod} ({prod_pct:.1f}% | {prod_cnt} шт.)", expanded=True):
-                        for usr, user_df in prod_df.groupby('Тип юзера'):
-                            usr_cnt = len(user_df)
-                            # Процент юзера внутри этого продукта
-                            usr_pct = (usr_cnt / prod_cnt) * 100 
-                            st.markdown(f"**👤 ЮЗЕР: {usr}** ({usr_pct:.1f}% | {usr_cnt} шт.)")
-
-                            topic_counts = user_df['Тип обращения'].value_counts()
-                            for top, top_cnt in topic_counts.items():
-                                # Процент темы внутри этого юзера
-                                top_pct = (top_cnt / usr_cnt) * 100 
-                                st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;↳ 💬 *ТЕМА: {top}* ({top_pct:.1f}% | {top_cnt} шт.)")
-
-                st.divider()
-
-                # --- БЛОКИ (Визуализация как на схеме) ---
-                st.write("### 🔲 Карта распределения (Кликабельно)")
-                st.caption("Нажимай на блоки, чтобы провалиться вглубь продукта.")
-                
-                tree_df = df_valid_prods.groupby(['Продукт', 'Тип юзера', 'Тип обращения']).size().reset_index(name='Количество')
-                fig_tree = px.treemap(
-                    tree_df,
-                    path=[px.Constant("Все продукты"), 'Продукт', 'Тип юзера', 'Тип обращения'],
-                    values='Количество',
-                    color='Продукт',
-                    color_discrete_sequence=px.colors.qualitative.Pastel
-                )
-                fig_tree.update_traces(textinfo="label+value+percent parent")
-                fig_tree.update_layout(margin=dict(t=10, l=10, r=10, b=10), height=500)
-                st.plotly_chart(fig_tree, use_container_width=True)
+            if sub_tab3.open:
+                # 1. Отсекаем все прочерки. Считаем только размеченные продукты.
+                df_valid_prods = df_analysis[df_analysis['Продукт'] != '-'].copy()
 
-                st.divider()
-
-                # --- ОЧИЩЕННАЯ ТАБЛИЦА ---
-                st.write("### 📊 Детализация конверсии бота по продуктам")
-                
-                # Добавили Тип обращения, чтобы таблица была максимально подробной
-                prod_stats = df_valid_prods.groupby(['Продукт', 'Тип юзера', 'Тип обращения', 'Статус']).size().unstack(fill_value=0)
-                prod_stats['Всего'] = prod_stats.sum(axis=1)
+                if not df_valid_prods.empty:
+                    total_valid_chats = total_rows(df_valid_prods)
                 
-                for c in ['Закрыл', 'Перевод']: 
-                    if c not in prod_stats.columns: prod_stats[c] = 0
+                    c_head1, c_head2 = st.columns([2, 1])
+                    c_head1.write(f"### 🏢 Иерархия обращений")
+                    c_head2.metric("Учтено чатов с продуктом", total_valid_chats)
+
+                    # --- ЭТАЖИ (Текстовый отчет) ---
+                    for prod, prod_df in df_valid_prods.groupby('Продукт'):
+                        prod_cnt = total_rows(prod_df)
+                        # Процент продукта от общей массы размеченных
+                        prod_pct = (prod_cnt / total_valid_chats) * 100 
                     
-                prod_stats['Бот(✓)'] = (prod_stats['Закрыл'] / prod_stats['Всего'] * 100).map('{:.1f}%'.format)
-                prod_stats['Бот(→)'] = (prod_stats['Перевод'] / prod_stats['Всего'] * 100).map('{:.1f}%'.format)
-
-                def get_prod_details(row):
-                    transferred = row.get('Перевод', 0)
-                    if transferred == 0: return "—"
-                    cat_reasons = df_valid_prods[(df_valid_prods['Продукт'] == row.name[0]) & 
-                                              (df_valid_prods['Тип юзера'] == row.name[1]) & 
-                                              (df_valid_prods['Тип обращения'] == row.name[2]) &
-                                              (df_valid_prods['Статус'] == 'Перевод')]
-                    r_counts = cat_reasons['Причина перевода'].value_counts()
-                    return "\n".join([f"• {r}: {(count/transferred*100):.0f}%" for r, count in r_counts.items() if count > 0])
-
-                prod_stats['Причины перевода'] = prod_stats.apply(get_prod_details, axis=1)
+                        with st.expander(f"📦 ПРОДУКТ: {prod} ({prod_pct:.1f}% | {prod_cnt} шт.)", expanded=True):
+                            for usr, user_df in prod_df.groupby('Тип юзера'):
+                                usr_cnt = total_rows(user_df)
+                                # Процент юзера внутри этого продукта
+                                usr_pct = (usr_cnt / prod_cnt) * 100 
+                                st.markdown(f"**👤 ЮЗЕР: {usr}** ({usr_pct:.1f}% | {usr_cnt} шт.)")
+
+                                topic_counts = ranked_counts(user_df, 'Тип обращения')
+                                for top, top_cnt in topic_counts.items():
+                                    # Процент темы внутри этого юзера
+                                    top_pct = (top_cnt / usr_cnt) * 100 
+                                    st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;↳ 💬 *ТЕМА: {top}* ({top_pct:.1f}% | {top_cnt} шт.)")
+
+                    st.divider()
+
+                    # --- БЛОКИ (Визуализация как на схеме) ---
+                    st.write("### 🔲 Карта распределения (Кликабельно)")
+                    st.caption("Нажимай на блоки, чтобы провалиться вглубь продукта.")
                 
-                final_prod_table = prod_stats[['Всего', 'Бот(✓)', 'Бот(→)', 'Причины перевода']].sort_values(['Продукт', 'Всего'], ascending=[True, False]).reset_index()
-                st.dataframe(final_prod_table, use_container_width=True, hide_index=True)
+                    tree_df = df_valid_prods.groupby(['Продукт', 'Тип юзера', 'Тип обращения'], observed=True)['n'].sum().reset_index(name='Количество')
+                    tree_df = tree_df.astype({'Продукт': str, 'Тип юзера': str, 'Тип обращения': str})  # plotly не агрегирует категории
+                    fig_tree = px.treemap(
+                        tree_df,
+                        path=[px.Constant("Все продукты"), 'Продукт', 'Тип юзера', 'Тип обращения'],
+                        values='Количество',
+                        color='Продукт',
+                        color_discrete_sequence=px.colors.qualitative.Pastel
+                    )
+                    fig_tree.update_traces(textinfo="label+value+percent parent")
+                    fig_tree.update_layout(margin=dict(t=10, l=10, r=10, b=10), height=500)
+                    st.plotly_chart(fig_tree, use_container_width=True)
+
+                    st.divider()
+
+                    # --- ОЧИЩЕННАЯ ТАБЛИЦА ---
+                    st.write("### 📊 Детализация конверсии бота по продуктам")
+                    st.dataframe(final_prod_table, use_container_width=True, hide_index=True)
 
-            else:
-                st.info("Нет обращений с размеченным 'Продуктом' за выбранный период (везде стоят прочерки).")
+                else:
+                    st.info("Нет обращений с размеченным 'Продуктом' за выбранный период (везде стоят прочерки).")
     else:
         st.info("Нет данных за выбранный период. Попробуйте изменить даты в фильтрах.")
 
+with tabs[3]:
+    if tabs[3].open: categories_tab()
+
 # ==========================================
-# TAB 5: ДИНАМИКА (ПЕРИОД Б -> ПЕРИОД А + ВИЗУАЛИЗАЦИЯ)
+# TAB 5: ДИНАМИКА (ТРЕНД ПО ПЕРИОДАМ И ПЕРИОД Б -> ПЕРИОД А)
 # ==========================================
-with tabs[4]:
-    st.subheader("📈 Сравнение динамики: Прошлое vs Настоящее")
-    
+@st.fragment
+@timed_tab("Динамика")
+def dynamics_tab():
+    st.subheader("📈 Динамика обращений")
+    sub_trend, sub_pair = st.tabs(["📈 Тренд по периодам", "⚖️ Прошлое vs Настоящее"], key="dynamics_tabs", on_change="rerun")
+    with sub_trend:
+        if sub_trend.open: dynamics_trend()
+    with sub_pair:
+        if sub_pair.open: dynamics_pair()
+
+def dynamics_trend():
+    """Матрица тип обращения × период: объем и % закрытия ботом за N недель или месяцев"""
+    c_unit, c_count, c_end = st.columns(3)
+    unit = c_unit.radio("Шаг", ["Недели", "Месяцы"], horizontal=True, key="dyn_unit")
+    count = c_count.slider("Периодов", 2, 26, 13 if unit == "Недели" else 12, key=f"dyn_count_{unit}")
+    end = c_end.date_input("По дату", datetime.now().date(), key="dyn_end")
+
+    periods = trend_periods(end, count, unit)
+    volume, bot_pct = topic_dynamics(sheet_cube.cells, periods)
+    if volume.empty:
+        st.warning("Нет данных за выбранные периоды.")
+        return
+
+    # Подписи — начало периода; неполный последний период помечен звездочкой
+    partial = end.weekday() != 6 if unit == "Недели" else (end + timedelta(days=1)).day != 1
+    labels = [start.strftime("%d.%m" if unit == "Недели" else "%m.%Y") for start, _ in periods]
+    if partial: labels[-1] += "*"
+    volume.columns = bot_pct.columns = labels
+    volume = volume.loc[volume.sum(axis=1).sort_values(ascending=False, kind='stable').index]
+    bot_pct = bot_pct.loc[volume.index]
+
+    # Итог по всем типам за последний период против предыдущего
+    totals = volume.sum()
+    closed_totals = (volume * bot_pct.fillna(0) / 100).sum()
+    bot_share = closed_totals / totals.where(totals > 0) * 100
+    m1, m2 = st.columns(2)
+    v_diff = (totals.iloc[-1] / totals.iloc[-2] - 1) * 100 if totals.iloc[-2] > 0 else 0
+    m1.metric(f"Обращений за {labels[-1]}", f"{int(totals.iloc[-1])} чатов", f"{v_diff:+.1f}%", delta_color="inverse")
+    m2.metric(f"Закрыто ботом за {labels[-1]}", f"{bot_share.iloc[-1]:.1f}%" if pd.notna(bot_share.iloc[-1]) else "-",
+              f"{bot_share.iloc[-1] - bot_share.iloc[-2]:+.1f}пп" if bot_share.iloc[-2:].notna().all() else None)
+    if partial: st.caption("\\* — период еще не закончился, сравнение с предыдущим занижено")
+
+    top = volume.head(DYNAMICS_TOP_TOPICS)
+    st.write(f"#### Объем обращений (топ-{len(top)} типов)")
+    def draw_volume(fig):
+        sns.heatmap(top, annot=True, fmt="d", cmap="Blues", cbar=False, ax=fig.subplots()).set(xlabel="", ylabel="")
+    st.image(get_chart_cache().render(('dyn_volume', top), draw_volume, figsize=(max(8, count * 0.8), len(top) * 0.45 + 2)), width='stretch')
+
+    st.write("#### % закрытия ботом")
+    top_bot = bot_pct.loc[top.index]
+    def draw_bot(fig):
+        sns.heatmap(top_bot, annot=True, fmt=".0f", cmap="RdYlGn", vmin=0, vmax=100, cbar=False, ax=fig.subplots()).set(xlabel="", ylabel="")
+    st.image(get_chart_cache().render(('dyn_bot', top_bot), draw_bot, figsize=(max(8, count * 0.8), len(top) * 0.45 + 2)), width='stretch')
+
+    # Все типы: тренды строкой-спарклайном
+    last, prev = volume.iloc[:, -1], volume.iloc[:, -2]
+    table = pd.DataFrame({
+        "Тип обращения": volume.index.astype(str),
+        "Всего": volume.sum(axis=1).to_numpy(),
+        "Тренд V": volume.to_numpy().tolist(),
+        f"V {labels[-1]} к {labels[-2]}": ((last / prev.where(prev > 0) - 1) * 100).round(1).to_numpy(),
+        "Тренд B": [[None if pd.isna(x) else x for x in row] for row in bot_pct.round(1).to_numpy().tolist()],  # без обращений — разрыв, а не 0
+        f"B {labels[-1]}, %": bot_pct.iloc[:, -1].round(1).to_numpy()
+    })
+    with st.expander(f"Все типы обращений ({len(table)})", expanded=False):
+        st.dataframe(table, hide_index=True, use_container_width=True, column_config={
+            "Тренд V": st.column_config.LineChartColumn("Тренд V", help=f"Объем: {labels[0]} … {labels[-1]}"),
+            "Тренд B": st.column_config.LineChartColumn("Тренд B", help="% закрытия ботом", y_min=0, y_max=100)
+        })
+
+def dynamics_pair():
     # 1. Легенда (Описание логики)
     with st.expander("ℹ️ Логика цветовой индикации", expanded=False):
         st.markdown("""
@@ -1001,12 +1065,13 @@ with tabs[4]:
             p_s, p_e = range_prev
             c_s, c_e = range_curr
             
-            # Расчет данных
-            stats_p = get_dynamics_stats(df_gsheet_all, p_s, p_e)
-            stats_c = get_dynamics_stats(df_gsheet_all, c_s, c_e)
+            # Расчет данных: оба периода одной группировкой (0 — Б, 1 — А)
+            volume, bot_pct = topic_dynamics(sheet_cube.cells, [(p_s, p_e), (c_s, c_e)])
+            df_dyn = pd.DataFrame({
+                'Всего_curr': volume[1], 'Бот_%_curr': bot_pct[1], 'Всего_prev': volume[0], 'Бот_%_prev': bot_pct[0]
+            }).fillna(0)
 
-            # Объединяем (Сортировка по текущему объему А)
-            df_dyn = stats_c.join(stats_p, lsuffix='_curr', rsuffix='_prev', how='outer').fillna(0)
+            # Сортировка по текущему объему А
             df_dyn = df_dyn.sort_values('Всего_curr', ascending=False)
             
             # Функция подготовки данных для визуальной таблицы
@@ -1063,13 +1128,28 @@ with tabs[4]:
                 st.warning("Нет данных в выбранных диапазонах.")
         else:
             st.error("Выберите полные диапазоны дат (начало и конец).")
+
+with tabs[4]:
+    if tabs[4].open: dynamics_tab()
+
 # ==========================================
 # TAB 6: БАЗА ДАННЫХ
 # ==========================================
-with tabs[5]: # 
-    st.subheader("🗄️ База данных")
-    if not df_gsheet.empty:
-        st.write(f"Отображено записей: {len(df_gsheet)}")
-        st.dataframe(df_gsheet, use_container_width=True)
-    else:
-        st.info("Нет данных для отображения за выбранный период.")
\ No newline at end of file
+with tabs[5]:
+    if tabs[5].open:
+        with get_pipeline().metrics.timer('tab_render_seconds', tab="База данных"):
+            st.subheader("🗄️ База данных")
+            if not df_gsheet.empty:
+                st.write(f"Отображено записей: {len(df_gsheet)}")
+                st.dataframe(df_gsheet, use_container_width=True)
+            else:
+                st.info("Нет данных для отображения за выбранный период.")
+
+# ==========================================
+# МЕТРИКИ ПРОГОНА
+# ==========================================
+if ADMIN_PANEL:
+    pipeline_metrics = get_pipeline().metrics
+    pipeline_metrics.observe('run_seconds', time.perf_counter() - run_started, page="dashboard")
+    pipeline_metrics.record_process()
+    metrics_panel(diff_snapshots(pipeline_metrics.snapshot(), run_snapshot))
\ No newline at end of file
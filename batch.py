@@ -0,0 +1,158 @@
+"""
+Пакетная выгрузка без интерфейса: догружает дни диапазона из API в хранилище
+и пишет в каталог:
+
+- facts.parquet          — факты диалог × оператор × дата (как df_api в дашборде);
+- response_times.json    — скорости ответов по операторам;
+- departments.json       — сводка по отделам (как отчет вкладки "Анализ отдела");
+- run.json               — параметры запуска и покрытие: сколько диалогов
+  загружено / не загрузилось, дни с ошибками;
+- metrics.json, metrics.prom — метрики запуска (время стадий, HTTP, память)
+  в JSON и в текстовом формате Prometheus (например, для node_exporter textfile).
+
+Настройки — те же, что у дашборда: .streamlit/secrets.toml (API_TOKEN,
+STORE_PATH, API_RATE_LIMIT, HTTP_MODE, CPU_WORKERS), переменные окружения с теми же
+именами важнее файла. Хранилище общее с дашбордом, поэтому выгрузка по cron
+заодно прогревает его.
+
+    python batch.py --start 2024-05-01 --end 2024-05-07 --out exports/
+    python batch.py --start 2024-05-01 --end 2024-05-07 --retry-failed
+
+Код выхода 2 — часть дней загрузилась не полностью (ошибки API); тогда
+--retry-failed дозапрашивает только сбойное, не перегружая весь диапазон.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tomllib
+from datetime import date, timedelta
+
+import pandas as pd
+
+from metrics import to_json, to_prometheus
+from pipeline import Pipeline, department_metrics, now_local, operator_speed_stats
+
+log = logging.getLogger("batch")
+
+SETTINGS_KEYS = ("API_TOKEN", "STORE_PATH", "API_RATE_LIMIT", "HTTP_MODE", "CPU_WORKERS")
+
+
+def load_settings(path):
+    """Настройки из secrets.toml (если есть), поверх — из окружения"""
+    settings = {}
+    if path and os.path.exists(path):
+        with open(path, "rb") as f:
+            settings.update(tomllib.load(f))
+    settings.update((k, os.environ[k]) for k in SETTINGS_KEYS if os.environ.get(k))
+    return settings
+
+def build_pipeline(settings):
+    if not settings.get("API_TOKEN"):
+        raise SystemExit("API_TOKEN не задан (secrets.toml или переменная окружения)")
+    return Pipeline(
+        settings["API_TOKEN"],
+        settings.get("STORE_PATH", os.path.join(".cache", "api_days.sqlite")),
+        rate=float(settings.get("API_RATE_LIMIT", 25)),
+        http_mode=settings.get("HTTP_MODE", "threads"),
+        cpu_workers=int(settings.get("CPU_WORKERS", 0))
+    )
+
+def department_report(facts, speeds, first_speeds, bot_department):
+    """{отдел: сводка department_metrics} по всем отделам периода"""
+    if facts.empty: return {}
+    report = {}
+    for dept, dept_data in facts.groupby('Отдел', observed=True):
+        metrics = department_metrics(dept_data, speeds, first_speeds, dept == bot_department)
+        if metrics: report[dept] = {k: to_json_value(v) for k, v in metrics.items()}
+    return report
+
+def to_json_value(value):
+    """numpy-скаляры и NaN -> значения JSON"""
+    if value is None or pd.isna(value): return None
+    return value.item() if hasattr(value, 'item') else value
+
+def export_range(pipeline, start, end, out_dir, full_reload=False, retry_failed=False):
+    """Догружает диапазон и пишет выгрузку в out_dir. retry_failed — запрашивать
+    только то, что не загрузилось (и дни, которых нет в хранилище). Возвращает
+    дни, загруженные не полностью."""
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    started = time.monotonic()
+    last_logged = [0.0]
+    def on_progress(frac, text):
+        # Не чаще раза в 5 секунд — прогресс вызывается на каждый диалог
+        if time.monotonic() - last_logged[0] >= 5 or frac >= 1:
+            last_logged[0] = time.monotonic()
+            log.info("%3.0f%% %s", frac * 100, text)
+    def on_wait(n_days):
+        log.info("ждем %d дн., которые грузит другой процесс", n_days)
+    if retry_failed:
+        pipeline.retry_failed(days, on_progress=on_progress, on_wait=on_wait)
+    else:
+        pipeline.refresh_days(days, full_reload, on_progress=on_progress, on_wait=on_wait)
+    coverage = pipeline.coverage(days)
+    incomplete = coverage['incomplete_days']
+    if incomplete:
+        log.warning("не загружено диалогов: %d, неполные дни: %s", coverage['failed'], ", ".join(d.isoformat() for d in incomplete))
+
+    facts, speeds, first_speeds = pipeline.read_range(start, end)
+    os.makedirs(out_dir, exist_ok=True)
+
+    facts_out = facts.copy()
+    if 'Дата' in facts_out:
+        # Категория из date -> обычная колонка дат (date32 в Parquet)
+        facts_out['Дата'] = pd.to_datetime(facts_out['Дата'].astype(object)).dt.date
+    facts_out.to_parquet(os.path.join(out_dir, "facts.parquet"), index=False)
+    pipeline.metrics.set('frame_rows', len(facts), frame='facts')
+    pipeline.metrics.set('frame_bytes', int(facts.memory_usage(deep=True).sum()), frame='facts')
+
+    op_stats = operator_speed_stats(facts, speeds, first_speeds) if not facts.empty else pd.DataFrame()
+    with open(os.path.join(out_dir, "response_times.json"), "w", encoding="utf-8") as f:
+        json.dump([{k: to_json_value(v) for k, v in row.items()} for row in op_stats.to_dict('records')], f, ensure_ascii=False, indent=1)
+
+    with open(os.path.join(out_dir, "departments.json"), "w", encoding="utf-8") as f:
+        json.dump(department_report(facts, speeds, first_speeds, pipeline.resolver.bot_department), f, ensure_ascii=False, indent=1)
+
+    with open(os.path.join(out_dir, "run.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            'start': start.isoformat(), 'end': end.isoformat(),
+            'generated_at': now_local().isoformat(timespec='seconds'),
+            'duration_s': round(time.monotonic() - started, 1),
+            'facts': len(facts), 'dialogs': int(facts['req_id'].nunique()) if not facts.empty else 0,
+            'coverage': {**coverage, 'incomplete_days': [d.isoformat() for d in incomplete]}
+        }, f, ensure_ascii=False, indent=1)
+
+    # Процесс выгрузки — один запуск, поэтому метрики реестра и есть метрики запуска
+    pipeline.metrics.observe('run_seconds', time.monotonic() - started, page="batch")
+    pipeline.metrics.record_process()
+    snapshot = pipeline.metrics.snapshot()
+    with open(os.path.join(out_dir, "metrics.json"), "w", encoding="utf-8") as f:
+        json.dump(to_json(snapshot), f, ensure_ascii=False, indent=1)
+    with open(os.path.join(out_dir, "metrics.prom"), "w", encoding="utf-8") as f:
+        f.write(to_prometheus(snapshot))
+    return incomplete
+
+def main(argv=None):
+    yesterday = now_local().date() - timedelta(days=1)
+    parser = argparse.ArgumentParser(description="Выгрузка фактов и метрик chat2desk за диапазон дат")
+    parser.add_argument("--start", type=date.fromisoformat, default=yesterday, help="первый день, YYYY-MM-DD (по умолчанию вчера)")
+    parser.add_argument("--end", type=date.fromisoformat, default=None, help="последний день, YYYY-MM-DD (по умолчанию = --start)")
+    parser.add_argument("--out", default="exports", help="каталог выгрузки")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="файл настроек")
+    parser.add_argument("--full-reload", action="store_true", help="пересчитать открытые дни с нуля")
+    parser.add_argument("--retry-failed", action="store_true", help="дозапросить только то, что не загрузилось в прошлый раз")
+    args = parser.parse_args(argv)
+    end = args.end or args.start
+    if end < args.start: parser.error("--end раньше --start")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    pipeline = build_pipeline(load_settings(args.secrets))
+    incomplete = export_range(pipeline, args.start, end, args.out, args.full_reload, args.retry_failed)
+    log.info("готово: %s", os.path.abspath(args.out))
+    return 2 if incomplete else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+"""Бенчмарки конвейера API на локальной подмене chat2desk (см. bench_pipeline.py)."""
@@ -0,0 +1,233 @@
+"""
+Бенчмарк конвейера API (pipeline.Pipeline) на локальной подмене chat2desk.
+
+Каждый размер (число диалогов) прогоняется в отдельном процессе с чистым
+хранилищем: refresh_days за диапазон закрытых дней, затем read_range.
+Отчет: пропускная способность, p50/p99 по стадиям и пиковая память процесса.
+
+Стадии:
+- stats     — запросы страниц request_stats (задержка HTTP, с 429-повторами);
+- messages  — запросы страниц сообщений диалогов;
+- process   — расчет пачки диалогов (process_dialog_batch; с --cpu-workers —
+  время в процессе пула);
+- save      — запись дня в DayStore;
+- read      — сборка таблицы фактов за диапазон из хранилища.
+
+    python -m benchmarks.bench_pipeline --sizes 1000,10000,50000,200000
+    python -m benchmarks.bench_pipeline --sizes 10000 --workers 10,20,40 --server-rps 25 --latency-ms 80
+    python -m benchmarks.bench_pipeline --sizes 50000 --cpu-workers 0,2,4 --latency-ms 0
+    python -m benchmarks.bench_pipeline --json results.json --baseline old.json
+
+С --baseline сравнивает пропускную способность с прошлым запуском (те же
+размеры, воркеры и процессы расчета) и завершается с кодом 1, если она упала больше, чем на
+--tolerance.
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from benchmarks.mock_chat2desk import MockChat2Desk, MockConfig
+
+try:
+    import resource
+except ImportError:  # нет на Windows — пиковая память не меряется
+    resource = None
+
+STAGES = ("stats", "messages", "process", "save", "read")
+
+
+def percentiles(samples):
+    if not samples: return None, None
+    arr = np.asarray(samples) * 1000
+    return float(np.percentile(arr, 50)), float(np.percentile(arr, 99))
+
+def peak_rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024  # macOS — байты, Linux — КБ
+
+def run_case(case):
+    """Один прогон в текущем процессе. case — словарь параметров из main."""
+    import pipeline as pipeline_mod
+    from api_client import Chat2DeskClient, AsyncChat2DeskClient
+
+    samples = {stage: [] for stage in STAGES}
+
+    # Замеры — обертками вокруг методов клиента, расчета и хранилища (только в этом процессе)
+    def timed_get(get):
+        def wrapper(self, path, params=None):
+            started = time.perf_counter()
+            try:
+                return get(self, path, params)
+            finally:
+                samples['stats' if path == '/statistics' else 'messages'].append(time.perf_counter() - started)
+        return wrapper
+    def timed_get_json(get_json):
+        async def wrapper(self, path, params=None):
+            started = time.perf_counter()
+            try:
+                return await get_json(self, path, params)
+            finally:
+                samples['messages'].append(time.perf_counter() - started)
+        return wrapper
+    Chat2DeskClient.get = timed_get(Chat2DeskClient.get)
+    AsyncChat2DeskClient.get_json = timed_get_json(AsyncChat2DeskClient.get_json)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pipe = pipeline_mod.Pipeline("bench", os.path.join(tmp, "days.sqlite"), rate=case['rate'],
+                                     http_mode=case['http_mode'], base_url=case['base_url'], max_workers=case['workers'],
+                                     cpu_workers=case['cpu_workers'])
+        save_day = pipe.store.save_day
+        def timed_save(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return save_day(*args, **kwargs)
+            finally:
+                samples['save'].append(time.perf_counter() - started)
+        pipe.store.save_day = timed_save
+        # Расчет может идти в пуле процессов, поэтому его время — из метрики, которую пишет конвейер
+        observe = pipe.metrics.observe
+        def timed_observe(name, value, **labels):
+            if name == 'stage_seconds' and labels.get('stage') == 'process': samples['process'].append(value)
+            observe(name, value, **labels)
+        pipe.metrics.observe = timed_observe
+
+        end = date.fromisoformat(case['end'])
+        days = [end - timedelta(days=i) for i in reversed(range(case['days']))]
+        started = time.perf_counter()
+        incomplete = pipe.refresh_days(days)
+        fetch_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        facts, _, _ = pipe.read_range(days[0], days[-1])
+        samples['read'].append(time.perf_counter() - started)
+        dialogs = int(facts['req_id'].nunique()) if not facts.empty else 0
+
+    requests_n = len(samples['stats']) + len(samples['messages'])
+    return {
+        'size': case['size'], 'workers': case['workers'], 'cpu_workers': case['cpu_workers'], 'http_mode': case['http_mode'],
+        'fetch_s': fetch_s, 'dialogs_stored': dialogs, 'incomplete_days': len(incomplete),
+        'requests': requests_n,
+        'dialogs_per_s': case['size'] / fetch_s if fetch_s else None,
+        'requests_per_s': requests_n / fetch_s if fetch_s else None,
+        'stages': {stage: dict(zip(('p50_ms', 'p99_ms'), percentiles(values)), n=len(values)) for stage, values in samples.items()},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def spawn_case(case):
+    """Прогон в отдельном процессе: пиковая память и кэши не копятся между размерами"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_pipeline", "--case", json.dumps(case)],
+        cwd=root, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"прогон {case['size']} упал:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def format_row(r):
+    stages = "  ".join(
+        f"{stage} {s['p50_ms']:.1f}/{s['p99_ms']:.1f}" if s['p50_ms'] is not None else f"{stage} -"
+        for stage, s in r['stages'].items()
+    )
+    mem = f"{r['peak_rss_mb']:.0f}MB" if r['peak_rss_mb'] is not None else "-"
+    return (f"{r['size']:>7} dlg  w={r['workers']:<3} cpu={r.get('cpu_workers', 0):<2} {r['fetch_s']:7.1f}s  {r['dialogs_per_s']:8.0f} dlg/s  "
+            f"{r['requests_per_s']:7.0f} req/s  peak {mem:>6}  stored {r['dialogs_stored']}"
+            f"{'  INCOMPLETE ' + str(r['incomplete_days']) + ' d' if r['incomplete_days'] else ''}\n"
+            f"{'':>9}p50/p99 ms: {stages}")
+
+def compare(results, baseline, tolerance):
+    """Сообщения о падении пропускной способности относительно baseline"""
+    def key(r): return r['size'], r['workers'], r.get('cpu_workers', 0), r['http_mode']
+    old = {key(r): r for r in baseline}
+    problems = []
+    for r in results:
+        prev = old.get(key(r))
+        if not prev or not prev['dialogs_per_s']: continue
+        change = r['dialogs_per_s'] / prev['dialogs_per_s'] - 1
+        if change < -tolerance:
+            problems.append(f"{r['size']} dlg, w={r['workers']}, cpu={r.get('cpu_workers', 0)}: {prev['dialogs_per_s']:.0f} -> {r['dialogs_per_s']:.0f} dlg/s ({change:+.0%})")
+    return problems
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def int_range(value):
+    lo, _, hi = value.partition("-")
+    return int(lo), int(hi or lo)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки и обработки диалогов на подмене chat2desk")
+    parser.add_argument("--sizes", type=int_list, default=[1000, 10000, 50000, 200000], help="число диалогов, через запятую")
+    parser.add_argument("--days", type=int, default=7, help="на сколько дней распределить диалоги")
+    parser.add_argument("--workers", type=int_list, default=None, help="MAX_WORKERS, через запятую (по умолчанию как в pipeline.py)")
+    parser.add_argument("--cpu-workers", type=int_list, default=None, help="процессов расчета, через запятую (0 — в основном процессе)")
+    parser.add_argument("--http-mode", default="threads", choices=("threads", "async"))
+    parser.add_argument("--rate", type=float, default=1000, help="лимит клиента, запросов в секунду")
+    parser.add_argument("--messages", type=int_range, default=(2, 12), help="сообщений в диалоге, МИН-МАКС")
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="доля случайных ответов 429")
+    parser.add_argument("--server-rps", type=int, default=0, help="предел сервера, запросов в секунду (сверх — 429)")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--baseline", help="результаты прошлого запуска (--json) для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое падение пропускной способности")
+    parser.add_argument("--case", help=argparse.SUPPRESS)  # внутренний: один прогон в дочернем процессе
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    import pipeline as pipeline_mod
+    workers = args.workers or [pipeline_mod.MAX_WORKERS]
+    cpu_workers = args.cpu_workers or [pipeline_mod.CPU_WORKERS]
+    end = date.today() - timedelta(days=3)  # закрытые дни: сохраняются окончательно, без состояний диалогов
+    results = []
+    for size in args.sizes:
+        config = MockConfig(
+            dialogs_per_day=math.ceil(size / args.days), messages=args.messages,
+            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate, max_rps=args.server_rps, retry_after=args.retry_after,
+            time_offset=pipeline_mod.TIME_OFFSET
+        )
+        for n_workers in workers:
+            for n_cpu in cpu_workers:
+                server = MockChat2Desk(config).start()
+                try:
+                    result = spawn_case({
+                        'size': config.dialogs_per_day * args.days, 'days': args.days, 'end': end.isoformat(),
+                        'workers': n_workers, 'cpu_workers': n_cpu, 'rate': args.rate, 'http_mode': args.http_mode,
+                        'base_url': server.url
+                    })
+                finally:
+                    server.stop()
+                result['server'] = {'requests': server.requests, 'errors': server.errors, 'throttled': server.throttled}
+                results.append(result)
+                print(format_row(result), flush=True)
+                if server.errors or server.throttled:
+                    print(f"{'':>9}server: {server.requests} req, {server.errors} x 500, {server.throttled} x 429", flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for line in problems: print("REGRESSION", line)
+        if problems: return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Проверка векторного расчета (response_engine.MessageBatch) против
+последовательного разбора диалога по сообщениям.
+
+Эталонов два:
+- reference_dialog — разбор по сообщениям с текущими правилами (как в
+  хранилище дней): ответ оператора вне окна дня тоже закрывает ожидание
+  клиента, сообщения без created пропускаются, расчет продолжается с
+  сохраненного состояния. С ним расчет должен совпадать полностью;
+- baseline_dialog — цикл process_single_dialog из app.py до хранилища дней
+  (без запроса к API). Он отличается ожидаемо: ответ вне окна ожидание не
+  закрывал, а диалог с сообщением без created терял целиком (сортировка
+  падала). Поэтому сравнение с ним — только для диалогов без таких случаев.
+
+Диалоги случайные: входящие, ответы операторов и бота, служебные сообщения,
+сообщения без created и с одинаковым created, ответы до и после окна дня,
+порядок API любой. Каждый диалог считается в два захода (как открытый день:
+сначала часть сообщений, потом все с продолжением сохраненного состояния) и
+сравнивается с эталоном после каждого захода; первый заход — еще и с
+прежним циклом.
+
+    python -m benchmarks.check_engine --dialogs 300 --seed 1
+
+Код выхода 1 — есть расхождения (первые выводятся).
+"""
+import argparse
+import random
+import sys
+from datetime import date, timedelta
+
+import pandas as pd
+
+from pipeline import (TIME_OFFSET, day_window, dump_dialog_state, load_dialog_state, new_dialog_state,
+                      process_dialog_batch, to_unix)
+
+
+def reference_dialog(item, msgs, target_start, target_end, state=None):
+    """Эталон: разбор сообщений по одному с текущими правилами (ответ вне окна
+    тоже закрывает ожидание). state — продолжить с сохраненного состояния,
+    учитывая только сообщения новее его водяного знака."""
+    msgs = sorted(msgs, key=lambda x: x.get('created') or 0)
+    stats = state if state is not None else new_dialog_state(item)
+    stats['rating'] = item.get('rating')
+    client_waiting_since = stats['client_waiting_since']
+    last_ts, last_ids = stats['last_ts'], set(stats['last_ids'])
+
+    for m in msgs:
+        ts = m.get('created')
+        if not ts: continue
+        if ts < last_ts or (ts == last_ts and m.get('id') in last_ids): continue
+        if ts > stats['last_ts']: stats['last_ts'], stats['last_ids'] = ts, []
+        stats['last_ids'].append(m.get('id'))
+
+        dt_local = pd.to_datetime(ts, unit='s') + timedelta(hours=TIME_OFFSET)
+        msg_type = m.get('type')
+        op_id = m.get('operatorID') or m.get('operator_id')
+
+        if msg_type in ('from_client', 'in'):
+            if client_waiting_since is None: client_waiting_since = dt_local
+        elif msg_type == 'out' and op_id:
+            if target_start <= dt_local <= target_end:
+                stats['participations'].add(op_id)
+                stats['op_hours'].setdefault(op_id, set()).add((dt_local.date(), dt_local.hour))
+                if client_waiting_since is not None:
+                    diff = (dt_local - client_waiting_since).total_seconds()
+                    if diff > 0: stats['operator_speeds'].setdefault(op_id, []).append(diff)
+            # Ответ вне окна тоже закрывает ожидание
+            client_waiting_since = None
+
+    stats['client_waiting_since'] = client_waiting_since
+    return stats
+
+
+def baseline_dialog(item, msgs, target_start, target_end):
+    """Прежний цикл process_single_dialog (app.py до хранилища дней) без запроса к API"""
+    msgs = sorted(msgs, key=lambda x: x.get('created', 0))
+    client_waiting_since = None
+    stats = {'req_id': item['req_id'], 'participations': set(), 'operator_speeds': {}, 'op_hours': {}, 'rating': item.get('rating')}
+    for m in msgs:
+        ts = m.get('created')
+        if not ts: continue
+        dt_local = pd.to_datetime(ts, unit='s') + timedelta(hours=TIME_OFFSET)
+        msg_type = m.get('type')
+        op_id = m.get('operatorID') or m.get('operator_id')
+        if msg_type == 'from_client' or msg_type == 'in':
+            if client_waiting_since is None: client_waiting_since = dt_local
+        elif msg_type == 'out' and op_id and op_id != 0:
+            if target_start <= dt_local <= target_end:
+                stats['participations'].add(op_id)
+                stats['op_hours'].setdefault(op_id, set()).add((dt_local.date(), dt_local.hour))
+                if client_waiting_since:
+                    diff = (dt_local - client_waiting_since).total_seconds()
+                    if diff > 0: stats['operator_speeds'].setdefault(op_id, []).append(diff)
+                    client_waiting_since = None
+    return stats
+
+
+def differs_from_baseline(msgs, target_start, target_end):
+    """Ожидаемое расхождение с прежним циклом: сообщение без created или ответ
+    оператора вне окна, пока клиент ждет"""
+    if any(not m.get('created') for m in msgs): return True
+    waiting = False
+    for m in sorted(msgs, key=lambda x: x['created']):
+        dt_local = pd.to_datetime(m['created'], unit='s') + timedelta(hours=TIME_OFFSET)
+        if m.get('type') in ('from_client', 'in'): waiting = True
+        elif m.get('type') == 'out' and (m.get('operatorID') or m.get('operator_id')):
+            if waiting and not target_start <= dt_local <= target_end: return True
+            waiting = False
+    return False
+
+
+def random_dialog(rnd, req_id, day):
+    """Случайный диалог вокруг дня day: (item, сообщения в порядке API)"""
+    start_ts = int(to_unix(day_window(day)[0]))
+    t = start_ts + rnd.randint(-6 * 3600, 20 * 3600)  # может начаться накануне
+    ops = [rnd.randint(1000, 1010) for _ in range(3)]
+    msgs = []
+    for k in range(rnd.randint(0, 25)):
+        t += rnd.choice((0, 0, 1, 5, 60, 600, 3600, 4 * 3600))  # равные created — тоже
+        kind = rnd.random()
+        if kind < 0.45: m = {'type': rnd.choice(('in', 'from_client')), 'created': t}
+        elif kind < 0.85: m = {'type': 'out', 'created': t, 'operatorID': rnd.choice(ops)}
+        elif kind < 0.92: m = {'type': 'out', 'created': t, 'operatorID': 0}
+        else: m = {'type': 'system', 'created': t}
+        if rnd.random() < 0.03: m['created'] = None
+        m['id'] = req_id * 100 + k
+        msgs.append(m)
+    order = rnd.random()
+    if order < 0.3: msgs.reverse()
+    elif order < 0.5: rnd.shuffle(msgs)
+    return {'req_id': req_id, 'rating': rnd.choice((None, 3, 5))}, msgs
+
+
+def normalized(stats):
+    """Состояние после сохранения: так его видит следующая загрузка"""
+    return load_dialog_state(dump_dialog_state(stats))
+
+
+def check(n_dialogs, seed):
+    rnd = random.Random(seed)
+    day = date(2024, 5, 10)
+    window = day_window(day)
+    dialogs = [random_dialog(rnd, i, day) for i in range(n_dialogs)]
+
+    # Заход 1: сообщения до случайной точки (как на момент первой загрузки открытого дня)
+    first = []
+    for item, msgs in dialogs:
+        ordered = sorted((m for m in msgs if m['created']), key=lambda m: m['created'])
+        cut = rnd.randint(0, len(ordered))
+        first.append([m for m in msgs if m in ordered[:cut]])
+
+    mismatches = []
+    states, _, _ = process_dialog_batch([(i, day, item, part, None) for i, ((item, _), part) in enumerate(zip(dialogs, first))])
+    saved = dict(states)
+    expected = [reference_dialog(item, part, *window) for (item, _), part in zip(dialogs, first)]
+    for i, ref in enumerate(expected):
+        if normalized(ref) != load_dialog_state(saved[i]): mismatches.append((1, i))
+
+    # Прежний цикл: те же участия, часы и скорости везде, кроме ожидаемых расхождений
+    fields = ('participations', 'operator_speeds', 'op_hours', 'rating')
+    expected_diffs = 0
+    for i, ((item, _), part) in enumerate(zip(dialogs, first)):
+        if differs_from_baseline(part, *window):
+            expected_diffs += 1
+            continue
+        base, state = baseline_dialog(item, part, *window), load_dialog_state(saved[i])
+        if any(base[f] != state[f] for f in fields): mismatches.append(('baseline', i))
+
+    # Заход 2: все сообщения, продолжение сохраненного состояния
+    states, _, _ = process_dialog_batch([(i, day, item, msgs, saved[i]) for i, (item, msgs) in enumerate(dialogs)])
+    for i, ((item, msgs), ref) in enumerate(zip(dialogs, expected)):
+        ref = reference_dialog(item, msgs, *window, normalized(ref))
+        if normalized(ref) != load_dialog_state(dict(states)[i]): mismatches.append((2, i))
+    return dialogs, mismatches, expected_diffs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сверка MessageBatch с последовательным разбором диалогов")
+    parser.add_argument("--dialogs", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    dialogs, mismatches, expected_diffs = check(args.dialogs, args.seed)
+    print(f"{len(dialogs)} диалогов x 2 захода: расхождений {len(mismatches)}; "
+          f"с прежним циклом не сравнивались (ожидаемые отличия) {expected_diffs}")
+    for stage, i in mismatches[:5]:
+        print(f"  заход {stage}, диалог {i}: {dialogs[i][1]}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Локальная подмена API chat2desk для бенчмарков: /operators,
+/operators/{id}, /statistics?report=request_stats и /requests/{id}/messages.
+
+Диалоги синтетические и детерминированные (зависят только от seed и id):
+за день dialogs_per_day диалогов, у каждого от messages[0] до messages[1]
+сообщений, клиент и операторы чередуются. Можно задать задержку ответа,
+долю ошибок 500, случайные 429 и предел запросов в секунду (сверх него —
+429 с Retry-After), чтобы проверить поведение клиента под лимитом.
+"""
+import json
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import date
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+MockConfig = namedtuple('MockConfig', [
+    'dialogs_per_day',  # диалогов в request_stats за день
+    'messages',         # (мин, макс) сообщений в диалоге
+    'operators',        # число операторов (плюс бот)
+    'latency_ms',       # задержка каждого ответа
+    'jitter_ms',        # + равномерная случайная добавка 0..jitter_ms
+    'error_rate',       # доля ответов 500
+    'throttle_rate',    # доля случайных ответов 429
+    'max_rps',          # предел запросов в секунду (0 — без предела), сверх — 429
+    'retry_after',      # Retry-After у 429, секунды
+    'time_offset',      # сдвиг локального времени от UTC, часы
+    'seed',
+], defaults=(1000, (2, 12), 20, 0.0, 0.0, 0.0, 0.0, 0, 1, 3, 0))
+
+BOT_ID = 310507
+DAY_ID_BASE = 10**6  # id диалога = номер дня от 1970-01-01 * DAY_ID_BASE + номер в дне
+
+
+def day_dialog_ids(config, day):
+    base = (day - date(1970, 1, 1)).days * DAY_ID_BASE
+    return range(base, base + config.dialogs_per_day)
+
+def dialog_messages(config, req_id):
+    """Сообщения диалога по возрастанию created: вопрос клиента, ответ оператора и т.д."""
+    rnd = random.Random(config.seed * 1_000_003 + req_id)
+    day_start = (req_id // DAY_ID_BASE) * 86400 - config.time_offset * 3600
+    t = day_start + rnd.randint(0, 80000)
+    op_ids = [BOT_ID] + [1000 + i for i in range(config.operators)]
+    operator = rnd.choice(op_ids)
+    out = []
+    for k in range(rnd.randint(*config.messages)):
+        t += rnd.randint(1, 600)
+        if k % 2 == 0:
+            out.append({'id': req_id * 1000 + k, 'created': t, 'type': 'in'})
+        else:
+            if rnd.random() < 0.1: operator = rnd.choice(op_ids)  # перевод на другого оператора
+            out.append({'id': req_id * 1000 + k, 'created': t, 'type': 'out', 'operatorID': operator})
+    return out
+
+
+class MockChat2Desk:
+    """HTTP-сервер в фоновом потоке. url — базовый адрес для Pipeline(base_url=...)."""
+
+    def __init__(self, config=MockConfig(), host='127.0.0.1', port=0):
+        self.config = config
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._rnd = random.Random(config.seed)
+        self._window = (0, 0)  # (секунда, запросов в ней) для max_rps
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+            # Заголовки и тело — одним пакетом, без задержки Nagle/delayed ACK (~40 мс на ответ)
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args): pass
+
+            def do_GET(self):
+                mock._handle(self)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024  # по умолчанию 5: при десятках соединений сразу SYN теряются
+
+        self._server = Server((host, port), Handler)
+        self.url = f"http://{host}:{self._server.server_address[1]}/v1"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-chat2desk", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _admit(self):
+        """None — обслужить, иначе код ошибки (429 / 500)"""
+        config = self.config
+        with self._lock:
+            self.requests += 1
+            if config.max_rps:
+                second = int(time.monotonic())
+                start, count = self._window
+                count = count + 1 if start == second else 1
+                self._window = (second, count)
+                if count > config.max_rps:
+                    self.throttled += 1
+                    return 429
+            roll = self._rnd.random()
+            if roll < config.throttle_rate:
+                self.throttled += 1
+                return 429
+            if roll < config.throttle_rate + config.error_rate:
+                self.errors += 1
+                return 500
+        return None
+
+    def _handle(self, handler):
+        config = self.config
+        if config.latency_ms or config.jitter_ms:
+            time.sleep((config.latency_ms + random.random() * config.jitter_ms) / 1000)
+        status = self._admit()
+        if status == 429:
+            return self._send(handler, {'error': 'Too Many Requests'}, 429, {'Retry-After': str(config.retry_after)})
+        if status:
+            return self._send(handler, {'error': 'Internal Server Error'}, status)
+
+        url = urlparse(handler.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path.removeprefix('/v1')
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 200))
+        if path == '/operators':
+            ops = [{'id': BOT_ID, 'first_name': 'Бот', 'last_name': 'AI'}] + [
+                {'id': 1000 + i, 'first_name': 'Оператор', 'last_name': str(i)} for i in range(config.operators)]
+            return self._send(handler, {'data': ops[offset:offset + limit], 'meta': {'total': len(ops)}})
+        if path.startswith('/operators/'):
+            op_id = int(path.split('/')[2])
+            if 1000 <= op_id < 1000 + config.operators:
+                return self._send(handler, {'data': {'id': op_id, 'first_name': 'Оператор', 'last_name': str(op_id - 1000)}})
+        if path == '/statistics' and query.get('report') == 'request_stats':
+            ids = day_dialog_ids(config, date.fromisoformat(query['date']))[offset:offset + limit]
+            rows = [{'request_id': i, 'rating_scale_score': i % 6 or None} for i in ids]
+            return self._send(handler, {'data': rows})
+        if path.startswith('/requests/') and path.endswith('/messages'):
+            msgs = dialog_messages(config, int(path.split('/')[2]))
+            return self._send(handler, {'data': msgs[offset:offset + limit], 'meta': {'total': len(msgs)}})
+        self._send(handler, {'error': 'Not Found'}, 404)
+
+    @staticmethod
+    def _send(handler, obj, status=200, headers=None):
+        body = json.dumps(obj).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items(): handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
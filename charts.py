@@ -0,0 +1,74 @@
+"""
+Рендер графиков matplotlib/seaborn в PNG с кэшем по содержимому.
+
+Фигура создается как matplotlib.figure.Figure, без pyplot: она не попадает
+в глобальный список фигур pyplot и не живет дольше рендера. После сохранения
+в PNG (с теми же параметрами, что у st.pyplot) фигура сразу очищается.
+Готовые картинки лежат в LRU по хэшу входных данных, ограниченном числом
+картинок и суммарным размером. Одинаковый график не перерисовывается ни
+на rerun, ни в другой сессии.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+from matplotlib.figure import Figure
+
+SAVEFIG_OPTIONS = {'bbox_inches': 'tight', 'dpi': 200, 'format': 'png'}
+
+
+def content_key(*parts):
+    """Хэш входных данных графика: таблицы — по значениям, индексу и колонкам,
+    остальное — по repr"""
+    h = hashlib.md5()
+    for part in parts:
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            h.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+            if isinstance(part, pd.DataFrame): h.update(repr(part.columns.tolist()).encode())
+        else:
+            h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+def render_png(draw, figsize):
+    """draw(fig) рисует на новой фигуре -> PNG (bytes); фигура очищается в любом случае"""
+    fig = Figure(figsize=figsize)
+    try:
+        draw(fig)
+        buf = io.BytesIO()
+        fig.savefig(buf, **SAVEFIG_OPTIONS)
+        return buf.getvalue()
+    finally:
+        fig.clear()
+
+
+class ChartCache:
+    """LRU готовых картинок по ключу содержимого. Потокобезопасен."""
+
+    def __init__(self, max_items=128, max_bytes=64 * 2**20):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def render(self, key_parts, draw, figsize):
+        """PNG графика: из кэша, если такие данные уже рисовались, иначе render_png.
+        key_parts — все, от чего зависит картинка (данные и параметры оформления)."""
+        key = content_key(figsize, *key_parts)
+        with self._lock:
+            png = self._items.get(key)
+            if png is not None:
+                self._items.move_to_end(key)
+                return png
+        png = render_png(draw, figsize)
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = png
+                self._bytes += len(png)
+                while self._items and (len(self._items) > self.max_items or self._bytes > self.max_bytes):
+                    _, old = self._items.popitem(last=False)
+                    self._bytes -= len(old)
+        return png
@@ -0,0 +1,288 @@
+"""
+Посуточное хранилище результатов API chat2desk (SQLite).
+
+Для каждого дня хранится результат анализа: участия операторов по часам
+(с оценкой диалога) и гистограммы скоростей ответов по операторам
+(см. sketches.SpeedSketch). Закрытые дни больше не
+перезапрашиваются у API, открытые (например, сегодня) перезаписываются.
+Для открытых дней дополнительно хранится состояние каждого диалога и
+водяной знак (последний учтенный `created`), чтобы обновлять день
+инкрементально. Во время загрузки состояния посчитанных диалогов
+сохраняются контрольными точками (checkpoint_states), а у сохраненного дня —
+покрытие: сколько диалогов загружено и сколько не удалось.
+
+Здесь же — справочник имен операторов из API (operator_directory), чтобы
+после перезапуска не перезапрашивать его целиком.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from sketches import SpeedSketch
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    day        TEXT PRIMARY KEY,
+    version    INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    is_final   INTEGER NOT NULL,
+    watermark  INTEGER,
+    coverage   TEXT  -- JSON: счетчики диалогов дня (pipeline.COVERAGE_KEYS) и полнота списка чатов
+);
+CREATE TABLE IF NOT EXISTS participations (
+    day         TEXT NOT NULL,
+    req_id      INTEGER NOT NULL,
+    operator_id INTEGER NOT NULL,
+    rating,
+    date        TEXT,
+    hour        INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_participations_day ON participations(day);
+CREATE TABLE IF NOT EXISTS speed_buckets (
+    day         TEXT NOT NULL,
+    operator_id INTEGER NOT NULL,
+    is_first    INTEGER NOT NULL,  -- 0: все ответы, 1: первые ответы в диалоге
+    bucket      INTEGER NOT NULL,
+    count       INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_speed_buckets_day ON speed_buckets(day);
+CREATE TABLE IF NOT EXISTS dialog_state (
+    day         TEXT NOT NULL,
+    req_id      INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    PRIMARY KEY (day, req_id)
+);
+CREATE TABLE IF NOT EXISTS operators (
+    id   INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def speed_bucket_rows(day, speeds):
+    """[(op_id, speed, is_first)] -> строки speed_buckets: гистограмма всех ответов
+    оператора (is_first=0) и отдельно первых ответов (is_first=1)"""
+    values = {}
+    for op_id, speed, is_first in speeds:
+        values.setdefault((op_id, 0), []).append(speed)
+        if is_first: values.setdefault((op_id, 1), []).append(speed)
+    return [
+        (day, op_id, kind, bucket, count)
+        for (op_id, kind), vals in values.items()
+        for bucket, count in SpeedSketch.from_values(vals).sparse()
+    ]
+
+
+class DayStore:
+    """Хранилище результатов по дням. Потокобезопасно (одно соединение + lock)."""
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder: os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        # Базы, созданные до появления водяного знака
+        cols = {r[1] for r in self._conn.execute("PRAGMA table_info(days)")}
+        if 'watermark' not in cols:
+            self._conn.execute("ALTER TABLE days ADD COLUMN watermark INTEGER")
+            self._conn.commit()
+        # ... и до появления покрытия
+        if 'coverage' not in cols:
+            self._conn.execute("ALTER TABLE days ADD COLUMN coverage TEXT")
+            self._conn.commit()
+        # Базы с сырыми скоростями: переводим в гистограммы без перезапроса API
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'speeds'").fetchone():
+            by_day = {}
+            for day, op_id, speed, is_first in self._conn.execute("SELECT day, operator_id, speed, is_first FROM speeds"):
+                by_day.setdefault(day, []).append((op_id, speed, is_first))
+            with self._conn:
+                for day, speeds in by_day.items():
+                    self._conn.executemany("INSERT INTO speed_buckets VALUES (?, ?, ?, ?, ?)", speed_bucket_rows(day, speeds))
+                self._conn.execute("DROP TABLE speeds")
+
+    def final_days(self, days, version):
+        """Какие из дней уже закрыты и посчитаны текущей версией обработки."""
+        keys = [d.isoformat() for d in days]
+        if not keys: return set()
+        with self._lock:
+            found = set()
+            for chunk_start in range(0, len(keys), 500):
+                chunk = keys[chunk_start:chunk_start + 500]
+                q = f"SELECT day FROM days WHERE is_final = 1 AND version = ? AND day IN ({','.join('?' * len(chunk))})"
+                found.update(r[0] for r in self._conn.execute(q, [version, *chunk]))
+        return {d for d in days if d.isoformat() in found}
+
+    def fresh_days(self, days, version, max_age):
+        """Какие из дней посчитаны текущей версией не раньше max_age секунд назад
+        (открытый день, только что обновленный фоновой загрузкой)."""
+        keys = [d.isoformat() for d in days]
+        if not keys: return set()
+        since = time.time() - max_age
+        with self._lock:
+            found = set()
+            for chunk_start in range(0, len(keys), 500):
+                chunk = keys[chunk_start:chunk_start + 500]
+                q = f"SELECT day FROM days WHERE version = ? AND fetched_at >= ? AND day IN ({','.join('?' * len(chunk))})"
+                found.update(r[0] for r in self._conn.execute(q, [version, since, *chunk]))
+        return {d for d in days if d.isoformat() in found}
+
+    def data_version(self, days):
+        """Версия данных набора дней (число сохраненных дней, время последнего
+        сохранения): меняется, как только перезаписан любой из дней."""
+        keys = [d.isoformat() for d in days]
+        count, latest = 0, 0.0
+        with self._lock:
+            for chunk_start in range(0, len(keys), 500):
+                chunk = keys[chunk_start:chunk_start + 500]
+                n, last = self._conn.execute(
+                    f"SELECT COUNT(*), MAX(fetched_at) FROM days WHERE day IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchone()
+                count += n
+                latest = max(latest, last or 0.0)
+        return count, latest
+
+    def save_day(self, day, result, version, is_final, states=None, watermark=None, coverage=None):
+        """Перезаписывает день целиком.
+
+        result = {'rows': [(req_id, op_id, rating, 'YYYY-MM-DD' | None, hour)],
+                  'speeds': [(op_id, speed, is_first)]} — скорости сохраняются гистограммами.
+        states = {req_id: (fingerprint, state_json)} — только для открытых дней,
+        у закрытого дня состояния диалогов удаляются.
+        coverage — словарь покрытия дня (хранится как JSON).
+        """
+        key = day.isoformat()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM participations WHERE day = ?", (key,))
+            self._conn.execute("DELETE FROM speed_buckets WHERE day = ?", (key,))
+            self._conn.execute("DELETE FROM dialog_state WHERE day = ?", (key,))
+            self._conn.executemany(
+                "INSERT INTO participations VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, *row) for row in result['rows']]
+            )
+            self._conn.executemany(
+                "INSERT INTO speed_buckets VALUES (?, ?, ?, ?, ?)",
+                speed_bucket_rows(key, result['speeds'])
+            )
+            if states and not is_final:
+                self._conn.executemany(
+                    "INSERT INTO dialog_state VALUES (?, ?, ?, ?)",
+                    [(key, req_id, fp, state) for req_id, (fp, state) in states.items()]
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO days (day, version, fetched_at, is_final, watermark, coverage) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, version, time.time(), int(is_final), watermark, json.dumps(coverage) if coverage is not None else None)
+            )
+
+    def checkpoint_states(self, day, version, states):
+        """Дописывает состояния диалогов дня посреди загрузки (контрольная точка).
+
+        Если день еще не сохранялся или посчитан другой версией, он заводится
+        незакрытым и несвежим (fetched_at = 0) — следующая загрузка его
+        перезапросит, но диалоги с неизменным отпечатком возьмет отсюда."""
+        key = day.isoformat()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT version FROM days WHERE day = ?", (key,)).fetchone()
+            if not row or row[0] != version:
+                self._conn.execute("DELETE FROM dialog_state WHERE day = ?", (key,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO days (day, version, fetched_at, is_final) VALUES (?, ?, 0, 0)", (key, version)
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dialog_state VALUES (?, ?, ?, ?)",
+                [(key, req_id, fp, state) for req_id, (fp, state) in states.items()]
+            )
+
+    def dialog_states(self, day, version):
+        """Сохраненные состояния диалогов открытого дня: {req_id: (fingerprint, state_json)}"""
+        key = day.isoformat()
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM days WHERE day = ?", (key,)).fetchone()
+            if not row or row[0] != version: return {}
+            return {
+                req_id: (fp, state) for req_id, fp, state in
+                self._conn.execute("SELECT req_id, fingerprint, state FROM dialog_state WHERE day = ?", (key,))
+            }
+
+    def coverage(self, days):
+        """Покрытие сохраненных дней: {day: словарь покрытия}. Дни без покрытия
+        (сохранены до его появления или только контрольной точкой) не входят."""
+        keys = [d.isoformat() for d in days]
+        found = {}
+        with self._lock:
+            for chunk_start in range(0, len(keys), 500):
+                chunk = keys[chunk_start:chunk_start + 500]
+                found.update(self._conn.execute(
+                    f"SELECT day, coverage FROM days WHERE coverage IS NOT NULL AND day IN ({','.join('?' * len(chunk))})", chunk
+                ))
+        return {d: json.loads(found[d.isoformat()]) for d in days if d.isoformat() in found}
+
+    def watermark(self, day):
+        """Последний учтенный `created` (unix) за день или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT watermark FROM days WHERE day = ?", (day.isoformat(),)).fetchone()
+        return row[0] if row else None
+
+    def operators(self):
+        """Сохраненный справочник операторов: ({id: имя}, время полного обновления | None)"""
+        with self._lock:
+            names = dict(self._conn.execute("SELECT id, name FROM operators"))
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'operators_refreshed_at'").fetchone()
+        return names, row[0] if row else None
+
+    def save_operators(self, names, refreshed_at=None):
+        """Дописывает имена операторов {id: имя}; refreshed_at — время полного
+        обновления (если справочник загружен целиком)"""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO operators VALUES (?, ?)", names.items())
+            if refreshed_at is not None:
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('operators_refreshed_at', ?)", (refreshed_at,))
+
+    def load_speed_sketches(self, days):
+        """Гистограммы скоростей за набор дней, слитые по оператору:
+        ({op_id: SpeedSketch} по всем ответам, {op_id: SpeedSketch} по первым)"""
+        keys = [d.isoformat() for d in days]
+        parts = {}
+        with self._lock:
+            for chunk_start in range(0, len(keys), 500):
+                chunk = keys[chunk_start:chunk_start + 500]
+                for op_id, is_first, bucket, count in self._conn.execute(
+                    "SELECT operator_id, is_first, bucket, SUM(count) FROM speed_buckets "
+                    f"WHERE day IN ({','.join('?' * len(chunk))}) GROUP BY operator_id, is_first, bucket", chunk
+                ):
+                    buckets, counts = parts.setdefault((op_id, is_first), ([], []))
+                    buckets.append(bucket); counts.append(count)
+        all_speeds, first_speeds = {}, {}
+        for (op_id, is_first), (buckets, counts) in parts.items():
+            (first_speeds if is_first else all_speeds)[op_id] = SpeedSketch.from_buckets(buckets, counts)
+        return all_speeds, first_speeds
+
+    def load_facts(self, days):
+        """Факты участия за набор дней, сжатые до (req_id, operator_id, date):
+        часы собраны в 24-битную маску. Возвращает кортеж колонок
+        (req_ids, operator_ids, ratings, dates, hour_masks)."""
+        keys = [d.isoformat() for d in days]
+        rows = []
+        with self._lock:
+            for chunk_start in range(0, len(keys), 500):
+                chunk = keys[chunk_start:chunk_start + 500]
+                rows.extend(self._conn.execute(
+                    "SELECT req_id, operator_id, MAX(rating), date, "
+                    "SUM(DISTINCT CASE WHEN hour >= 0 THEN 1 << hour ELSE 0 END) "
+                    f"FROM participations WHERE day IN ({','.join('?' * len(chunk))}) "
+                    "GROUP BY req_id, operator_id, date", chunk
+                ))
+        if not rows: return [], [], [], [], []
+        return tuple(list(col) for col in zip(*rows))
@@ -0,0 +1,168 @@
+"""
+Встроенные метрики: счетчики, значения и гистограммы времени по меткам.
+
+Metrics — накопительный реестр на процесс (его держит Pipeline, пишут
+HTTP-клиент, конвейер и интерфейс). Снимок snapshot() — обычный словарь;
+разность двух снимков (diff_snapshots) дает метрики одного прогона: все,
+что произошло между ними. Снимок выгружается в JSON (to_json) или в
+текстовый формат Prometheus (to_prometheus).
+"""
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # нет на Windows
+    resource = None
+
+# Границы корзин гистограмм, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def endpoint_label(path):
+    """/requests/123/messages -> /requests/{id}/messages: метка без числовых id"""
+    return re.sub(r'/\d+', '/{id}', path)
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    """Реестр метрик. Потокобезопасен; запись — словарь под одним lock."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}  # key -> [счетчики корзин (+ последняя — больше всех границ), сумма, число]
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        pos = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            hist[0][pos] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Время блока -> гистограмма name (секунды), в том числе при исключении"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """{'counters': {key: n}, 'gauges': {key: v}, 'histograms': {key: (корзины, сумма, число)},
+        'buckets': границы}; key = (имя, ((метка, значение), ...))"""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()},
+                'buckets': self.buckets
+            }
+
+    def record_process(self):
+        """Пиковая память процесса (RSS) — значение process_peak_rss_bytes"""
+        if resource is None: return
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.set('process_peak_rss_bytes', peak if sys.platform == 'darwin' else peak * 1024)
+
+
+def diff_snapshots(after, before):
+    """Метрики между двумя снимками: разность счетчиков и гистограмм,
+    значения — из after. Пустые разности отбрасываются."""
+    counters = {}
+    for key, value in after['counters'].items():
+        delta = value - before['counters'].get(key, 0)
+        if delta: counters[key] = delta
+    histograms = {}
+    for key, (counts, total, n) in after['histograms'].items():
+        prev_counts, prev_total, prev_n = before['histograms'].get(key, ([0] * len(counts), 0.0, 0))
+        if n - prev_n:
+            histograms[key] = ([a - b for a, b in zip(counts, prev_counts)], total - prev_total, n - prev_n)
+    return {'counters': counters, 'gauges': dict(after['gauges']), 'histograms': histograms, 'buckets': after['buckets']}
+
+def histogram_quantile(buckets, counts, q):
+    """Оценка квантиля по корзинам (линейно внутри корзины, как в Prometheus)"""
+    n = sum(counts)
+    if not n: return None
+    rank = q * n
+    cum = 0
+    for i, count in enumerate(counts):
+        if cum + count >= rank and count:
+            if i >= len(buckets): return float(buckets[-1])  # выше последней границы
+            lo = buckets[i - 1] if i > 0 else 0.0
+            return lo + (buckets[i] - lo) * (rank - cum) / count
+        cum += count
+    return float(buckets[-1])
+
+def hist_quantile(buckets, hist, q):
+    """Квантиль гистограммы (корзины, сумма, число): одно наблюдение — оно само"""
+    counts, total, n = hist
+    return total if n == 1 else histogram_quantile(buckets, counts, q)
+
+def to_json(snapshot):
+    """Снимок -> JSON-совместимый словарь: списки {name, labels, value} по видам метрик"""
+    def rows(items, value):
+        return [{'name': name, 'labels': dict(labels), **value(v)} for (name, labels), v in sorted(items.items())]
+    buckets = snapshot['buckets']
+    return {
+        'counters': rows(snapshot['counters'], lambda v: {'value': v}),
+        'gauges': rows(snapshot['gauges'], lambda v: {'value': v}),
+        'histograms': rows(snapshot['histograms'], lambda v: {
+            'count': v[2], 'sum': v[1],
+            'buckets': dict(zip([str(b) for b in buckets] + ['+Inf'], v[0])),
+            'p50': hist_quantile(buckets, v, 0.5),
+            'p99': hist_quantile(buckets, v, 0.99)
+        })
+    }
+
+def to_prometheus(snapshot, prefix="sla_"):
+    """Снимок -> текстовый формат Prometheus (exposition format 0.0.4)"""
+    def fmt_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    lines, typed = [], set()
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+
+    for (name, labels), value in sorted(snapshot['counters'].items()):
+        type_line(name, "counter")
+        lines.append(f"{prefix}{name}{fmt_labels(labels)} {value}")
+    for (name, labels), value in sorted(snapshot['gauges'].items()):
+        type_line(name, "gauge")
+        lines.append(f"{prefix}{name}{fmt_labels(labels)} {value}")
+    buckets = snapshot['buckets']
+    for (name, labels), (counts, total, n) in sorted(snapshot['histograms'].items()):
+        type_line(name, "histogram")
+        cum = 0
+        for bound, count in zip(list(buckets) + ['+Inf'], counts):
+            cum += count
+            lines.append(f"{prefix}{name}_bucket{fmt_labels(labels, [('le', bound)])} {cum}")
+        lines.append(f"{prefix}{name}_sum{fmt_labels(labels)} {total}")
+        lines.append(f"{prefix}{name}_count{fmt_labels(labels)} {n}")
+    return "\n".join(lines) + "\n"
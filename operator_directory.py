@@ -0,0 +1,151 @@
+"""
+Справочник операторов chat2desk: имена из API и определенные по ним
+отдел и роль (OperatorResolver).
+
+Один OperatorDirectory на процесс (его держит Pipeline), общий для всех
+сессий. Справочник загружается из /operators целиком, постранично, не чаще
+раза в ttl секунд и хранится в DayStore — перезапуск его не перезапрашивает.
+Оператор, которого в справочнике нет (например, новый сотрудник), ищется при
+первом появлении в данных: внеочередным полным обновлением (не чаще раза в
+OPERATORS_MIN_REFRESH), оставшиеся — запросом по id. Уволенные из API не
+удаляются: их имена нужны для старых дней.
+
+version растет при каждом изменении имен — по ней сбрасываются кэши таблиц
+фактов, собранных со старыми именами.
+"""
+import threading
+import time
+
+OPERATORS_PAGE_LIMIT = 200
+OPERATORS_TTL = 3600          # плановое полное обновление, секунды
+OPERATORS_MIN_REFRESH = 300   # пауза между полными обновлениями из-за неизвестных id и после ошибки
+OPERATORS_MISS_TTL = 600      # id, не найденный в API, не перезапрашивается столько секунд
+OPERATORS_MAX_LOOKUPS = 50    # запросов по одному id за вызов
+
+
+def operator_name(op):
+    """Имя оператора из ответа API: имя и фамилия, иначе email, иначе id"""
+    name = f"{op.get('first_name') or ''} {op.get('last_name') or ''}".strip()
+    return name or op.get('email') or str(op['id'])
+
+
+class OperatorDirectory:
+    """Имена и OperatorIdentity операторов по id. Потокобезопасен.
+
+    static — служебные id (бот, система): их имена важнее API."""
+
+    def __init__(self, client, resolver, metrics, store=None, static=None, ttl=OPERATORS_TTL, clock=time.time):
+        self.client = client
+        self.resolver = resolver
+        self.metrics = metrics
+        self.store = store
+        self.static = dict(static or {})
+        self.ttl = ttl
+        self.clock = clock
+        self.version = 0
+        self._lock = threading.Lock()          # имена и отметки времени
+        self._refresh_lock = threading.Lock()  # запросы к API — по одному за раз
+        self._names, self._refreshed_at = store.operators() if store is not None else ({}, None)
+        self._attempted_at = None  # последняя попытка полного обновления, в том числе неудачная
+        self._misses = {}          # id -> когда API его не нашел
+
+    def names(self, op_ids=()):
+        """{id: имя} всех известных операторов. Устаревший справочник обновляется,
+        id из op_ids, которых в нем нет, ищутся в API."""
+        self.ensure_fresh()
+        if self.unknown(op_ids): self.lookup(op_ids)
+        with self._lock:
+            return {**self._names, **self.static}
+
+    def identities(self, op_ids):
+        """OperatorIdentity для каждого id из op_ids (имя, отдел, тимлид, бот)"""
+        names = self.names(op_ids)
+        return [self.resolver.resolve(op_id, names.get(op_id, f"ID {op_id}")) for op_id in op_ids]
+
+    def unknown(self, op_ids):
+        """id, которых нет в справочнике и которые недавно не искали безуспешно"""
+        now = self.clock()
+        with self._lock:
+            return [
+                op_id for op_id in dict.fromkeys(op_ids)
+                if op_id not in self._names and op_id not in self.static
+                and now - self._misses.get(op_id, float('-inf')) >= OPERATORS_MISS_TTL
+            ]
+
+    def ensure_fresh(self):
+        """Полное обновление, если справочник старше ttl. Пока обновляет другой
+        поток, со старыми именами не ждем его, без имен — ждем."""
+        if not self._due(self.ttl): return
+        if not self._refresh_lock.acquire(blocking=not self._names): return
+        try:
+            if self._due(self.ttl): self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def lookup(self, op_ids):
+        """Ищет в API операторов из op_ids, которых нет в справочнике: сначала
+        внеочередным полным обновлением, оставшихся — по одному"""
+        with self._refresh_lock:
+            if self.unknown(op_ids) and self._due(OPERATORS_MIN_REFRESH): self.refresh()
+            missing = self.unknown(op_ids)[:OPERATORS_MAX_LOOKUPS]
+            found = {}
+            for op_id in missing:
+                try:
+                    r = self.client.get(f"/operators/{op_id}")
+                    data = r.json().get('data') if r.status_code == 200 else None
+                except Exception:
+                    data = None
+                if isinstance(data, list): data = data[0] if data else None
+                if data:
+                    found[op_id] = operator_name({'id': op_id, **data})
+                else:
+                    with self._lock: self._misses[op_id] = self.clock()
+                self.metrics.inc('operator_lookups_total', result='found' if data else 'missing')
+            if found: self._merge(found)
+
+    def refresh(self):
+        """Полное обновление: все страницы /operators. При ошибке посреди
+        загрузки полученные имена сохраняются, но справочник остается устаревшим
+        (следующая попытка — не раньше чем через OPERATORS_MIN_REFRESH)."""
+        self._attempted_at = started = self.clock()
+        fetched, offset, complete = {}, 0, False
+        try:
+            with self.metrics.timer('stage_seconds', stage='operators'):
+                while True:
+                    r = self.client.get("/operators", params={"limit": OPERATORS_PAGE_LIMIT, "offset": offset})
+                    if r.status_code != 200: break
+                    data = r.json()
+                    page = data.get('data') or []
+                    new = {op['id']: operator_name(op) for op in page if op['id'] not in fetched}
+                    # Конец — пустая страница (или сервер игнорирует offset) либо meta.total
+                    if not new:
+                        complete = True
+                        break
+                    fetched.update(new)
+                    offset += len(page)
+                    total = (data.get('meta') or {}).get('total')
+                    if total is not None and offset >= total:
+                        complete = True
+                        break
+        except Exception:
+            pass  # сеть или не JSON: остаемся со старыми именами
+        self._merge(fetched, started if complete else None)
+
+    def _due(self, max_age):
+        now = self.clock()
+        with self._lock:
+            return ((self._refreshed_at is None or now - self._refreshed_at >= max_age)
+                    and (self._attempted_at is None or now - self._attempted_at >= OPERATORS_MIN_REFRESH))
+
+    def _merge(self, names, refreshed_at=None):
+        with self._lock:
+            changed = {op_id: name for op_id, name in names.items() if self._names.get(op_id) != name}
+            self._names.update(changed)
+            for op_id in names: self._misses.pop(op_id, None)
+            if refreshed_at is not None: self._refreshed_at = refreshed_at
+            if changed: self.version += 1
+        # Отдел и роль — сразу, а не при первой сборке таблицы фактов
+        for op_id, name in changed.items():
+            if op_id not in self.static: self.resolver.resolve(op_id, name)
+        if self.store is not None and (changed or refreshed_at is not None):
+            self.store.save_operators(changed, refreshed_at)
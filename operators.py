@@ -0,0 +1,84 @@
+"""
+Определение оператора по имени: отдел, роль (тимлид/бот/специалист).
+
+OperatorResolver один раз нормализует справочник отделов и корни фамилий
+тимлидов и строит индекс по словам имени. Результат запоминается на
+operator_id (пока у оператора не сменилось имя), так что разбор строк идет
+один раз на оператора, а не на каждое участие в диалоге.
+"""
+from collections import namedtuple
+
+UNKNOWN_DEPARTMENT = "Не определен"
+
+OperatorIdentity = namedtuple('OperatorIdentity', ['name', 'department', 'is_tl', 'is_bot'])
+
+
+def normalize_text(text):
+    if not text: return ""
+    return str(text).lower().strip().replace("ё", "е")
+
+
+class OperatorResolver:
+    """Справочник операторов с индексом имен и памятью по operator_id.
+
+    Правила совпадают с прежним поиском по DEPARTMENT_MAPPING:
+    сначала точное совпадение имени, затем первый (в порядке справочника)
+    ключ, все слова которого встречаются в имени из API.
+    """
+
+    def __init__(self, department_mapping, custom_grouping=None, tl_roots=(),
+                 bot_id=None, bot_name="Бот AI", bot_department="Бот AI"):
+        self.custom_grouping = custom_grouping or {}
+        self.tl_roots = [normalize_text(r) for r in tl_roots]
+        self.bot_id = bot_id
+        self.bot_name = bot_name
+        self.bot_department = bot_department
+
+        self._exact = {}
+        self._entries = []  # (слова ключа, отдел) в порядке справочника
+        self._by_token = {}  # слово -> номера ключей, где оно встречается
+        for name, dept in department_mapping.items():
+            clean = normalize_text(name)
+            self._exact.setdefault(clean, dept)
+            parts = clean.split()
+            if not parts: continue
+            pos = len(self._entries)
+            self._entries.append((parts, dept))
+            for part in set(parts): self._by_token.setdefault(part, []).append(pos)
+        self._memo = {}
+
+    def department(self, api_name):
+        clean = normalize_text(api_name)
+        if clean in self._exact: return self._exact[clean]
+
+        # Кандидаты, у которых все слова есть среди слов имени целиком
+        tokens = set(clean.split())
+        best = None
+        for token in tokens:
+            for pos in self._by_token.get(token, ()):
+                if best is not None and pos >= best: continue
+                if all(part in tokens for part in self._entries[pos][0]): best = pos
+        # Более ранний ключ мог совпасть только как подстрока — проверяем лишь их
+        limit = len(self._entries) if best is None else best
+        for parts, dept in self._entries[:limit]:
+            if all(part in clean for part in parts): return dept
+        return UNKNOWN_DEPARTMENT if best is None else self._entries[best][1]
+
+    def is_team_lead(self, api_name):
+        clean = normalize_text(api_name)
+        return any(root in clean for root in self.tl_roots)
+
+    def resolve(self, op_id, api_name):
+        """OperatorIdentity для оператора; повторные вызовы берутся из памяти."""
+        cached = self._memo.get(op_id)
+        if cached is not None and cached[0] == api_name: return cached[1]
+
+        if op_id == self.bot_id:
+            identity = OperatorIdentity(f"🤖 {self.bot_name}", self.bot_department, False, True)
+        else:
+            dept = self.department(api_name)
+            identity = OperatorIdentity(
+                api_name, self.custom_grouping.get(dept, dept), self.is_team_lead(api_name), False
+            )
+        self._memo[op_id] = (api_name, identity)
+        return identity
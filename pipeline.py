@@ -0,0 +1,967 @@
+"""
+Конвейер данных API chat2desk без интерфейса: загрузка дней (request_stats и
+сообщения диалогов), расчет участий и скоростей ответов, посуточное хранилище
+и сборка таблицы фактов за диапазон.
+
+Сбойные запросы (страницы request_stats, сообщения диалогов) уходят в
+очередь повторов с экспоненциальной паузой. Посчитанные диалоги по ходу
+загрузки сохраняются контрольными точками в хранилище, у каждого дня —
+покрытие: сколько диалогов загружено, взято из хранилища, пропущено и не
+загрузилось. Повтор только сбойного — retry_failed.
+
+Для долгих загрузок есть потоковый режим (on_partial): по мере расчета
+пачек диалогов наружу отдается растущая таблица фактов с гистограммами
+скоростей — предварительные цифры до конца загрузки.
+
+Загрузка диалогов — конвейер из стадий с ограниченными очередями:
+I/O (потоки или asyncio: запросы, разбор JSON, пагинация) -> расчет пачек
+(process_dialog_batch: скорости, участия, состояния и частичный агрегат дня;
+в основном процессе или в пуле процессов при cpu_workers > 0) -> слияние
+частичных агрегатов в основном потоке. Когда расчет не успевает, I/O ждет,
+поэтому память не растет с размером диапазона.
+
+Pipeline держит общие на процесс ресурсы (HTTP-клиент, DayStore, справочник
+операторов, single-flight по дням, реестр метрик) и не зависит от Streamlit:
+его строит и дашборд (app.py), и пакетная выгрузка (batch.py). Ход загрузки
+сообщается через колбэки on_progress / on_wait, время стадий — в
+metrics (stage_seconds{stage=...}).
+"""
+import asyncio
+import hashlib
+import heapq
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from api_client import AdaptiveRateLimiter, Chat2DeskClient, AsyncChat2DeskClient
+from day_store import DayStore
+from metrics import Metrics
+from operator_directory import OperatorDirectory
+from operators import OperatorResolver
+from reference import BOT_ID, OPERATORS_MAP, DEPARTMENT_MAPPING, CUSTOM_GROUPING, TL_ROOTS
+from response_engine import MessageBatch
+from singleflight import SingleFlight
+from sketches import SpeedSketch
+
+BASE_URL = "https://api.chat2desk.com/v1"
+
+MAX_WORKERS = 20
+TIME_OFFSET = 3
+ASYNC_MAX_CONNECTIONS = 200
+
+# Процессы для расчета пачек диалогов (0 — в основном процессе). На многоядерном
+# сервере — число ядер минус одно (основной процесс занят I/O и слиянием)
+CPU_WORKERS = 0
+# Ограниченные очереди конвейера: диалогов в загрузке и пачек в расчете на процесс
+IO_QUEUE_DIALOGS = 1000
+CPU_QUEUE_BATCHES = 2
+
+# Пагинация отчета request_stats: размер страницы и сколько страниц дня запрашивать наперед
+STATS_PAGE_LIMIT = 200
+STATS_PREFETCH_PAGES = 4
+
+# Сообщения диалога читаются постранично, пока не выйдем за окно анализа
+MESSAGES_PAGE_LIMIT = 300
+# Поля request_stats с временем последней активности (если отчет их отдает):
+# диалоги, затихшие до начала окна, не запрашиваются вовсе
+STATS_LAST_ACTIVITY_FIELDS = ("last_message_time", "end_time")
+# Сколько скачанных диалогов копить перед векторным расчетом скоростей
+ENGINE_BATCH_DIALOGS = 2000
+# Потоковый режим: пачка считается и промежуточный результат отдается не реже раза в столько секунд
+STREAM_INTERVAL = 2.0
+
+# Повтор сбойных запросов: до RETRY_ROUNDS раз, пауза RETRY_BASE_DELAY * 2**попытка (не больше RETRY_MAX_DELAY)
+RETRY_ROUNDS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Покрытие дня: fetched — загружены сообщения, reused — не изменились с прошлой загрузки
+# (состояние из хранилища), skipped — затихли до начала дня, failed — не загрузились после повторов
+COVERAGE_KEYS = ("listed", "fetched", "reused", "skipped", "failed")
+
+STORE_VERSION = 1  # увеличить при изменении логики обработки диалогов — дни пересчитаются
+STORE_FINAL_DELAY = timedelta(hours=6)  # после конца дня еще догоняют ответы и оценки
+
+
+def now_local():
+    """Текущее локальное время (наивное, со сдвигом TIME_OFFSET)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=TIME_OFFSET)
+
+def new_dialog_state(item):
+    """Пустое состояние диалога. Состояние можно сохранить и дообработать позже."""
+    return {
+        'req_id': item['req_id'],
+        'participations': set(),
+        'operator_speeds': {},
+        'op_hours': {},
+        'rating': item.get('rating'),
+        'client_waiting_since': None,
+        'last_ts': 0,      # водяной знак: последний учтенный created
+        'last_ids': []     # id сообщений с created == last_ts (секундная точность)
+    }
+
+def dump_dialog_state(stats):
+    waiting = stats['client_waiting_since']
+    return json.dumps({
+        'req_id': stats['req_id'],
+        'rating': stats['rating'],
+        'participations': list(stats['participations']),
+        'operator_speeds': [[op, sp] for op, sp in stats['operator_speeds'].items()],
+        'op_hours': [[op, [[d.isoformat(), h] for d, h in hours]] for op, hours in stats['op_hours'].items()],
+        'client_waiting_since': waiting.isoformat() if waiting is not None else None,
+        'last_ts': stats['last_ts'],
+        'last_ids': stats['last_ids']
+    })
+
+def load_dialog_state(raw):
+    data = json.loads(raw)
+    waiting = data['client_waiting_since']
+    return {
+        'req_id': data['req_id'],
+        'rating': data['rating'],
+        'participations': set(data['participations']),
+        'operator_speeds': {op: sp for op, sp in data['operator_speeds']},
+        'op_hours': {op: {(date.fromisoformat(d), h) for d, h in hours} for op, hours in data['op_hours']},
+        'client_waiting_since': pd.Timestamp(waiting) if waiting else None,
+        'last_ts': data['last_ts'],
+        'last_ids': data['last_ids']
+    }
+
+def extract_messages(json_data):
+    return json_data if isinstance(json_data, list) else json_data.get('data', [])
+
+def to_unix(local_dt):
+    """Локальное время окна -> unix (UTC)"""
+    return (pd.Timestamp(local_dt) - timedelta(hours=TIME_OFFSET)).timestamp()
+
+def compact_message(m):
+    """Только поля, нужные расчету: сообщения копятся в очереди и уходят в
+    другие процессы, тексты и вложения там не нужны"""
+    return {'id': m.get('id'), 'created': m.get('created'), 'type': m.get('type'),
+            'operatorID': m.get('operatorID') or m.get('operator_id')}
+
+def day_window(day):
+    """Окно анализа диалога — его день (локальное время)"""
+    target_start = pd.Timestamp(day)
+    return target_start, target_start + timedelta(hours=23, minutes=59, seconds=59)
+
+class DialogMessageReader:
+    """Постраничное чтение сообщений диалога с ранней остановкой.
+
+    Порядок выдачи API определяется по первой странице (если он не монотонный,
+    читаются все страницы):
+    - по возрастанию: останавливаемся на первом сообщении позже конца окна;
+    - по убыванию: останавливаемся, когда встретили ответ оператора раньше
+      начала окна — он закрывает ожидание, более старые сообщения не нужны.
+    Сообщения позже конца окна на статистику окна не влияют и отбрасываются.
+    Страница без новых id (сервер игнорирует offset) — тоже конец, повторы
+    сообщений в расчет не попадают."""
+
+    def __init__(self, target_start, target_end):
+        self.start_ts, self.end_ts = to_unix(target_start), to_unix(target_end)
+        self.messages = []
+        self.offset = 0
+        self.order = None
+        self.done = False
+        self.seen = set()
+
+    def feed(self, page):
+        self.offset += len(page)
+        if len(page) < MESSAGES_PAGE_LIMIT: self.done = True
+        ids = {m.get('id') for m in page} - {None}
+        if ids and ids <= self.seen:
+            self.done = True
+            return
+        stamps = [m.get('created') or 0 for m in page]
+        if self.order is None and len(set(stamps)) > 1:
+            if all(a <= b for a, b in zip(stamps, stamps[1:])): self.order = 'asc'
+            elif all(a >= b for a, b in zip(stamps, stamps[1:])): self.order = 'desc'
+            else: self.order = 'unordered'  # без гарантии порядка читаем все страницы
+
+        for m, ts in zip(page, stamps):
+            msg_id = m.get('id')
+            if msg_id is not None:
+                if msg_id in self.seen: continue
+                self.seen.add(msg_id)
+            if ts > self.end_ts:
+                if self.order == 'asc': self.done = True
+                continue
+            self.messages.append(compact_message(m))
+            if self.order == 'desc' and ts < self.start_ts and m.get('type') == 'out' and (m.get('operatorID') or m.get('operator_id')):
+                self.done = True
+
+def parse_api_time(value):
+    """unix-время или строка даты из API -> unix. Строка без пояса считается локальным временем."""
+    if value is None: return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        ts = pd.Timestamp(value)
+    except ValueError:
+        return None
+    return ts.timestamp() if ts.tzinfo is not None else to_unix(ts)
+
+def last_activity_before(item, target_start):
+    """True, если по строке request_stats диалог затих до начала окна"""
+    ts = item.get('last_activity')
+    return ts is not None and ts < to_unix(target_start)
+
+def last_activity_after(item, ts):
+    """True, если по строке request_stats в диалоге было что-то позже ts (unix)"""
+    last = item.get('last_activity')
+    return last is not None and ts is not None and last > ts
+
+def fetch_dialog_messages(client, item, target_start, target_end):
+    """Сообщения диалога, нужные для окна анализа. None — ошибка запроса."""
+    try:
+        if last_activity_before(item, target_start): return []
+        reader = DialogMessageReader(target_start, target_end)
+        while not reader.done:
+            r = client.get(f"/requests/{item['req_id']}/messages", params={"limit": MESSAGES_PAGE_LIMIT, "offset": reader.offset})
+            if r.status_code != 200: return None
+            with client.metrics.timer('json_parse_seconds', endpoint='/requests/{id}/messages'):
+                page = extract_messages(r.json())
+            reader.feed(page)
+        return reader.messages
+    except Exception:
+        return None
+
+def add_to_batch(batch, key, item, msgs, target_start, target_end, state=None):
+    """Кладет диалог в пачку MessageBatch, продолжая с сохраненного состояния"""
+    waiting = state['client_waiting_since'] if state else None
+    batch.add(
+        key, msgs, to_unix(target_start), to_unix(target_end),
+        init_wait=to_unix(waiting) if waiting is not None else None,
+        last_ts=state['last_ts'] if state else 0,
+        last_ids=state['last_ids'] if state else ()
+    )
+
+def merge_engine_result(item, state, res):
+    """Добавляет результат MessageBatch к состоянию диалога"""
+    stats = state if state is not None else new_dialog_state(item)
+    stats['rating'] = item.get('rating')
+    stats['participations'] |= res['participations']
+    for op_id, hours in res['op_hours'].items():
+        stats['op_hours'].setdefault(op_id, set()).update(hours)
+    for op_id, speeds in res['operator_speeds'].items():
+        stats['operator_speeds'].setdefault(op_id, []).extend(speeds)
+    waiting = res['waiting']
+    stats['client_waiting_since'] = pd.to_datetime(waiting, unit='s') + timedelta(hours=TIME_OFFSET) if waiting is not None else None
+    if res['last_ts'] is not None:
+        if res['last_ts'] == stats['last_ts']: stats['last_ids'] = stats['last_ids'] + res['last_ids']
+        else: stats['last_ts'], stats['last_ids'] = res['last_ts'], res['last_ids']
+    return stats
+
+def backoff_delay(attempt):
+    """Пауза перед повтором номер attempt (с 0)"""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+def coverage_complete(cov):
+    """День загружен полностью: весь список чатов и все диалоги"""
+    return bool(cov) and cov['stats_complete'] and not cov['failed']
+
+def coverage_summary(coverage):
+    """Покрытие набора дней {day: покрытие}: суммы счетчиков и дни с ошибками"""
+    total = dict.fromkeys(COVERAGE_KEYS, 0)
+    for cov in coverage.values():
+        for k in COVERAGE_KEYS: total[k] += cov.get(k, 0)
+    total['incomplete_days'] = sorted(day for day, cov in coverage.items() if not coverage_complete(cov))
+    return total
+
+def is_day_final(day):
+    """День закрыт, если в локальном времени он закончился больше STORE_FINAL_DELAY назад"""
+    return now_local() >= datetime.combine(day + timedelta(days=1), datetime.min.time()) + STORE_FINAL_DELAY
+
+def fetch_stats_page(client, d_str, offset):
+    """Одна страница request_stats. Ошибка HTTP — исключение (день будет неполным)."""
+    params = {"report": "request_stats", "date": d_str, "limit": STATS_PAGE_LIMIT, "offset": offset}
+    r = client.get("/statistics", params=params)
+    r.raise_for_status()
+    with client.metrics.timer('json_parse_seconds', endpoint='/statistics'):
+        return r.json().get('data', [])
+
+def stats_rows_to_items(rows):
+    items = []
+    for row in rows:
+        rating = row.get('rating_scale_score')
+        if rating == 0 or rating == '0': rating = None
+        # Отпечаток строки отчета: изменился — в диалоге что-то произошло
+        fp = hashlib.md5(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
+        last_activity = next((row[f] for f in STATS_LAST_ACTIVITY_FIELDS if row.get(f)), None)
+        items.append({'req_id': row['request_id'], 'rating': rating, 'fp': fp, 'last_activity': parse_api_time(last_activity)})
+    return list({v['req_id']: v for v in items}.values())
+
+def build_day_result(dialog_results):
+    """Сворачивает состояния диалогов за день в формат DayStore"""
+    rows, speeds = [], []
+    for res in dialog_results:
+        if not res or not res['participations']: continue
+        for op_id, op_speeds in res['operator_speeds'].items():
+            for i, s in enumerate(op_speeds):
+                speeds.append((op_id, s, int(i == 0)))
+        for op_id in res['participations']:
+            hours = res.get('op_hours', {}).get(op_id, set())
+            if not hours:
+                rows.append((res['req_id'], op_id, res['rating'], None, -1))
+            for d, h in hours:
+                rows.append((res['req_id'], op_id, res['rating'], d.isoformat(), h))
+    return {'rows': rows, 'speeds': speeds}
+
+def fact_columns(rows):
+    """Строки участий [(req_id, op_id, rating, date, hour)] -> колонки фактов
+    (req_ids, operator_ids, ratings, dates, hour_masks), как DayStore.load_facts"""
+    facts = {}
+    for req_id, op_id, rating, d, hour in rows:
+        fact = facts.setdefault((req_id, op_id, d), [None, 0])
+        if fact[0] is None: fact[0] = rating
+        if hour >= 0: fact[1] |= 1 << hour
+    cols = ([], [], [], [], [])
+    for (req_id, op_id, d), (rating, mask) in facts.items():
+        for col, value in zip(cols, (req_id, op_id, rating, d, mask)): col.append(value)
+    return cols
+
+def speed_sketches(speeds, into=None):
+    """[(op_id, speed, is_first)] -> ({op_id: SpeedSketch}, {op_id: SpeedSketch} первых ответов).
+    into — пара словарей, к гистограммам которых значения добавляются."""
+    values = {}
+    for op_id, speed, is_first in speeds:
+        values.setdefault((op_id, 0), []).append(speed)
+        if is_first: values.setdefault((op_id, 1), []).append(speed)
+    all_speeds, first_speeds = into if into is not None else ({}, {})
+    for (op_id, kind), vals in values.items():
+        target = first_speeds if kind else all_speeds
+        sketch = SpeedSketch.from_values(vals)
+        target[op_id] = SpeedSketch.merge_all([target[op_id], sketch]) if op_id in target else sketch
+    return all_speeds, first_speeds
+
+def day_part(dialog_results):
+    """Частичный агрегат дня по состояниям диалогов: результат build_day_result
+    и водяной знак (последний учтенный created)"""
+    part = build_day_result(dialog_results)
+    part['watermark'] = max((res['last_ts'] for res in dialog_results), default=None)
+    return part
+
+def merge_day_part(into, part):
+    """Добавляет частичный агрегат part к агрегату дня into"""
+    into['rows'].extend(part['rows'])
+    into['speeds'].extend(part['speeds'])
+    if part['watermark'] is not None:
+        into['watermark'] = part['watermark'] if into['watermark'] is None else max(into['watermark'], part['watermark'])
+
+def process_dialog_batch(dialogs):
+    """Стадия расчета: пачка скачанных диалогов -> состояния и частичные агрегаты.
+
+    dialogs — [(key, day, item, messages, state_json | None)]. Аргументы и
+    результат — простые данные, поэтому функция выполняется и в основном
+    процессе, и в пуле процессов. Возвращает (states, parts, секунды):
+    states — [(key, state_json)], parts — {day: day_part}."""
+    started = time.perf_counter()
+    batch = MessageBatch(TIME_OFFSET)
+    prev = {}
+    for key, day, item, msgs, raw in dialogs:
+        prev[key] = load_dialog_state(raw) if raw is not None else None
+        add_to_batch(batch, key, item, msgs, *day_window(day), prev[key])
+    jobs = {dialog[0]: dialog for dialog in dialogs}
+    states, by_day = [], {}
+    for key, res in batch.run():
+        _, day, item, _, _ = jobs[key]
+        stats = merge_engine_result(item, prev[key], res)
+        states.append((key, dump_dialog_state(stats)))
+        by_day.setdefault(day, []).append(stats)
+    return states, {day: day_part(results) for day, results in by_day.items()}, time.perf_counter() - started
+
+def build_api_facts(req_ids, op_ids, ratings, dates, hour_masks, operators):
+    """Таблица фактов диалог × оператор × дата.
+
+    Часы участия — 24-битная маска hour_mask, оператор/отдел/дата — категории,
+    колонки собираются сразу массивами. Строки по часам при необходимости
+    дает explode_hours (app.py). operators — OperatorDirectory."""
+    op_arr = np.asarray(op_ids, dtype=np.int64)
+    uniq_ops, op_idx = np.unique(op_arr, return_inverse=True)
+
+    # Имя, отдел и роль — из справочника, один раз на оператора (бот — отдельный отдел)
+    identities = operators.identities(uniq_ops.tolist())
+    names = [i.name for i in identities]
+    depts = [i.department for i in identities]
+
+    def categorical(values_per_op):
+        cats = sorted(set(values_per_op))
+        pos = {v: i for i, v in enumerate(cats)}
+        return pd.Categorical.from_codes(np.array([pos[v] for v in values_per_op])[op_idx], cats)
+
+    date_arr = np.array([d or '' for d in dates])
+    uniq_dates, date_idx = np.unique(date_arr, return_inverse=True)
+    date_cats = [date.fromisoformat(d) for d in uniq_dates if d]
+    date_codes = date_idx - (1 if '' in uniq_dates else 0)  # '' (без часов) -> код -1, т.е. NaN
+
+    df = pd.DataFrame({
+        'req_id': np.asarray(req_ids, dtype=np.int64),
+        'operator_id': op_arr.astype(np.int32),
+        'Оператор': categorical(names),
+        'Отдел': categorical(depts),
+        'is_tl': np.array([i.is_tl for i in identities], dtype=bool)[op_idx],
+        'rating': pd.to_numeric(pd.Series(ratings, dtype=object), errors='coerce').astype(np.float32),
+        'Дата': pd.Categorical.from_codes(date_codes, date_cats),
+        'hour_mask': np.asarray(hour_masks, dtype=np.int32)
+    })
+    return df[df['Отдел'] != "Тренер"].reset_index(drop=True)
+
+def department_metrics(df, sm, fsm, is_bot=False):
+    """Сводка отдела за период по фактам API: чаты, оценки и CSAT, скорости
+    (слияние гистограмм операторов отдела), специалистов и нагрузку в среднем
+    за день. None — у отдела нет фактов (кроме бота)."""
+    if df.empty and not is_bot: return None
+    chats = df['req_id'].nunique() if not df.empty else 0
+    ratings = pd.to_numeric(df.drop_duplicates('req_id')['rating'], errors='coerce').dropna() if not df.empty else pd.Series(dtype=float)
+
+    # Скорости отдела — слияние гистограмм его операторов
+    dept_ops = df['operator_id'].unique() if not df.empty else []
+    d_speeds = SpeedSketch.merge_all(sm[o_id] for o_id in dept_ops if o_id in sm)
+    d_first = SpeedSketch.merge_all(fsm[o_id] for o_id in dept_ops if o_id in fsm)
+
+    avg_s = d_speeds.median() or 0
+    avg_fs = d_first.median() or 0
+    p90_s = d_speeds.quantile(0.9) or 0
+
+    daily_c = df.groupby('Дата', observed=True)['req_id'].nunique() if not df.empty else pd.Series(dtype=float)
+    if is_bot:
+        daily_o = pd.Series(1, index=daily_c.index) if not daily_c.empty else pd.Series(dtype=float)
+    else:
+        daily_o = df[~df['is_tl']].groupby('Дата', observed=True)['operator_id'].nunique() if not df.empty else pd.Series(dtype=float)
+
+    daily_stats = pd.DataFrame({'c': daily_c, 'o': daily_o}).fillna(0)
+    avg_specs = daily_stats['o'].mean() if not daily_stats.empty else 0
+    daily_stats['load'] = daily_stats.apply(lambda r: r['c']/r['o'] if r['o']>0 else r['c'], axis=1)
+    avg_load = daily_stats['load'].mean() if not daily_stats.empty else 0
+
+    return {
+        'chats': chats, 'ratings': len(ratings), 'csat': ratings.mean() if len(ratings)>0 else 0,
+        'specs': round(avg_specs) if not is_bot else 1,
+        'load': round(avg_load),
+        'speed': avg_s, 'first_speed': avg_fs, 'speed_p90': p90_s
+    }
+
+def operator_speed_stats(df, sm, fsm):
+    """Скорости ответов по операторам за период: чаты, число ответов,
+    медиана первого ответа, медиана и p90 всех ответов (секунды)"""
+    ops = df.groupby(['operator_id', 'Оператор', 'Отдел', 'is_tl'], observed=True).agg(chats=('req_id', 'nunique')).reset_index()
+    rows = []
+    for row in ops.itertuples(index=False):
+        speeds, first = sm.get(row.operator_id), fsm.get(row.operator_id)
+        rows.append({
+            'operator_id': row.operator_id, 'operator': row.Оператор, 'department': row.Отдел,
+            'is_tl': bool(row.is_tl), 'chats': row.chats,
+            'answers': speeds.count if speeds is not None else 0,
+            'first_speed_median': first.median() if first is not None else None,
+            'speed_median': speeds.median() if speeds is not None else None,
+            'speed_p90': speeds.quantile(0.9) if speeds is not None else None
+        })
+    return pd.DataFrame(rows)
+
+
+class Pipeline:
+    """Загрузка и хранение посуточных результатов API. Потокобезопасен,
+    один экземпляр на процесс."""
+
+    def __init__(self, api_token, store_path, rate=25, http_mode="threads", base_url=BASE_URL, max_workers=MAX_WORKERS,
+                 metrics=None, cpu_workers=CPU_WORKERS):
+        self.api_token = api_token
+        self.base_url = base_url
+        self.http_mode = http_mode  # "threads" | "async" (нужен aiohttp)
+        self.max_workers = max_workers
+        self.cpu_workers = cpu_workers
+        self._cpu_pool = None
+        self._cpu_pool_lock = threading.Lock()
+        self.metrics = metrics or Metrics()
+        # Один лимит запросов на процесс: списки чатов, справочник и сообщения (в том
+        # числе асинхронные загрузки разных сессий) делят скорость и паузы после 429
+        self.limiter = AdaptiveRateLimiter(rate, ASYNC_MAX_CONNECTIONS if http_mode == "async" else max_workers)
+        # Одна сессия с keep-alive на процесс, общая для всех пользователей
+        self.client = Chat2DeskClient(base_url, api_token, pool_size=max_workers, limiter=self.limiter, metrics=self.metrics)
+        self.store = DayStore(store_path)
+        # Индекс справочника строится один раз, отдел и роль запоминаются на operator_id
+        self.resolver = OperatorResolver(DEPARTMENT_MAPPING, CUSTOM_GROUPING, TL_ROOTS, bot_id=BOT_ID)
+        # Имена операторов из API: служебные + справочник с TTL, хранится вместе с днями
+        self.operators = OperatorDirectory(self.client, self.resolver, self.metrics, self.store, OPERATORS_MAP)
+        # Дни, которые сейчас грузятся из API (любой сессией или фоновым обновлением)
+        self.flights = SingleFlight()
+
+    def cpu_pool(self):
+        """Пул процессов стадии расчета (один на Pipeline, создается при первой
+        загрузке). spawn, а не fork: процесс многопоточный (сессии, фон)."""
+        with self._cpu_pool_lock:
+            if self._cpu_pool is None:
+                self._cpu_pool = ProcessPoolExecutor(self.cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._cpu_pool
+
+    async def process_dialogs_async(self, jobs, on_result):
+        """Асинхронный вариант пула потоков: все запросы сообщений в одном потоке.
+        jobs — кортежи (item, target_start, target_end, key) (можно генератором:
+        берутся по мере загрузки, не больше ASYNC_MAX_CONNECTIONS в полете);
+        on_result(key, messages | None) — корутина: пока она ждет, воркер не берет
+        новое задание."""
+        async with AsyncChat2DeskClient(self.base_url, self.api_token, max_connections=ASYNC_MAX_CONNECTIONS,
+                                        limiter=self.limiter, metrics=self.metrics) as client:
+            async def fetch(job):
+                item, target_start, target_end = job[:3]
+                if last_activity_before(item, target_start): return []
+                try:
+                    reader = DialogMessageReader(target_start, target_end)
+                    while not reader.done:
+                        status, data = await client.get_json(f"/requests/{item['req_id']}/messages", {"limit": MESSAGES_PAGE_LIMIT, "offset": reader.offset})
+                        if status != 200: return None
+                        reader.feed(extract_messages(data))
+                    return reader.messages
+                except Exception:
+                    return None
+
+            jobs = iter(jobs)
+            async def worker():
+                # Задания берутся из общего итератора: в полете не больше числа воркеров
+                for job in jobs:
+                    await on_result(job[3], await fetch(job))
+
+            await asyncio.gather(*(worker() for _ in range(ASYNC_MAX_CONNECTIONS)))
+
+    def fetch_request_lists(self, days, on_day_done=None):
+        """Списки чатов по дням из request_stats без ограничения на число страниц.
+
+        Дни запрашиваются параллельно, внутри дня страницы идут волнами по
+        STATS_PREFETCH_PAGES штук (наперед), пока не встретится неполная страница
+        или страница из одних уже полученных request_id (сервер игнорирует offset).
+        Сбойная страница повторяется до RETRY_ROUNDS раз с растущей паузой
+        (волна ждет ее, остальные дни грузятся дальше).
+        Возвращает {day: (items, complete)}; complete=False — часть страниц так и
+        не загрузилась и список дня неполный."""
+        client = self.client
+        pages = {day: {} for day in days}
+        state = {day: {'next': 0, 'end': None, 'failed': set(), 'pending': 0, 'attempts': {}, 'seen': set()} for day in days}
+        result = {}
+        retry_queue = []  # куча (когда повторить, day, offset)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+
+            def submit(day, offset):
+                futures[executor.submit(fetch_stats_page, client, day.strftime("%Y-%m-%d"), offset)] = (day, offset)
+
+            def submit_wave(day):
+                d_state = state[day]
+                for _ in range(STATS_PREFETCH_PAGES):
+                    offset = d_state['next']
+                    d_state['next'] += STATS_PAGE_LIMIT
+                    d_state['pending'] += 1
+                    submit(day, offset)
+
+            for day in days: submit_wave(day)
+
+            while futures or retry_queue:
+                now = time.monotonic()
+                while retry_queue and retry_queue[0][0] <= now:
+                    _, day, offset = heapq.heappop(retry_queue)
+                    submit(day, offset)
+                timeout = retry_queue[0][0] - now if retry_queue else None
+                if not futures:
+                    time.sleep(max(timeout, 0))
+                    continue
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    day, offset = futures.pop(future)
+                    d_state = state[day]
+                    try:
+                        data = future.result()
+                        pages[day][offset] = data
+                        ids = {row.get('request_id') for row in data}
+                        if len(data) < STATS_PAGE_LIMIT or ids <= d_state['seen']:
+                            d_state['end'] = offset if d_state['end'] is None else min(d_state['end'], offset)
+                        d_state['seen'] |= ids
+                    except Exception:
+                        attempt = d_state['attempts'].get(offset, 0)
+                        # Страницы после найденного конца дня не нужны — их не повторяем
+                        if attempt < RETRY_ROUNDS and (d_state['end'] is None or offset <= d_state['end']):
+                            d_state['attempts'][offset] = attempt + 1
+                            heapq.heappush(retry_queue, (time.monotonic() + backoff_delay(attempt), day, offset))
+                            self.metrics.inc('retries_total', kind='stats_page')
+                            continue
+                        d_state['failed'].add(offset)
+
+                    d_state['pending'] -= 1
+                    if d_state['pending']: continue
+                    # Волна закончилась: идем дальше, если конец не найден и ошибок не было
+                    if d_state['end'] is None and not d_state['failed']:
+                        submit_wave(day)
+                        continue
+                    end = d_state['end'] if d_state['end'] is not None else d_state['next']
+                    complete = not any(off <= end for off in d_state['failed'])
+                    rows = [row for off in sorted(pages[day]) if off <= end for row in pages[day][off]]
+                    result[day] = (stats_rows_to_items(rows), complete)
+                    if on_day_done: on_day_done(day)
+
+        return result
+
+    def fetch_days(self, days, on_progress=None, full_reload=False, on_partial=None, reload_days=(), settled_days=()):
+        """Запрашивает дни у API. Все диалоги всех дней идут в один конвейер,
+        окно анализа у каждого диалога — его собственный день.
+
+        Если для дня есть сохраненные состояния диалогов (открытый день уже
+        загружался), обновление инкрементальное: сообщения запрашиваются только у
+        новых диалогов, у тех, чья строка в request_stats изменилась, и у тех, где
+        по ней была активность позже сохраненного состояния (последнего учтенного
+        сообщения, а без сообщений — водяного знака дня), а обрабатываются только
+        сообщения новее водяного знака диалога. full_reload (все дни) и
+        reload_days (только эти) — загрузить заново, без сохраненных состояний.
+        settled_days — дни, чьи состояния посчитаны уже после закрытия дня: они
+        окончательные, запрашиваются только новые и не загрузившиеся диалоги.
+        Диалоги, которые не загрузились, повторяются раундами (до RETRY_ROUNDS,
+        с растущей паузой); посчитанные по ходу сохраняются контрольными точками.
+
+        Стадии: I/O (не больше IO_QUEUE_DIALOGS диалогов в загрузке) -> пачки по
+        ENGINE_BATCH_DIALOGS в process_dialog_batch (при cpu_workers > 0 — в пуле
+        процессов, не больше CPU_QUEUE_BATCHES пачек на процесс; в режиме async —
+        через run_in_executor, не блокируя цикл событий) -> слияние частичных
+        агрегатов дней. Полная очередь расчета останавливает I/O.
+
+        on_progress(доля 0..1, текст) — ход загрузки (для прогресс-бара), может быть None.
+        on_partial(rows, (speeds, first_speeds), готово, всего) — потоковый режим: не
+        реже раза в STREAM_INTERVAL секунд отдает участия (формат DayStore) и
+        гистограммы скоростей всех посчитанных к этому моменту диалогов.
+        Возвращает {day: (result, states, watermark, complete, coverage)}."""
+        store = self.store
+        if on_progress is None: on_progress = lambda frac, text: None
+        day_prev = {day: {} if full_reload or day in reload_days else store.dialog_states(day, STORE_VERSION) for day in days}
+
+        listed = 0
+        def on_day_listed(day):
+            nonlocal listed
+            listed += 1
+            on_progress(listed / (len(days) * 2), f"Сбор списка чатов: {listed}/{len(days)} дн. (последний {day})")
+
+        with self.metrics.timer('stage_seconds', stage='stats_pages'):
+            day_lists = self.fetch_request_lists(days, on_day_listed)
+        day_items = {day: items for day, (items, _) in day_lists.items()}
+
+        day_states = {day: {} for day in days}
+        reused = {day: [] for day in days}
+        coverage = {
+            day: {**dict.fromkeys(COVERAGE_KEYS, 0), 'listed': len(day_items[day]), 'stats_complete': day_lists[day][1]}
+            for day in days
+        }
+        jobs = []
+        for day, items in day_items.items():
+            prev = day_prev[day]
+            watermark = store.watermark(day) if prev else None
+            settled = day in settled_days
+            for item in items:
+                fp, raw = prev.get(item['req_id'], (None, None))
+                state = None
+                if raw is not None and (fp == item['fp'] or (settled and fp)):
+                    state = load_dialog_state(raw)
+                    # Строка отчета меняется не с каждым сообщением: отпечаток — только
+                    # дополнительная проверка, главное — не было ли активности позже состояния
+                    if not settled and last_activity_after(item, state['last_ts'] or watermark): state = None
+                if state is not None:
+                    day_states[day][item['req_id']] = (fp, raw)
+                    reused[day].append(state)
+                    coverage[day]['reused'] += 1
+                else:
+                    jobs.append((day, item, raw))
+            if not day_lists[day][1]:
+                # Список дня неполный — не теряем диалоги, которые уже были посчитаны
+                listed_ids = {item['req_id'] for item in items}
+                for req_id, (fp, raw) in prev.items():
+                    if req_id not in listed_ids:
+                        day_states[day][req_id] = (fp, raw)
+                        reused[day].append(load_dialog_state(raw))
+
+        # Агрегаты дней: диалоги, не изменившиеся с прошлой загрузки, — сразу,
+        # посчитанные — частичными агрегатами пачек (изменившиеся диалоги
+        # продолжают прошлое состояние, поэтому уже включают свой прошлый вклад)
+        day_parts = {day: day_part(reused[day]) for day in days}
+        stream_rows, stream_speeds = [], ({}, {})
+        if on_partial:
+            for part in day_parts.values():
+                stream_rows.extend(part['rows'])
+                speed_sketches(part['speeds'], stream_speeds)
+
+        total = len(jobs)
+        completed = 0
+        batch = []
+        last_flush = time.monotonic()
+        cpu_pool = self.cpu_pool() if self.cpu_workers > 0 else None
+        cpu_queue = deque()
+
+        def report_progress():
+            if total > 0:
+                current_prog = 0.5 + (completed / total * 0.5)
+                on_progress(min(current_prog, 1.0), f"Анализ диалогов: {completed}/{total}")
+
+        def merge_batch(result):
+            # Слияние: состояния диалогов и частичные агрегаты дней. Возвращает
+            # контрольную точку {day: {req_id: (fp, state)}} для save_checkpoint
+            states, parts, seconds = result
+            self.metrics.observe('stage_seconds', seconds, stage='process')
+            with self.metrics.timer('stage_seconds', stage='merge'):
+                checkpoint = {}
+                for i, state in states:
+                    day, item, raw = jobs[i]
+                    day_states[day][item['req_id']] = checkpoint.setdefault(day, {})[item['req_id']] = (item['fp'], state)
+                for day, part in parts.items():
+                    merge_day_part(day_parts[day], part)
+            if on_partial and parts:
+                for part in parts.values():
+                    stream_rows.extend(part['rows'])
+                    speed_sketches(part['speeds'], stream_speeds)
+                on_partial(stream_rows, stream_speeds, completed, total)
+            return checkpoint
+
+        def save_checkpoint(checkpoint):
+            # Контрольная точка: при падении процесса следующая загрузка не перезапрашивает эти диалоги
+            with self.metrics.timer('stage_seconds', stage='checkpoint'):
+                for day, day_checkpoint in checkpoint.items():
+                    store.checkpoint_states(day, STORE_VERSION, day_checkpoint)
+
+        def drain(limit):
+            # Готовые пачки сливаются по порядку; больше limit в очереди — ждем (backpressure)
+            while cpu_queue and (len(cpu_queue) > limit or cpu_queue[0].done()):
+                if not cpu_queue[0].done():
+                    with self.metrics.timer('stage_seconds', stage='cpu_wait'):
+                        cpu_queue[0].result()
+                save_checkpoint(merge_batch(cpu_queue.popleft().result()))
+
+        def flush_batch():
+            nonlocal batch, last_flush
+            if batch:
+                if cpu_pool is None:
+                    save_checkpoint(merge_batch(process_dialog_batch(batch)))
+                else:
+                    cpu_queue.append(cpu_pool.submit(process_dialog_batch, batch))
+                    drain(self.cpu_workers * CPU_QUEUE_BATCHES)
+            batch = []
+            last_flush = time.monotonic()
+
+        def collect(i, msgs):
+            # Скачанный диалог — в пачку; True — пачку пора отдавать в расчет
+            nonlocal completed
+            day, item, raw = jobs[i]
+            batch.append((i, day, item, msgs, raw))
+            coverage[day]['skipped' if last_activity_before(item, day_window(day)[0]) else 'fetched'] += 1
+            completed += 1
+            return len(batch) >= ENGINE_BATCH_DIALOGS or (on_partial and time.monotonic() - last_flush >= STREAM_INTERVAL)
+
+        retry = []
+        def on_result(i, msgs):
+            if msgs is None:
+                retry.append(i)  # сбой запроса — в очередь повторов
+                return
+            if collect(i, msgs):
+                flush_batch()
+            elif cpu_queue:
+                drain(self.cpu_workers * CPU_QUEUE_BATCHES)
+            report_progress()
+
+        async def dispatch_async(indices):
+            # Те же стадии в цикле событий: пачка считается в пуле процессов через
+            # run_in_executor, ожидание пачки и запись контрольной точки — await,
+            # чтобы не останавливать загрузку. При cpu_workers=0 расчет, как и в
+            # потоках, в основном потоке (поток рядом с циклом отнимал бы у него GIL)
+            loop = asyncio.get_running_loop()
+            merging = asyncio.Lock()  # слияние по порядку, по одной пачке
+            queue_limit = self.cpu_workers * CPU_QUEUE_BATCHES
+
+            async def drain_async(limit):
+                async with merging:
+                    while cpu_queue and (len(cpu_queue) > limit or cpu_queue[0].done()):
+                        if not cpu_queue[0].done():
+                            with self.metrics.timer('stage_seconds', stage='cpu_wait'):
+                                await cpu_queue[0]
+                        checkpoint = merge_batch(cpu_queue.popleft().result())
+                        await loop.run_in_executor(None, save_checkpoint, checkpoint)
+
+            async def flush_async():
+                nonlocal batch, last_flush
+                # Пачку забираем до await: пока ждем, другие воркеры собирают следующую
+                ready, batch = batch, []
+                last_flush = time.monotonic()
+                if ready and cpu_pool is None:
+                    save_checkpoint(merge_batch(process_dialog_batch(ready)))
+                elif ready:
+                    cpu_queue.append(loop.run_in_executor(cpu_pool, process_dialog_batch, ready))
+                    await drain_async(queue_limit)
+
+            async def on_result_async(i, msgs):
+                if msgs is None:
+                    retry.append(i)
+                    return
+                if collect(i, msgs):
+                    await flush_async()
+                elif cpu_queue and not merging.locked():
+                    await drain_async(queue_limit)
+                report_progress()
+
+            await self.process_dialogs_async(((jobs[i][1], *day_window(jobs[i][0]), i) for i in indices), on_result_async)
+            await flush_async()
+            await drain_async(0)
+
+        def dispatch(indices):
+            if self.http_mode == "async":
+                asyncio.run(dispatch_async(indices))
+                return
+            client = self.client
+            indices = iter(indices)
+            done = queue.SimpleQueue()
+            in_flight = 0
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                def submit(n):
+                    # Очередь загрузки ограничена: новые диалоги — по мере того, как забираются готовые
+                    nonlocal in_flight
+                    for i in islice(indices, n):
+                        future = executor.submit(fetch_dialog_messages, client, jobs[i][1], *day_window(jobs[i][0]))
+                        future.add_done_callback(lambda future, i=i: done.put((i, future)))
+                        in_flight += 1
+                submit(IO_QUEUE_DIALOGS)
+                while in_flight:
+                    i, future = done.get()
+                    in_flight -= 1
+                    on_result(i, future.result())
+                    submit(1)
+
+        started = time.perf_counter()
+        pending = list(range(total))
+        for attempt in range(RETRY_ROUNDS + 1):
+            if attempt:
+                delay = backoff_delay(attempt - 1)
+                on_progress(min(0.5 + completed / total * 0.5, 1.0), f"Повтор {attempt}/{RETRY_ROUNDS}: {len(pending)} диалогов через {delay:.0f} с")
+                self.metrics.inc('retries_total', len(pending), kind='dialog')
+                time.sleep(delay)
+            retry = []
+            dispatch(pending)
+            pending = retry
+            if not pending: break
+        flush_batch()
+        drain(0)
+
+        for i in pending:
+            # Не загрузился и после повторов: прошлое состояние (или пустое) с пустым
+            # отпечатком — в следующий раз (retry_failed) диалог запросится снова
+            day, item, raw = jobs[i]
+            if raw is not None:
+                merge_day_part(day_parts[day], day_part([load_dialog_state(raw)]))
+            day_states[day][item['req_id']] = ('', raw if raw is not None else dump_dialog_state(new_dialog_state(item)))
+            coverage[day]['failed'] += 1
+            completed += 1
+        if pending:
+            self.metrics.inc('dialogs_failed_total', len(pending))
+            report_progress()
+        if jobs:
+            # Загрузка сообщений и расчет вместе: диалогов в секунду = dialogs_processed_total / сумма этой стадии
+            self.metrics.observe('stage_seconds', time.perf_counter() - started, stage='dialogs')
+            self.metrics.inc('dialogs_processed_total', completed)
+
+        out = {}
+        for day, states in day_states.items():
+            part = day_parts[day]
+            result = {'rows': part['rows'], 'speeds': part['speeds']}
+            out[day] = (result, states, part['watermark'], coverage_complete(coverage[day]), coverage[day])
+        return out
+
+    def refresh_days(self, days, full_reload=False, max_age=0, on_progress=None, on_wait=None, on_partial=None):
+        """Догружает в хранилище дни, которых там нет или которые еще открыты.
+        Открытый день, обновленный не раньше max_age секунд назад (фоновым
+        обновлением или другой сессией), не перезапрашивается. День, который
+        прямо сейчас грузит другая сессия, не запрашивается повторно — ждем ее
+        (on_wait). on_partial(facts, speeds, first_speeds, готово, всего) —
+        потоковый режим: промежуточная таблица фактов по всем дням (готовые из
+        хранилища + уже посчитанные диалоги загружаемых), как у read_range.
+        Возвращает дни, загруженные не полностью (список чатов или диалоги с
+        ошибками)."""
+        store = self.store
+        # Закрытые дни берем из хранилища, у API спрашиваем только недостающие и открытые
+        ready = store.final_days(days, STORE_VERSION)
+        if max_age and not full_reload: ready |= store.fresh_days(days, STORE_VERSION, max_age)
+        missing = [d for d in days if d not in ready]
+        if not missing: return []
+
+        publish = self.partial_publisher([d for d in days if d in ready], on_partial) if on_partial else None
+
+        def fetch(own_days):
+            # День, который сохранится закрытым, грузится целиком: сохраненные состояния
+            # открытого дня могли отстать от API, а закрытый день больше не перезапрашивается.
+            # Если день уже так загружался, но сохранен неполным (покрытие с final_states),
+            # его состояния окончательные — повторяются только диалоги, которые не загрузились.
+            closing = {day for day in own_days if is_day_final(day)}
+            saved = store.coverage(closing)
+            settled = {day for day in closing if saved.get(day, {}).get('final_states')}
+            complete_by_day = {}
+            fetched = self.fetch_days(own_days, on_progress, full_reload, publish, reload_days=closing - settled,
+                                      settled_days=settled)
+            for day, (result, states, watermark, complete, coverage) in fetched.items():
+                coverage['final_states'] = day in closing
+                # Неполный день не фиксируем как закрытый — в следующий раз он перезапросится
+                with self.metrics.timer('stage_seconds', stage='save'):
+                    store.save_day(day, result, STORE_VERSION, complete and day in closing, states, watermark, coverage)
+                complete_by_day[day] = complete
+            self.metrics.inc('days_fetched_total', len(own_days))
+            return complete_by_day
+
+        complete_by_day = self.flights.do_many(missing, fetch, on_wait)
+        return [day for day in missing if not complete_by_day.get(day)]
+
+    def partial_publisher(self, ready_days, on_partial):
+        """Колбэк для fetch_days: промежуточные участия загружаемых дней + готовые
+        дни из хранилища -> on_partial(facts, speeds, first_speeds, готово, всего)"""
+        base_cols = self.store.load_facts(ready_days) if ready_days else ([], [], [], [], [])
+        base_speeds, base_first = self.store.load_speed_sketches(ready_days) if ready_days else ({}, {})
+
+        def merged(base, extra):
+            out = dict(base)
+            for op_id, sketch in extra.items():
+                out[op_id] = SpeedSketch.merge_all([out[op_id], sketch]) if op_id in out else sketch
+            return out
+
+        def publish(rows, speeds, done, total):
+            with self.metrics.timer('stage_seconds', stage='partial_build'):
+                cols = [base + extra for base, extra in zip(base_cols, fact_columns(rows))]
+                facts = build_api_facts(*cols, self.operators) if cols[0] else pd.DataFrame()
+            on_partial(facts, merged(base_speeds, speeds[0]), merged(base_first, speeds[1]), done, total)
+        return publish
+
+    def retry_failed(self, days, on_progress=None, on_wait=None):
+        """Догружает только то, что не загрузилось: дни с ошибками в списке чатов
+        или диалогах и дни, которых еще нет в хранилище. Внутри дня запрашиваются
+        только сбойные (у открытого — и изменившиеся) диалоги, остальные берутся
+        из хранилища; день, который уже можно закрыть, но состояния которого
+        посчитаны еще открытым днем, загружается целиком.
+        Возвращает дни, которые и после этого неполные."""
+        coverage = self.store.coverage(days)
+        todo = [day for day in days if not coverage_complete(coverage.get(day))]
+        return self.refresh_days(todo, on_progress=on_progress, on_wait=on_wait)
+
+    def coverage(self, days):
+        """Покрытие дней из хранилища (coverage_summary). Дни, закрытые до
+        появления покрытия, считаются полными и в счетчики не входят."""
+        return coverage_summary(self.store.coverage(days))
+
+    def read_range(self, start_date, end_date):
+        """Факты и гистограммы скоростей за диапазон из хранилища:
+        (таблица фактов, {op_id: SpeedSketch}, {op_id: SpeedSketch} первых ответов)"""
+        date_list = [d.date() for d in pd.date_range(start_date, end_date)]
+
+        with self.metrics.timer('stage_seconds', stage='read_store'):
+            # Скорости — гистограммы по оператору, слитые за все дни диапазона
+            all_speeds, all_first_speeds = self.store.load_speed_sketches(date_list)
+            req_ids, op_ids, ratings, dates, hour_masks = self.store.load_facts(date_list)
+        if not req_ids: return pd.DataFrame(), all_speeds, all_first_speeds
+        with self.metrics.timer('stage_seconds', stage='facts_build'):
+            facts = build_api_facts(req_ids, op_ids, ratings, dates, hour_masks, self.operators)
+        return facts, all_speeds, all_first_speeds
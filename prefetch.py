@@ -0,0 +1,73 @@
+"""
+Фоновое обновление ходовых периодов: сегодня, вчера, последние 7 дней и
+прошлые к ним периоды (для динамики в отчетах).
+
+PrefetchScheduler — поток-демон: раз в interval секунд, в рабочие часы,
+вызывает job(days) для дней, покрывающих эти периоды. Сама загрузка
+(API -> DayStore) передается снаружи. Интерфейс потом только читает
+готовые дни из хранилища, а не ждет API на первом запуске за день.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+log = logging.getLogger(__name__)
+
+# (сколько дней назад заканчивается период, длина периода в днях): сегодня, вчера, 7 дней
+DEFAULT_PERIODS = ((0, 1), (1, 1), (0, 7))
+
+
+def period_days(today, periods):
+    """Дни, покрывающие периоды и равные им прошлые периоды, по возрастанию"""
+    days = set()
+    for end_offset, length in periods:
+        end = today - timedelta(days=end_offset)
+        days.update(end - timedelta(days=i) for i in range(2 * length))
+    return sorted(days)
+
+
+class PrefetchScheduler:
+    """Периодический прогрев хранилища в отдельном потоке.
+
+    now() — текущее локальное время (datetime): по нему выбираются дни и
+    проверяются рабочие часы hours = (с, до). Ошибка job не останавливает
+    поток: она запоминается в last_error, следующий запуск — по расписанию.
+    """
+
+    def __init__(self, job, now, interval, periods=DEFAULT_PERIODS, hours=(0, 24)):
+        self.job = job
+        self.now = now
+        self.interval = interval
+        self.periods = periods
+        self.hours = hours
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="prefetch", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        started = time.monotonic()
+        try:
+            self.job(period_days(self.now().date(), self.periods))
+            self.last_error = None
+        except Exception as e:
+            log.exception("prefetch failed")
+            self.last_error = e
+        self.last_run = self.now()
+        self.last_duration = time.monotonic() - started
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if self.hours[0] <= self.now().hour < self.hours[1]: self.run_once()
+            self._stop.wait(self.interval)
@@ -0,0 +1,67 @@
+"""
+Справочники: служебные операторы, отделы операторов и тимлиды.
+
+Общие для дашборда и пакетной выгрузки (batch.py).
+"""
+
+BOT_ID = 310507
+OPERATORS_MAP = {BOT_ID: "Бот AI", 0: "Система"}
+DEPARTMENT_MAPPING = {
+    "Никита Приходько": "Concierge",
+    "Алина Федулова": "Тренер",
+    "Илья Аврамов": "Appointment",
+    "Виктория Суворова": "Appointment",
+    "Кирилл Минаев": "Appointment",
+    "Мария Попова": "Без отдела",
+    "Станислав Басов": "Claims",
+    "Милена Говорова": "Без отдела",
+    "Надежда Смирнова": "Сопровождение",
+    "Ирина Вережан": "Claims",
+    "Наталья Половникова": "Claims",
+    "Администратор": "Без отдела",
+    "Владимир Асатрян": "Без отдела",
+    "Екатерина Ермакова": "Без отдела",
+    "Константин Гетман": "SMM",
+    "Екатерина Анисимова": "Без отдела",
+    "Оля Трущелева": "Без отдела",
+    "Алина Новикова": "SALE",
+    "Иван Савицкий": "SALE",
+    "Анастасия Ванян": "SALE",
+    "Павел Новиков": "SALE",
+    "Александра Шаповал": "SMM",
+    "Георгий Астапов": "Deep_support",
+    "Елена Панова": "Deep_support",
+    "Татьяна Сошникова": "SMM",
+    "Виктория Вороняк": "SMM",
+    "Анна Чернышова": "SMM",
+    "Алина Ребрина": "Claims",
+    "Алена Воронина": "Claims",
+    "Ксения Бухонина": "Сопровождение",
+    "Елизавета Давыденко": "Сопровождение",
+    "Екатерина Кондратьева": "Сопровождение",
+    "Ксения Гаврилова": "Claims",
+    "Снежана Ефимова": "Сопровождение",
+    "Анастасия Карпеева": "Claims",
+    "Кристина Любина": "Сопровождение",
+    "Наталья Серебрякова": "Сопровождение",
+    "Константин Клишин": "Claims",
+    "Наталья Баландина": "Claims",
+    "Даниил Гусев": "Appointment",
+    "Анна Власенкова": "SMM",
+    "Регина Арендт": "Сопровождение",
+    "Екатерина Щукина": "Сопровождение",
+    "Ксения Кривко": "Claims",
+    "Вероника Софронова": "SMM",
+    "Юрий Кобелев": "Claims",
+    "Арина Прохорова": "SMM"
+}
+
+CUSTOM_GROUPING = {
+    "Cleaner_Payments": "Сопровождение",
+    "Penalty": "Сопровождение",
+    "Operations": "Сопровождение",
+    "Storage": "Сопровождение"
+}
+
+# Корни фамилий тимлидов (поиск подстрокой в имени оператора)
+TL_ROOTS = ["черныш", "гетман", "власенков"]
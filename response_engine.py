@@ -0,0 +1,126 @@
+"""
+Векторный расчет скоростей ответа и участий операторов по пачке диалогов.
+
+Сообщения многих диалогов складываются в колоночные массивы NumPy
+(диалог, created, тип, оператор) и обрабатываются за один проход:
+ожидание клиента, скорости ответа, участия и корзины (дата, час).
+
+Семантика совпадает с последовательным разбором диалога:
+- первое входящее сообщение после ответа оператора начинает ожидание;
+- ответ оператора (type == 'out', operator != 0) закрывает ожидание, а если он
+  попал в окно анализа — дает участие, час и (при diff > 0) скорость ответа.
+"""
+from datetime import date, timedelta
+
+import numpy as np
+
+IN_TYPES = ('from_client', 'in')
+KIND_OTHER, KIND_IN, KIND_OUT = 0, 1, 2
+EPOCH = date(1970, 1, 1)
+
+
+class MessageBatch:
+    """Пачка диалогов для расчета. Окна и ожидание — в unix-секундах (UTC)."""
+
+    def __init__(self, tz_offset_hours):
+        self.offset_s = tz_offset_hours * 3600
+        self.keys = []
+        self.win_start, self.win_end, self.init_wait = [], [], []
+        self._dlg, self._ts, self._kind, self._op, self._ids = [], [], [], [], []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, msgs, start_ts, end_ts, init_wait=None, last_ts=0, last_ids=()):
+        """Добавляет диалог. Сообщения не новее (last_ts, last_ids) уже учтены и пропускаются."""
+        if last_ts:
+            seen = set(last_ids)
+            msgs = [m for m in msgs if (m.get('created') or 0) > last_ts
+                    or (m.get('created') == last_ts and m.get('id') not in seen)]
+        msgs = [m for m in msgs if m.get('created')]
+        idx = len(self.keys)
+        self.keys.append(key)
+        self.win_start.append(start_ts)
+        self.win_end.append(end_ts)
+        self.init_wait.append(np.nan if init_wait is None else init_wait)
+
+        ops = [m.get('operatorID') or m.get('operator_id') or 0 for m in msgs]
+        self._dlg.extend([idx] * len(msgs))
+        self._ts.extend(m['created'] for m in msgs)
+        self._op.extend(ops)
+        self._ids.extend(m.get('id') for m in msgs)
+        self._kind.extend(
+            KIND_IN if m.get('type') in IN_TYPES else (KIND_OUT if m.get('type') == 'out' and op else KIND_OTHER)
+            for m, op in zip(msgs, ops)
+        )
+
+    def run(self):
+        """Возвращает список (key, result) в порядке добавления.
+
+        result = {'participations': set(op), 'op_hours': {op: {(date, hour)}},
+                  'operator_speeds': {op: [сек, ...]}, 'waiting': unix | None,
+                  'last_ts': created | None, 'last_ids': [id, ...]}"""
+        results = [{'participations': set(), 'op_hours': {}, 'operator_speeds': {},
+                    'waiting': None if np.isnan(w) else w, 'last_ts': None, 'last_ids': []}
+                   for w in self.init_wait]
+        if not self._ts: return list(zip(self.keys, results))
+
+        dlg = np.asarray(self._dlg, dtype=np.int64)
+        ts = np.asarray(self._ts, dtype=np.float64)
+        order = np.lexsort((ts, dlg))  # устойчивая: при равном created сохраняется порядок API
+        dlg, ts = dlg[order], ts[order]
+        kind = np.asarray(self._kind, dtype=np.int8)[order]
+        op = np.asarray(self._op, dtype=np.int64)[order]
+        ids = np.asarray(self._ids, dtype=object)[order]
+        win_start = np.asarray(self.win_start, dtype=np.float64)
+        win_end = np.asarray(self.win_end, dtype=np.float64)
+        init_wait = np.asarray(self.init_wait, dtype=np.float64)
+
+        is_in, is_out = kind == KIND_IN, kind == KIND_OUT
+        first = np.r_[True, dlg[1:] != dlg[:-1]]
+        last = np.r_[first[1:], True]
+
+        # Сегмент = сообщения после предыдущего ответа оператора (или начала диалога) до ответа включительно
+        boundary = first.copy()
+        boundary[1:] |= is_out[:-1]
+        seg = np.cumsum(boundary) - 1
+        waiting = np.full(seg[-1] + 1, np.nan)
+        in_pos = np.flatnonzero(is_in)
+        if len(in_pos):
+            segs, first_in = np.unique(seg[in_pos], return_index=True)
+            waiting[segs] = ts[in_pos[first_in]]
+        # Ожидание, перенесенное из прошлой обработки, действует до первого ответа
+        carried = init_wait[dlg[first]]
+        has_carried = ~np.isnan(carried)
+        waiting[seg[first][has_carried]] = carried[has_carried]
+
+        out_pos = np.flatnonzero(is_out)
+        out_dlg, out_ts = dlg[out_pos], ts[out_pos]
+        in_window = (out_ts >= win_start[out_dlg]) & (out_ts <= win_end[out_dlg])
+        diff = out_ts - waiting[seg[out_pos]]
+        has_speed = in_window & (diff > 0)  # NaN (ожидания нет) дает False
+
+        part = out_pos[in_window]
+        local = ts[part] + self.offset_s
+        buckets = np.column_stack([dlg[part], op[part], local // 86400, (local % 86400) // 3600]).astype(np.int64)
+        day_cache = {}
+        for d, o, day_num, hour in np.unique(buckets, axis=0).tolist() if len(buckets) else []:
+            res = results[d]
+            res['participations'].add(o)
+            if day_num not in day_cache: day_cache[day_num] = EPOCH + timedelta(days=day_num)
+            res['op_hours'].setdefault(o, set()).add((day_cache[day_num], hour))
+
+        for d, o, s in zip(out_dlg[has_speed].tolist(), op[out_pos][has_speed].tolist(), diff[has_speed].tolist()):
+            results[d]['operator_speeds'].setdefault(o, []).append(s)
+
+        # Состояние на конец: ожидание после последнего сообщения и водяной знак
+        last_pos = np.flatnonzero(last)
+        end_wait = np.where(is_out[last_pos], np.nan, waiting[seg[last_pos]])
+        for d, pos, w in zip(dlg[last_pos].tolist(), last_pos.tolist(), end_wait.tolist()):
+            res = results[d]
+            res['waiting'] = None if np.isnan(w) else w
+            res['last_ts'] = ts[pos].item()
+            start = pos
+            while start > 0 and dlg[start - 1] == d and ts[start - 1] == ts[pos]: start -= 1
+            res['last_ids'] = ids[start:pos + 1].tolist()
+        return list(zip(self.keys, results))
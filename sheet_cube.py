@@ -0,0 +1,139 @@
+"""
+Предагрегированный куб по выгрузке Google Sheet.
+
+Строки таблицы сворачиваются в ячейки день × час × отдел × тип обращения ×
+статус × продукт × причина перевода со счетчиком n (и позицией первой строки
+first — чтобы при равных счетчиках порядок был как у value_counts). Вкладки
+считают по ячейкам, которых на порядки меньше, чем строк. Для честного CSAT
+бота отдельно хранятся ID обращений, закрытых ботом, по дням.
+
+Куб строится один раз при загрузке таблицы и дополняется дописанными строками
+(см. SheetLoader). Объект не меняется на месте: дозагрузка создает новый куб.
+
+Динамика по нескольким периодам (topic_dynamics) считается по ячейкам сразу
+для всех периодов: метка периода и одна группировка.
+"""
+import numpy as np
+import pandas as pd
+
+DIMENSIONS = ['Отдел', 'Тип обращения', 'Статус', 'Продукт', 'Причина перевода']
+KEYS = ['День', 'Час'] + DIMENSIONS
+CELL_COLUMNS = KEYS + ['n', 'first']
+
+
+def normalize_ids(values):
+    """ID обращения -> строка без хвоста '.0' (если pandas прочитал ID как float)"""
+    return pd.Series(values).astype(str).str.replace(r'\.0$', '', regex=True)
+
+
+def _group(frame, how):
+    cells = frame.groupby(KEYS, observed=True, dropna=False, sort=False).agg(**how).reset_index()
+    return cells.sort_values('День', kind='stable', ignore_index=True)
+
+
+def aggregate(df, offset=0):
+    """Строки таблицы -> (ячейки, ID закрытых ботом). offset — номер первой строки df в общей таблице."""
+    if df.empty:
+        return pd.DataFrame(columns=CELL_COLUMNS), pd.DataFrame(columns=['День', 'ID'])
+    day = df['Дата'].dt.normalize()
+    frame = pd.DataFrame({'День': day, 'Час': df['Час'].to_numpy()})
+    for c in DIMENSIONS:
+        frame[c] = df[c] if c in df.columns else pd.Categorical([np.nan] * len(df))
+    frame['Причина перевода'] = frame['Причина перевода'].astype('category')
+    frame['pos'] = np.arange(offset, offset + len(df))
+    cells = _group(frame, {'n': ('pos', 'size'), 'first': ('pos', 'min')})
+
+    if 'ID обращения' in df.columns:
+        closed = df['Статус'] == 'Закрыл'
+        closed_ids = pd.DataFrame({'День': day[closed].to_numpy(), 'ID': normalize_ids(df.loc[closed, 'ID обращения']).to_numpy()})
+        closed_ids = closed_ids.drop_duplicates().sort_values('День', kind='stable', ignore_index=True)
+    else:
+        closed_ids = pd.DataFrame(columns=['День', 'ID'])
+    return cells, closed_ids
+
+
+def day_range(frame, start, end, column='День'):
+    """Строки за дни [start, end] из таблицы, отсортированной по column: два бинарных
+    поиска и срез iloc (без копирования и без перебора дат по строкам)"""
+    days = frame[column].to_numpy()
+    lo = np.searchsorted(days, np.datetime64(pd.Timestamp(start)), side='left')
+    hi = np.searchsorted(days, np.datetime64(pd.Timestamp(end) + pd.Timedelta(days=1)), side='left')
+    return frame.iloc[lo:hi]
+
+
+class SheetCube:
+    """Ячейки куба (отсортированы по дню) и ID закрытых ботом обращений."""
+
+    def __init__(self, cells, closed_ids, has_ids=True):
+        self.cells = cells
+        self.closed = closed_ids
+        self.has_ids = has_ids
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(*aggregate(df), has_ids='ID обращения' in df.columns)
+
+    def append(self, tail, offset):
+        """Новый куб = текущий + строки tail (их номера начинаются с offset)"""
+        cells, closed_ids = aggregate(tail, offset)
+        if cells.empty: return self
+        merged = pd.concat([self.cells, cells], ignore_index=True)
+        for c in DIMENSIONS: merged[c] = merged[c].astype('category')
+        merged = _group(merged, {'n': ('n', 'sum'), 'first': ('first', 'min')})
+        closed = pd.concat([self.closed, closed_ids], ignore_index=True).drop_duplicates()
+        return SheetCube(merged, closed.sort_values('День', kind='stable', ignore_index=True), self.has_ids)
+
+    def slice(self, start, end):
+        """Ячейки за дни [start, end] включительно"""
+        return day_range(self.cells, start, end)
+
+    def closed_ids(self, start, end):
+        """ID обращений, закрытых ботом за дни [start, end]; None, если в таблице нет колонки ID"""
+        if not self.has_ids: return None
+        return day_range(self.closed, start, end)['ID'].tolist()
+
+
+def period_cells(cells, periods, column='День'):
+    """Ячейки периодов [(начало, конец)] с номером периода в колонке 'Период'.
+    Таблица отсортирована по column, поэтому границы всех периодов — бинарные
+    поиски, а ячейки собираются одной выборкой по позициям (периоды могут
+    пересекаться — тогда ячейка входит в каждый свой)."""
+    days = cells[column].to_numpy()
+    starts = np.array([np.datetime64(pd.Timestamp(start)) for start, _ in periods], dtype=days.dtype)
+    ends = np.array([np.datetime64(pd.Timestamp(end) + pd.Timedelta(days=1)) for _, end in periods], dtype=days.dtype)
+    lo = np.searchsorted(days, starts, side='left')
+    hi = np.maximum(np.searchsorted(days, ends, side='left'), lo)
+    sizes = hi - lo
+    # Позиции ячеек всех периодов подряд: lo[i] .. hi[i] - 1 для каждого i
+    offsets = np.repeat(lo - np.cumsum(sizes) + sizes, sizes)
+    out = cells.iloc[np.arange(sizes.sum()) + offsets].reset_index(drop=True)
+    out['Период'] = np.repeat(np.arange(len(periods)), sizes)
+    return out
+
+
+def topic_dynamics(cells, periods):
+    """Объем и % закрытых ботом по типам обращений за каждый из периодов —
+    одной группировкой тип × период. Возвращает (объем, бот_%): таблицы
+    тип обращения × номер периода (0..N-1); % за период без обращений — NaN."""
+    columns = pd.RangeIndex(len(periods), name='Период')
+    labeled = period_cells(cells, periods)
+    if labeled.empty:
+        return pd.DataFrame(columns=columns, dtype='int64'), pd.DataFrame(columns=columns, dtype='float64')
+    closed = labeled['n'].where(labeled['Статус'] == 'Закрыл', 0)
+    grouped = labeled.assign(closed=closed).groupby(['Тип обращения', 'Период'], observed=True)[['n', 'closed']].sum()
+    volume = grouped['n'].unstack(fill_value=0).reindex(columns=columns, fill_value=0)
+    bot_pct = (grouped['closed'] / grouped['n'] * 100).unstack().reindex(columns=columns)
+    return volume, bot_pct
+
+
+def ranked_counts(cells, by):
+    """Сумма n по ключу в порядке value_counts: по убыванию, при равенстве — по первому появлению"""
+    if cells.empty: return pd.Series(dtype='int64')
+    grouped = cells.groupby(by, observed=True).agg(n=('n', 'sum'), first=('first', 'min'))
+    grouped = grouped[grouped['n'] > 0].sort_values(['n', 'first'], ascending=[False, True])
+    return grouped['n']
+
+
+def total_rows(cells, mask=None):
+    """Сколько строк таблицы в ячейках (всех или по маске)"""
+    return int((cells['n'] if mask is None else cells.loc[mask, 'n']).sum())
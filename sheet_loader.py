@@ -0,0 +1,173 @@
+"""
+Загрузка выгрузки Google Sheet (CSV) с условными запросами и дозагрузкой.
+
+SheetLoader держит последнюю разобранную таблицу и при обновлении:
+- шлет If-None-Match / If-Modified-Since; 304 или тот же хэш содержимого —
+  таблица не перечитывается;
+- если новая выгрузка начинается с прежней (строки только дописаны),
+  разбирается лишь хвост, иначе файл разбирается целиком;
+- даты разбираются по явному формату (с запасным разбором для нестандартных
+  строк), текстовые колонки чистятся векторно и хранятся категориями;
+- таблица хранится отсортированной по дате, диапазон дней берется
+  бинарным поиском (sheet_cube.day_range).
+Вместе с таблицей поддерживается куб агрегатов (sheet_cube.SheetCube):
+при полном разборе строится заново, при дозагрузке дополняется хвостом.
+"""
+import hashlib
+import io
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+from sheet_cube import SheetCube
+
+TEXT_COLUMNS = ['Отдел', 'Статус', 'Тип обращения', 'Продукт']
+EMPTY_VALUES = ['nan', '']
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+RETRY_AFTER = 60  # после ошибки загрузки следующий запрос — не раньше, секунды
+
+
+def clean_codes(values):
+    """Категориальная колонка -> (коды, подписи). Чистятся только уникальные значения:
+    пробелы по краям, пустые и NaN -> '-'"""
+    labels = pd.Series(values.cat.categories, dtype=object).astype(str).str.strip()
+    labels = labels.mask(labels.isin(EMPTY_VALUES), '-').tolist() + ['-']
+    codes = values.cat.codes.to_numpy()
+    return np.where(codes < 0, len(labels) - 1, codes), labels
+
+
+def to_categorical(codes, labels):
+    """Коды + подписи (возможно с повторами после чистки) -> Categorical"""
+    cats, remap = np.unique(np.asarray(labels, dtype=object), return_inverse=True)
+    return pd.Categorical.from_codes(remap[codes], cats)
+
+
+def parse_sheet(data, date_format):
+    """CSV (bytes) -> таблица с колонками Дата, Час и категориальными TEXT_COLUMNS"""
+    df = pd.read_csv(io.BytesIO(data), dtype={c: 'category' for c in TEXT_COLUMNS})
+    raw_dates = df['Дата']
+    dates = pd.to_datetime(raw_dates, format=date_format, errors='coerce')
+    # Строки в другом формате (ручные правки) — разбираем по-старому, только их
+    odd = dates.isna() & raw_dates.notna()
+    if odd.any():
+        dates[odd] = pd.to_datetime(raw_dates[odd], dayfirst=True, errors='coerce', format='mixed')
+    df['Дата'] = dates
+    df = df.dropna(subset=['Дата']).reset_index(drop=True)
+
+    # Защита от выгрузок без колонки Продукт
+    if 'Продукт' not in df.columns: df['Продукт'] = pd.Categorical(['-'] * len(df))
+
+    text = {c: clean_codes(df[c]) for c in TEXT_COLUMNS if c in df.columns}
+    # Пустой тип обращения — прямая маршрутизация в отдел: считаем на кодах, а не по строкам
+    if 'Тип обращения' in text and 'Отдел' in text:
+        t_codes, t_labels = text['Тип обращения']
+        d_codes, d_labels = text['Отдел']
+        direct = np.array([label == '-' for label in t_labels])[t_codes]
+        text['Тип обращения'] = (
+            np.where(direct, len(t_labels) + d_codes, t_codes),
+            t_labels + [f"Прямая маршрутизация {d}" for d in d_labels]
+        )
+    for c, (codes, labels) in text.items():
+        df[c] = to_categorical(codes, labels)
+
+    df['Час'] = df['Дата'].dt.hour
+    # Устойчивая сортировка: строки с одинаковым временем остаются в порядке таблицы
+    return df.sort_values('Дата', kind='stable', ignore_index=True)
+
+
+def append_rows(df, tail):
+    """Склеивает таблицы, сохраняя категории (объединение словарей вместо object)"""
+    out = pd.concat([df, tail], ignore_index=True)
+    for c in TEXT_COLUMNS:
+        if c in df.columns and c in tail.columns:
+            out[c] = pd.api.types.union_categoricals([df[c].array, tail[c].array])
+    return out
+
+
+class SheetLoader:
+    """Последняя версия таблицы + метаданные для условной дозагрузки. Потокобезопасен."""
+
+    def __init__(self, url, date_format, max_age=600):
+        self.url = url
+        self.date_format = date_format
+        self.max_age = max_age
+        self.df = None
+        self.cube = None
+        self.checked_at = 0.0
+        self._error = None        # последняя ошибка загрузки и когда она была
+        self._failed_at = 0.0
+        self._etag = None
+        self._last_modified = None
+        self._size = 0
+        self._hash = None
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+
+    def load(self, force=False):
+        """(таблица, куб) не старше max_age секунд. Ошибка загрузки — исключение
+        (прежние таблица и куб остаются в self.df / self.cube). После ошибки
+        RETRY_AFTER секунд (кроме force) повторяется она же, без запроса: пока
+        Google недоступен, сессии не ждут READ_TIMEOUT под замком на каждом прогоне."""
+        with self._lock:
+            now = time.monotonic()
+            if self.df is not None and not force and now - self.checked_at < self.max_age:
+                return self.df, self.cube
+            if self._error is not None and not force and now - self._failed_at < RETRY_AFTER:
+                raise self._error
+            try:
+                self._refresh()
+            except Exception as e:
+                self._error, self._failed_at = e, time.monotonic()
+                raise
+            self._error = None
+            self.checked_at = time.monotonic()
+            return self.df, self.cube
+
+    @property
+    def version(self):
+        """Хэш последней загруженной выгрузки — ключ для кэшей, зависящих от таблицы"""
+        return self._hash
+
+    def _refresh(self):
+        headers = {}
+        if self.df is not None:
+            if self._etag: headers['If-None-Match'] = self._etag
+            if self._last_modified: headers['If-Modified-Since'] = self._last_modified
+        r = self._session.get(self.url, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        if r.status_code == 304 and self.df is not None: return
+        r.raise_for_status()
+        data = r.content
+        self._etag = r.headers.get('ETag')
+        self._last_modified = r.headers.get('Last-Modified')
+
+        digest = hashlib.md5(data).hexdigest()
+        if self.df is not None and digest == self._hash: return
+
+        if self._is_append(data):
+            header = data[:data.index(b'\n') + 1]
+            tail = data[self._size:].lstrip(b'\r\n')
+            if tail:
+                tail_df = parse_sheet(header + tail, self.date_format)
+                merged = append_rows(self.df, tail_df)
+                if tail_df.empty or self.df.empty or tail_df['Дата'].iloc[0] >= self.df['Дата'].iloc[-1]:
+                    self.cube = self.cube.append(tail_df, len(self.df))
+                    self.df = merged
+                else:
+                    # Дописаны строки задним числом — пересортировка и новый куб
+                    self.df = merged.sort_values('Дата', kind='stable', ignore_index=True)
+                    self.cube = SheetCube.from_frame(self.df)
+        else:
+            self.df = parse_sheet(data, self.date_format)
+            self.cube = SheetCube.from_frame(self.df)
+        self._size, self._hash = len(data), digest
+
+    def _is_append(self, data):
+        """Новая выгрузка = прежняя + новые строки (прежняя часть не менялась)"""
+        if self.df is None or len(data) <= self._size or b'\n' not in data: return False
+        if hashlib.md5(data[:self._size]).hexdigest() != self._hash: return False
+        # Прежний файл должен заканчиваться целой строкой, а не обрываться посреди нее
+        return data[self._size - 1:self._size] == b'\n' or data[self._size:self._size + 1] in (b'\r', b'\n')
@@ -0,0 +1,63 @@
+"""
+Single-flight: одна и та же работа, запрошенная одновременно из разных
+сессий (или фонового обновления), выполняется один раз.
+
+Ключи — единицы работы (у нас дни). Вызов берет себе ключи, которые сейчас
+никто не считает, выполняет работу только по ним и ждет результаты по
+остальным у тех вызовов, которые их уже считают. Наборы ключей у вызовов могут
+пересекаться как угодно: диапазон одной сессии, неделя фонового
+прогрева и т.д.
+"""
+import threading
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = {}
+        self.error = None
+
+
+class SingleFlight:
+    """Реестр выполняющихся вычислений по ключам. Потокобезопасен."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do_many(self, keys, fn, on_wait=None):
+        """fn(свои ключи) -> {ключ: результат}. Возвращает {ключ: результат} по всем keys.
+
+        Ключи, которые уже считает другой вызов, в fn не передаются — их
+        результат ждем (on_wait(число таких ключей) вызывается перед ожиданием).
+        Ошибка fn передается всем, кто ждал ее ключи."""
+        own, foreign = [], {}
+        flight = _Flight()
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                other = self._flights.get(key)
+                if other is None:
+                    self._flights[key] = flight
+                    own.append(key)
+                else:
+                    foreign[key] = other
+
+        results = {}
+        if own:
+            try:
+                flight.results = fn(own)
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    for key in own: del self._flights[key]
+                flight.done.set()
+            results.update((key, flight.results.get(key)) for key in own)
+
+        if foreign and on_wait: on_wait(len(foreign))
+        for key, other in foreign.items():
+            other.done.wait()
+            if other.error is not None: raise other.error
+            results[key] = other.results.get(key)
+        return results
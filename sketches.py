@@ -0,0 +1,81 @@
+"""
+Сливаемые гистограммы времени ответа (фиксированные корзины).
+
+До LINEAR_MAX секунд корзины шириной 1 секунду (для целых секунд — точно),
+дальше логарифмические с относительной ошибкой RELATIVE_ERROR. Раскладка
+корзин одна на всех, поэтому гистограммы складываются поэлементно: медиана и
+перцентили по оператору, отделу или любому периоду считаются слиянием
+посуточных гистограмм, а память не растет с числом ответов.
+"""
+import math
+
+import numpy as np
+
+LINEAR_MAX = 120
+RELATIVE_ERROR = 0.005
+MAX_SECONDS = 90 * 86400
+GAMMA = (1 + RELATIVE_ERROR) / (1 - RELATIVE_ERROR)
+N_BUCKETS = LINEAR_MAX + math.ceil(math.log(MAX_SECONDS / LINEAR_MAX, GAMMA)) + 1
+
+# Значение, которым представлена корзина
+BUCKET_VALUES = np.concatenate([
+    np.arange(LINEAR_MAX, dtype=np.float64),
+    2 * LINEAR_MAX * GAMMA ** np.arange(N_BUCKETS - LINEAR_MAX) / (GAMMA + 1)
+])
+BUCKET_VALUES[LINEAR_MAX] = LINEAR_MAX
+
+
+def bucket_of(values):
+    """Номера корзин для массива секунд"""
+    v = np.maximum(np.asarray(values, dtype=np.float64), 0)
+    log_part = LINEAR_MAX + np.ceil(np.log(np.maximum(v, LINEAR_MAX) / LINEAR_MAX) / math.log(GAMMA))
+    idx = np.where(v < LINEAR_MAX, np.floor(v), log_part)
+    return np.minimum(idx, N_BUCKETS - 1).astype(np.int64)
+
+
+class SpeedSketch:
+    """Гистограмма скоростей ответа. Сложение двух скетчей = скетч объединения."""
+
+    __slots__ = ('counts',)
+
+    def __init__(self, counts=None):
+        self.counts = np.zeros(N_BUCKETS, dtype=np.int64) if counts is None else counts
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(np.bincount(bucket_of(values), minlength=N_BUCKETS).astype(np.int64))
+
+    @classmethod
+    def from_buckets(cls, buckets, counts):
+        sketch = cls()
+        np.add.at(sketch.counts, np.asarray(buckets, dtype=np.int64), np.asarray(counts, dtype=np.int64))
+        return sketch
+
+    @classmethod
+    def merge_all(cls, sketches):
+        merged = cls()
+        for s in sketches: merged.counts += s.counts
+        return merged
+
+    def sparse(self):
+        """[(bucket, count)] по непустым корзинам — для хранения"""
+        idx = np.flatnonzero(self.counts)
+        return list(zip(idx.tolist(), self.counts[idx].tolist()))
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        """Перцентиль с линейной интерполяцией между соседними рангами (как np.percentile)"""
+        n = self.count
+        if n == 0: return None
+        cum = np.cumsum(self.counts)
+        rank = q * (n - 1)
+        lo, hi = math.floor(rank), math.ceil(rank)
+        v_lo = BUCKET_VALUES[np.searchsorted(cum, lo, side='right')]
+        v_hi = BUCKET_VALUES[np.searchsorted(cum, hi, side='right')]
+        return float(v_lo + (v_hi - v_lo) * (rank - lo))
+
+    def median(self):
+        return self.quantile(0.5)